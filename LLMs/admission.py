@@ -0,0 +1,390 @@
+import asyncio
+import hashlib
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from functools import partial
+from dotenv import load_dotenv
+from metrics import ADMISSION_DECISIONS
+from resilience import remaining_time
+
+load_dotenv()
+
+
+class AdmissionError(RuntimeError):
+    """
+    A request was turned away before doing any work; answered with 429 and Retry-After.
+    """
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+def _api_keys():
+    return {key.strip() for key in os.getenv("API_KEYS", "").split(",") if key.strip()}
+
+
+def client_address(headers, remote_addr):
+    """
+    The client's IP address; the one forwarded by a proxy (X-Forwarded-For) when
+    TRUST_PROXY_HEADERS is on.
+    """
+    address = remote_addr or "unknown"
+    if os.getenv("TRUST_PROXY_HEADERS", "off").lower() in ("1", "on", "true", "yes"):
+        forwarded = headers.get("X-Forwarded-For")
+        if forwarded:
+            address = forwarded.split(",")[0].strip()
+    return "ip:" + address
+
+
+def client_identity(headers, remote_addr):
+    """
+    Who a request is accounted to: its API key (X-API-Key, hashed), else the signed-in
+    user's Clerk id sent by the frontend (X-User-Id), else its IP address.
+    :param headers: Request headers, any mapping with get().
+    """
+    api_key = headers.get("X-API-Key")
+    if api_key:
+        return "key:" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+    user_id = headers.get("X-User-Id")
+    if user_id:
+        return "user:" + user_id.strip()[:128]
+    return client_address(headers, remote_addr)
+
+
+def rate_limit_buckets(headers, remote_addr):
+    """
+    Token buckets a request is charged against. An API key listed in API_KEYS has a
+    bucket of its own. Other headers are not verified, and a client sending a new value
+    with every request would get a fresh bucket each time, so such requests are charged
+    against their IP address as well: the header can narrow the limit, never widen it.
+    :return: List of bucket keys, the identity's last.
+    """
+    identity = client_identity(headers, remote_addr)
+    if identity.startswith("ip:") or headers.get("X-API-Key") in _api_keys():
+        return [identity]
+    return [client_address(headers, remote_addr), identity]
+
+
+class MemoryBucketStore:
+    def __init__(self, max_clients=None):
+        """
+        Token buckets of this worker process. With several workers each one enforces
+        the limit separately; use SQLiteBucketStore to share them.
+        :param max_clients: Buckets kept; the least recently used are dropped beyond it.
+        """
+        self.max_clients = max_clients or int(os.getenv("ADMISSION_MAX_CLIENTS", "100000"))
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def take(self, identity, rate, burst, cost=1.0):
+        """
+        Take cost tokens from the identity's bucket, which refills at rate tokens per
+        second up to burst.
+        :return: 0 when the tokens were taken, else seconds until they will be available.
+        """
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._buckets.pop(identity, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0.0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                wait = (cost - tokens) / rate
+            self._buckets[identity] = (tokens, now)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+            return wait
+
+
+class SQLiteBucketStore:
+    def __init__(self, db_path):
+        """
+        Token buckets in a SQLite file shared by the workers of one host. Put it on a
+        tmpfs such as /dev/shm to keep it in shared memory.
+        """
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=10, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS buckets (identity TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+
+    def take(self, identity, rate, burst, cost=1.0):
+        now = time.time()
+        with self._lock:
+            # IMMEDIATE takes the write lock up front, so workers cannot both spend the same tokens
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute("SELECT tokens, updated FROM buckets WHERE identity = ?",
+                                       (identity,)).fetchone()
+                tokens, updated = row if row is not None else (burst, now)
+                tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+                wait = 0.0
+                if tokens >= cost:
+                    tokens -= cost
+                else:
+                    wait = (cost - tokens) / rate
+                self._db.execute("INSERT OR REPLACE INTO buckets (identity, tokens, updated) VALUES (?, ?, ?)",
+                                 (identity, tokens, now))
+                # Full buckets carry no information; drop them now and then
+                self._db.execute("DELETE FROM buckets WHERE updated < ?", (now - burst / rate - 60,))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            return wait
+
+
+class _Waiter:
+    def __init__(self, identity, wake):
+        self.identity = identity
+        self.wake = wake
+        self.admitted = False
+
+
+class AdmissionController:
+    def __init__(self, store, rate=None, burst=None, max_in_flight=None, max_queued=None,
+                 max_queued_per_client=None, queue_timeout=None):
+        """
+        Decides whether a request may start work, in two steps:
+        1. A per-client token bucket (RATE_LIMIT_PER_MINUTE, default 30, with bursts of
+           RATE_LIMIT_BURST, default 10) rejects clients over their rate right away.
+        2. At most max_in_flight requests run LLM calls and renders at once
+           (ADMISSION_MAX_IN_FLIGHT, default 16). Others wait in per-client queues that
+           are served round-robin, so a client with many requests cannot starve the
+           rest; a full queue (ADMISSION_MAX_QUEUED, default 64, or
+           ADMISSION_MAX_QUEUED_PER_CLIENT, default 4, for one client) or a wait longer
+           than ADMISSION_QUEUE_TIMEOUT (default 10 s) rejects the request.
+        The in-flight cap and queues belong to this worker; the buckets live in store.
+        """
+        self.store = store
+        self.rate = (rate or float(os.getenv("RATE_LIMIT_PER_MINUTE", "30"))) / 60
+        self.burst = burst or float(os.getenv("RATE_LIMIT_BURST", "10"))
+        self.max_in_flight = max_in_flight or int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "16"))
+        self.max_queued = max_queued if max_queued is not None else int(os.getenv("ADMISSION_MAX_QUEUED", "64"))
+        self.max_queued_per_client = max_queued_per_client or int(os.getenv("ADMISSION_MAX_QUEUED_PER_CLIENT", "4"))
+        self.queue_timeout = queue_timeout or float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10"))
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        # identity -> deque of waiters, in round-robin order
+        self._queues = OrderedDict()
+        self._queued = 0
+
+    def check_rate(self, buckets, cost=1.0):
+        """
+        Take cost tokens from each of the buckets (see rate_limit_buckets).
+        :raises AdmissionError: The client is over its rate limit in any of them.
+        """
+        wait = max([self.store.take(bucket, self.rate, self.burst, cost) for bucket in buckets])
+        if wait > 0:
+            ADMISSION_DECISIONS.inc(outcome="rate_limited")
+            raise AdmissionError("Too many requests, please slow down.", retry_after=wait)
+
+    def wait_rate(self, buckets, cost=1.0, timeout=None):
+        """
+        Like check_rate, but wait up to timeout seconds for the buckets to refill instead
+        of failing right away; for work paced at the client's rate, such as the prompts
+        of a batch.
+        :raises AdmissionError: A bucket would not refill in time.
+        """
+        deadline = time.monotonic() + (timeout if timeout is not None else self.queue_timeout)
+        for bucket in buckets:
+            # Each bucket is charged once, when it has the tokens
+            wait = self.store.take(bucket, self.rate, self.burst, cost)
+            while wait > 0:
+                if time.monotonic() + wait > deadline:
+                    ADMISSION_DECISIONS.inc(outcome="rate_limited")
+                    raise AdmissionError("Too many requests, please slow down.", retry_after=wait)
+                time.sleep(wait)
+                wait = self.store.take(bucket, self.rate, self.burst, cost)
+
+    async def await_rate(self, buckets, cost=1.0, timeout=None):
+        """
+        Asyncio variant of wait_rate; the store is used off the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + (timeout if timeout is not None else self.queue_timeout)
+        for bucket in buckets:
+            take = partial(self.store.take, bucket, self.rate, self.burst, cost)
+            wait = await loop.run_in_executor(None, take)
+            while wait > 0:
+                if time.monotonic() + wait > deadline:
+                    ADMISSION_DECISIONS.inc(outcome="rate_limited")
+                    raise AdmissionError("Too many requests, please slow down.", retry_after=wait)
+                await asyncio.sleep(wait)
+                wait = await loop.run_in_executor(None, take)
+
+    def _enter(self, identity, wake):
+        """
+        Take an in-flight slot or join the client's queue.
+        :return: None when admitted, else the queued _Waiter.
+        :raises AdmissionError: The queue is full.
+        """
+        with self._lock:
+            if self.in_flight < self.max_in_flight and not self._queued:
+                self.in_flight += 1
+                ADMISSION_DECISIONS.inc(outcome="admitted")
+                return None
+            queue = self._queues.get(identity)
+            if self._queued >= self.max_queued or (queue and len(queue) >= self.max_queued_per_client):
+                ADMISSION_DECISIONS.inc(outcome="rejected")
+                raise AdmissionError("The server is busy, please retry shortly.", retry_after=self._retry_after())
+            waiter = _Waiter(identity, wake)
+            if queue is None:
+                queue = self._queues[identity] = deque()
+            queue.append(waiter)
+            self._queued += 1
+            ADMISSION_DECISIONS.inc(outcome="queued")
+            return waiter
+
+    def _retry_after(self):
+        # Roughly the time for the queue ahead to drain, assuming requests of a few seconds
+        return min(self.queue_timeout, 1 + self._queued / self.max_in_flight * 5)
+
+    def _leave(self):
+        """
+        Free a slot and hand it to the first waiter of the next client in turn.
+        """
+        with self._lock:
+            if not self._queues:
+                self.in_flight -= 1
+                return
+            identity, queue = next(iter(self._queues.items()))
+            waiter = queue.popleft()
+            del self._queues[identity]
+            if queue:
+                # Back of the rotation, behind the other clients
+                self._queues[identity] = queue
+            self._queued -= 1
+            waiter.admitted = True
+        waiter.wake()
+
+    def _abandon(self, waiter):
+        """
+        Remove a waiter that timed out or was cancelled.
+        :return: False when it was admitted meanwhile and now holds a slot.
+        """
+        with self._lock:
+            if waiter.admitted:
+                return False
+            queue = self._queues.get(waiter.identity)
+            queue.remove(waiter)
+            if not queue:
+                del self._queues[waiter.identity]
+            self._queued -= 1
+            return True
+
+    def _timeout(self):
+        remaining = remaining_time()
+        return self.queue_timeout if remaining is None else min(self.queue_timeout, remaining)
+
+    @contextmanager
+    def slot(self, identity):
+        """
+        Hold an in-flight slot for the identity while the block runs.
+        :raises AdmissionError: The queue is full or no slot became free in time.
+        """
+        event = threading.Event()
+        waiter = self._enter(identity, event.set)
+        if waiter is not None and not event.wait(self._timeout()) and self._abandon(waiter):
+            ADMISSION_DECISIONS.inc(outcome="timed_out")
+            raise AdmissionError("The server is busy, please retry shortly.", retry_after=self._retry_after())
+        try:
+            yield
+        finally:
+            self._leave()
+
+    @asynccontextmanager
+    async def aslot(self, identity):
+        """
+        Asyncio variant of slot; sync and async requests share the same slots and queues.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        waiter = self._enter(identity, wake)
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(future), timeout=self._timeout())
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if self._abandon(waiter):
+                    if isinstance(e, asyncio.CancelledError):
+                        raise
+                    ADMISSION_DECISIONS.inc(outcome="timed_out")
+                    raise AdmissionError("The server is busy, please retry shortly.",
+                                         retry_after=self._retry_after())
+                if isinstance(e, asyncio.CancelledError):
+                    self._leave()
+                    raise
+        try:
+            yield
+        finally:
+            self._leave()
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": self.in_flight, "queued": self._queued, "queued_clients": len(self._queues),
+                    "max_in_flight": self.max_in_flight}
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def admission_enabled():
+    return os.getenv("ADMISSION_CONTROL", "on").lower() not in ("0", "off", "false", "no")
+
+
+def get_admission_controller():
+    """
+    The worker's AdmissionController, with token buckets in SQLite when ADMISSION_DB
+    is set (e.g. /dev/shm/text2block-admission.db), else in memory.
+    """
+    global _controller
+    with _controller_lock:
+        if _controller is None:
+            db_path = os.getenv("ADMISSION_DB")
+            _controller = AdmissionController(SQLiteBucketStore(db_path) if db_path else MemoryBucketStore())
+        return _controller
+
+
+def admission_stats():
+    """
+    Stats of the worker's AdmissionController, or None before the first request.
+    """
+    with _controller_lock:
+        controller = _controller
+    return controller.stats() if controller is not None else None
+
+
+def admission_slot(identity):
+    """
+    Context manager holding an in-flight slot for identity; a no-op for None (work
+    that is not tied to a client, such as background jobs) or with ADMISSION_CONTROL off.
+    """
+    if identity is None or not admission_enabled():
+        return nullcontext()
+    return get_admission_controller().slot(identity)
+
+
+@asynccontextmanager
+async def _no_slot():
+    # contextlib.nullcontext only supports async with from Python 3.10
+    yield
+
+
+def aadmission_slot(identity):
+    """
+    Asyncio variant of admission_slot.
+    """
+    if identity is None or not admission_enabled():
+        return _no_slot()
+    return get_admission_controller().aslot(identity)
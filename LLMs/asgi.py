@@ -0,0 +1,413 @@
+from quart import Quart, Response, g, request, jsonify
+from quart_cors import cors
+from async_handler import AsyncGrokHandler
+from pipeline import (cached_stream_events, run_pipeline, run_pipeline_async, run_refinement_async, sse_event,
+                      stream_event_to_sse, stream_pipeline_async)
+from result_cache import CachedResult, get_result_cache, handler_cache_key, refine_cache_key
+from renderer import RenderBusyError, RenderLimitError
+from render_profiles import profile_from_request
+from resilience import CircuitOpenError, DeadlineExceededError, request_deadline
+from singleflight import get_async_single_flight, get_single_flight
+from jobs import JobQueueFullError, get_job_runner, job_body, validate_callback_url
+from batch import (BATCH_OUTPUTS, BatchArchive, BatchPacer, arun_batch, batch_concurrency, batch_items,
+                   batch_output, batch_summary, ndjson_line, zip_response_headers)
+from admission import (AdmissionError, aadmission_slot, admission_enabled, client_identity,
+                       get_admission_controller, rate_limit_buckets)
+from negotiation import NotAcceptableError, artifact_cache_control, artifact_response, negotiate, result_response
+from metrics import (CONTENT_TYPE, HTTP_DURATION, HTTP_REQUESTS, end_request_span, render_metrics,
+                     start_request_span)
+import asyncio
+import io
+import time
+
+# Async counterpart of main.py. Serve with an ASGI server, e.g.
+#   uvicorn asgi:app --host 0.0.0.0 --port 5000 --workers 2
+# Each worker process handles many in-flight requests while they wait on the LLMs or dot.
+# The frontend reads Retry-After on 429 and 503
+app = cors(Quart(__name__), expose_headers=['Retry-After'])
+
+# One handler per worker; its LLM clients come from the shared connection pool
+_query_handler = None
+
+
+def get_query_handler():
+    global _query_handler
+    if _query_handler is None:
+        _query_handler = AsyncGrokHandler()
+    return _query_handler
+
+def _endpoint_label():
+    # The route pattern, not the path, so render ids do not become label values
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+@app.before_request
+async def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.request_span = start_request_span(f"{request.method} {_endpoint_label()}")
+
+@app.after_request
+async def record_request_metrics(response):
+    endpoint = _endpoint_label()
+    HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    HTTP_DURATION.observe(time.perf_counter() - g.request_started, endpoint=endpoint, method=request.method)
+    g.response_status = response.status_code
+    return response
+
+# Endpoints that start pipeline work, and so count against the client's rate limit
+ADMITTED_ENDPOINTS = {'analyze', 'analyze_stream', 'refine', 'create_job', 'create_batch'}
+
+@app.before_request
+async def admit_request():
+    # Turn clients over their rate away before reading the body or touching an LLM
+    if request.method != 'POST' or request.endpoint not in ADMITTED_ENDPOINTS or not admission_enabled():
+        return None
+    g.client_identity = client_identity(request.headers, request.remote_addr)
+    g.rate_limit_buckets = rate_limit_buckets(request.headers, request.remote_addr)
+    try:
+        # The buckets may live in SQLite (ADMISSION_DB), so off the event loop
+        await asyncio.get_running_loop().run_in_executor(
+            None, get_admission_controller().check_rate, g.rate_limit_buckets
+        )
+    except AdmissionError as e:
+        return jsonify({'error': str(e)}), 429, {'Retry-After': str(e.retry_after)}
+    return None
+
+@app.teardown_request
+async def end_request_metrics(error=None):
+    end_request_span(g.pop('request_span', None), g.pop('response_status', None))
+
+@app.route('/api/analyze', methods=['POST'])
+async def analyze():
+    try:
+        # Get the prompt from the request
+        data = await request.get_json()
+        user_prompt = data.get('prompt') if data else None
+
+        if not user_prompt:
+            return jsonify({'error': 'No prompt provided'}), 400
+
+        # Response type from the Accept header (JSON, raw image or multipart); output
+        # format and size from 'profile' ("preview" or "full"), 'format', 'max_pixels', 'quality'
+        try:
+            media_type, accepted_format = negotiate(request.accept_mimetypes, data.get('format'))
+            profile = profile_from_request(data, image_format=accepted_format)
+        except NotAcceptableError as e:
+            return jsonify({'error': str(e)}), 406
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+
+        query_handler = get_query_handler()
+
+        # Serve repeated prompts from the result cache
+        result_cache = get_result_cache()
+        cache_key = handler_cache_key(query_handler, user_prompt, profile)
+        cached = await result_cache.aget(cache_key)
+        if cached is None:
+            identity = g.get('client_identity')
+
+            async def compute():
+                async with aadmission_slot(identity):
+                    result = await run_pipeline_async(query_handler, user_prompt, profile)
+                computed = CachedResult(result.dot_code, result.image, result.explanation, result.image_format,
+                                        result.user_prompt)
+                await result_cache.aput(cache_key, computed)
+                return computed
+
+            # Identical prompts arriving while this runs share its result instead of starting their own
+            with request_deadline():
+                cached, _ = await get_async_single_flight().do(cache_key, compute)
+
+        return result_response(cache_key, cached, media_type)
+
+    except AdmissionError as e:
+        return jsonify({'error': str(e)}), 429, {'Retry-After': str(e.retry_after)}
+
+    except RenderBusyError as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': str(e.retry_after)}
+
+    except RenderLimitError as e:
+        return jsonify({'error': str(e)}), 422
+
+    except CircuitOpenError as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': str(e.retry_after)}
+
+    except DeadlineExceededError as e:
+        return jsonify({'error': str(e)}), 504
+
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/analyze/stream', methods=['POST'])
+async def analyze_stream():
+    """
+    Streaming variant of /api/analyze using Server-Sent Events; see main.analyze_stream.
+    """
+    data = await request.get_json()
+    user_prompt = data.get('prompt') if data else None
+
+    if not user_prompt:
+        return jsonify({'error': 'No prompt provided'}), 400
+
+    try:
+        profile = profile_from_request(data)
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    # The body is produced after the request context is gone
+    identity = g.get('client_identity')
+
+    async def generate():
+        yield sse_event('status', {'stage': 'generating'})
+        try:
+            query_handler = get_query_handler()
+            result_cache = get_result_cache()
+            cache_key = handler_cache_key(query_handler, user_prompt, profile)
+            cached = await result_cache.aget(cache_key)
+            if cached is not None:
+                for event, payload in cached_stream_events(cached):
+                    yield stream_event_to_sse(event, payload, cached=True)
+                return
+
+            with request_deadline():
+                async with aadmission_slot(identity):
+                    async for event, payload in stream_pipeline_async(query_handler, user_prompt, profile):
+                        if event == 'done':
+                            await result_cache.aput(cache_key, CachedResult(
+                                payload.dot_code, payload.image, payload.explanation, payload.image_format,
+                                payload.user_prompt
+                            ))
+                        yield stream_event_to_sse(event, payload)
+
+        except AdmissionError as e:
+            yield sse_event('error', {'error': str(e), 'retry_after': e.retry_after})
+        except Exception as e:
+            print(f"Error: {str(e)}")
+            yield sse_event('error', {'error': str(e)})
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.timeout = None
+    return response
+
+@app.route('/api/refine', methods=['POST'])
+async def refine():
+    """
+    Change an earlier diagram instead of generating a new one; see main.refine.
+    """
+    try:
+        data = await request.get_json()
+        parent_id = data.get('id') if data else None
+        instruction = data.get('instruction') if data else None
+
+        if not parent_id or not instruction:
+            return jsonify({'error': "Both 'id' and 'instruction' are required"}), 400
+
+        try:
+            media_type, accepted_format = negotiate(request.accept_mimetypes, data.get('format'))
+            profile = profile_from_request(data, image_format=accepted_format)
+        except NotAcceptableError as e:
+            return jsonify({'error': str(e)}), 406
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+
+        result_cache = get_result_cache()
+        parent = await result_cache.aget(parent_id)
+        if parent is None:
+            return jsonify({'error': 'Unknown or expired render id'}), 404
+
+        query_handler = get_query_handler()
+        cache_key = refine_cache_key(query_handler, parent_id, instruction, profile)
+        cached = await result_cache.aget(cache_key)
+        if cached is None:
+            identity = g.get('client_identity')
+
+            async def compute():
+                async with aadmission_slot(identity):
+                    result = await run_refinement_async(query_handler, parent, instruction, profile)
+                computed = CachedResult(result.dot_code, result.image, result.explanation, result.image_format,
+                                        result.user_prompt)
+                await result_cache.aput(cache_key, computed)
+                return computed
+
+            with request_deadline():
+                cached, _ = await get_async_single_flight().do(cache_key, compute)
+
+        return result_response(cache_key, cached, media_type)
+
+    except AdmissionError as e:
+        return jsonify({'error': str(e)}), 429, {'Retry-After': str(e.retry_after)}
+
+    except RenderBusyError as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': str(e.retry_after)}
+
+    except RenderLimitError as e:
+        return jsonify({'error': str(e)}), 422
+
+    except CircuitOpenError as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': str(e.retry_after)}
+
+    except DeadlineExceededError as e:
+        return jsonify({'error': str(e)}), 504
+
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/jobs', methods=['POST'])
+async def create_job():
+    """
+    Background variant of /api/analyze; see main.create_job. Jobs run the sync
+    pipeline on the job threads, off the event loop.
+    """
+    data = await request.get_json()
+    user_prompt = data.get('prompt') if data else None
+
+    if not user_prompt:
+        return jsonify({'error': 'No prompt provided'}), 400
+
+    callback_url = data.get('callback_url')
+    try:
+        profile = profile_from_request(data)
+        if callback_url:
+            # Resolves the host, so keep it off the event loop
+            await asyncio.get_running_loop().run_in_executor(None, validate_callback_url, callback_url)
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    query_handler = get_query_handler()
+    runner = get_job_runner()
+    cache_key = handler_cache_key(query_handler, user_prompt, profile)
+    loop = asyncio.get_running_loop()
+    try:
+        # The job store may be SQLite (JOB_DB), so jobs are recorded off the event loop
+        if await get_result_cache().aget(cache_key) is not None:
+            job = await loop.run_in_executor(None, runner.completed, cache_key, callback_url)
+        else:
+            def run():
+                def compute():
+                    result = run_pipeline(query_handler, user_prompt, profile)
+                    computed = CachedResult(result.dot_code, result.image, result.explanation, result.image_format,
+                                            result.user_prompt)
+                    get_result_cache().put(cache_key, computed)
+                    return computed
+
+                get_single_flight().do(cache_key, compute)
+                return cache_key
+
+            job = await loop.run_in_executor(None, runner.submit, run, callback_url)
+    except JobQueueFullError as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': str(e.retry_after)}
+
+    return jsonify(await loop.run_in_executor(None, job_body, job)), 202, {'Location': f'/api/jobs/{job.id}'}
+
+@app.route('/api/batch', methods=['POST'])
+async def create_batch():
+    """
+    Generate a diagram for each of a list of prompts; see main.create_batch. Prompts run
+    as tasks of the event loop, BATCH_CONCURRENCY at a time.
+    """
+    data = await request.get_json()
+    prompts = data.get('prompts') if data else None
+
+    if not prompts:
+        return jsonify({'error': 'No prompts provided'}), 400
+
+    query_handler = get_query_handler()
+    buckets = g.get('rate_limit_buckets')
+    pacer = BatchPacer(get_admission_controller() if buckets else None, buckets)
+    try:
+        output = batch_output(request.accept_mimetypes, data.get('output'))
+        profile = profile_from_request(data)
+        concurrency = batch_concurrency(data.get('concurrency'))
+        items = batch_items(prompts, lambda prompt: handler_cache_key(query_handler, prompt, profile),
+                            pacer.max_prompts())
+    except NotAcceptableError as e:
+        return jsonify({'error': str(e)}), 406
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    identity = g.get('client_identity')
+    result_cache = get_result_cache()
+
+    async def compute(item):
+        await pacer.apace(item)
+        cached = await result_cache.aget(item.cache_key)
+        if cached is not None:
+            return cached
+
+        async def run():
+            async with aadmission_slot(identity):
+                result = await run_pipeline_async(query_handler, item.prompt, profile)
+            computed = CachedResult(result.dot_code, result.image, result.explanation, result.image_format,
+                                    result.user_prompt)
+            await result_cache.aput(item.cache_key, computed)
+            return computed
+
+        # Every prompt gets the time budget of a request of its own
+        with request_deadline():
+            cached, _ = await get_async_single_flight().do(item.cache_key, run)
+        return cached
+
+    outcomes = arun_batch(items, compute, concurrency)
+    if output == 'zip':
+        archive_file = io.BytesIO()
+        archive = BatchArchive(archive_file, len(prompts))
+        async for outcome in outcomes:
+            archive.add(outcome)
+        archive.close()
+        return archive_file.getvalue(), 200, zip_response_headers()
+
+    async def generate():
+        finished = []
+        async for outcome in outcomes:
+            finished.append(outcome)
+            yield ndjson_line(outcome.to_dict())
+        yield ndjson_line(batch_summary(len(prompts), finished))
+
+    response = Response(generate(), mimetype=BATCH_OUTPUTS['ndjson'])
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.timeout = None
+    return response
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+async def get_job(job_id):
+    """
+    Status of a background job; see main.get_job.
+    """
+    loop = asyncio.get_running_loop()
+    job = await loop.run_in_executor(None, get_job_runner().store.get, job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job id'}), 404
+    return jsonify(await loop.run_in_executor(None, job_body, job))
+
+@app.route('/api/render/<render_id>', methods=['GET'])
+async def get_render(render_id):
+    """
+    Serve a cached artifact with ETag and Cache-Control; see main.get_render.
+    """
+    result_cache = get_result_cache()
+    result = await result_cache.aget(render_id)
+    if result is None:
+        return jsonify({'error': 'Unknown or expired render id'}), 404
+
+    try:
+        media_type, _ = negotiate(request.accept_mimetypes, result.image_format, [result.image_format])
+    except NotAcceptableError as e:
+        return jsonify({'error': str(e)}), 406
+
+    return artifact_response(render_id, result, media_type, request.if_none_match,
+                             artifact_cache_control(result_cache))
+
+@app.route('/metrics', methods=['GET'])
+async def prometheus_metrics():
+    """
+    Prometheus scrape endpoint; see main.metrics.
+    """
+    return render_metrics(), 200, {'Content-Type': CONTENT_TYPE}
+
+@app.route('/api/cache/stats', methods=['GET'])
+async def cache_stats():
+    return jsonify(get_result_cache().stats())
@@ -0,0 +1,141 @@
+from functools import partial
+from dot_lint import DotStreamExtractor, dot_code_parses, extract_dot_code
+from dot_edit import apply_refinement
+from hedging import ahedged_call
+from resilience import DeadlineExceededError, ResilienceError, acall_with_fallback, guarded_stream
+from metrics import PAYLOAD_BYTES, record_payload, stage_timer
+from layout_select import get_layout_selector
+from render_profiles import get_profile, render_with_profile_async
+from router_groq_llms import GrokHandler
+
+
+async def arun_steps(steps, calls):
+    """
+    Asyncio variant of router_groq_llms.run_steps: calls are coroutine functions.
+    """
+    try:
+        request = next(steps)
+        while True:
+            try:
+                result = await calls[request[0]](*request[1:])
+            except Exception as e:
+                request = steps.throw(e)
+            else:
+                request = steps.send(result)
+    except StopIteration as stop:
+        return stop.value
+
+
+class AsyncGrokHandler(GrokHandler):
+    """
+    GrokHandler with asyncio variants of every LLM and render call, used by the ASGI app.
+    Prompts and stage backends are shared with the sync handler.
+    """
+
+    async def _adot_code(self, backend, prompt, stage):
+        if self.stream_dot_code:
+            response = (await backend.acomplete_streamed(prompt, stage, DotStreamExtractor)).dot_code
+        else:
+            response = await backend.acomplete(prompt, stage)
+        # Extract the DOT code and repair mechanical errors locally
+        dot_code = extract_dot_code(response)
+        record_payload("dot_code", dot_code)
+        return dot_code
+
+    async def _atext(self, backend, prompt, stage):
+        explanation = (await backend.acomplete(prompt, stage)).strip()
+        record_payload("explanation", explanation)
+        return explanation
+
+    async def agenerate_dot_code(self, user_prompt):
+        """
+        Generate DOT code with the generate backends, hedged or with fallback like
+        GrokHandler.generate_dot_code. Losing backends are cancelled.
+        """
+        prompt = self.dot_code_prompt(user_prompt)
+        calls = [(backend.name, partial(self._adot_code, backend, prompt, "generate_dot_code"))
+                 for backend in self.dot_code_backends()]
+        if self.hedge_backends:
+            return await ahedged_call(calls, dot_code_parses)
+        return await acall_with_fallback(calls)
+
+    async def afix_dot_code(self, dot_code, error_message):
+        """
+        Fix the DOT code based on the error message with the fix backends.
+        """
+        prompt = self.fix_dot_code_prompt(dot_code, error_message)
+        return await acall_with_fallback([
+            (backend.name, partial(self._aedited_dot_code, backend, prompt, dot_code, "fix_dot_code"))
+            for backend in self.stages["fix"]
+        ])
+
+    async def _aedited_dot_code(self, backend, prompt, dot_code, stage):
+        edited = apply_refinement(dot_code, await backend.acomplete(prompt, stage))
+        record_payload("dot_code", edited)
+        return edited
+
+    async def arefine_dot_code(self, dot_code, instruction):
+        """
+        Apply a structural change to DOT code with the refine backends.
+        """
+        prompt = self.refine_prompt(dot_code, instruction)
+        return await acall_with_fallback([
+            (backend.name, partial(self._aedited_dot_code, backend, prompt, dot_code, "refine_dot_code"))
+            for backend in self.stages["refine"]
+        ])
+
+    async def agenerate_text_response(self, dot_code, user_prompt):
+        """
+        Generate a textual explanation with the explain backends.
+        """
+        prompt = self.text_response_prompt(dot_code, user_prompt)
+        return await acall_with_fallback([(backend.name, partial(self._atext, backend, prompt, "generate_text_response"))
+                                          for backend in self.stages["explain"]])
+
+    async def astream_text_response(self, dot_code, user_prompt):
+        """
+        Stream the textual explanation from the explain backends, with the same fallback
+        before the first token as GrokHandler.stream_text_response.
+        :return: Async generator of text chunks as they arrive.
+        """
+        prompt = self.text_response_prompt(dot_code, user_prompt)
+        backends = self.stages["explain"]
+        for index, backend in enumerate(backends):
+            size = 0
+            try:
+                with stage_timer("stream_text_response", model=backend.model), \
+                        guarded_stream(backend.provider) as timeout:
+                    async for token in backend.astream(prompt, timeout):
+                        size += len(token.encode("utf-8"))
+                        yield token
+                backend.client_pool.record_success(backend.provider)
+                PAYLOAD_BYTES.observe(size, kind="explanation")
+                return
+
+            except DeadlineExceededError:
+                raise
+            except Exception as e:
+                error = backend.api_error(e)
+                if size == 0 and index < len(backends) - 1:
+                    print(f"'{backend.name}' failed ({e}); falling back to '{backends[index + 1].name}'.")
+                    continue
+                if isinstance(e, ResilienceError):
+                    raise
+                raise error from e
+
+    async def avalidate_and_render_dot_image(self, dot_code, profile=None, on_fix=None, on_attempt=None):
+        """
+        Validate and render the DOT code without blocking the event loop.
+        Use LLM to fix errors if encountered.
+        :param profile: RenderProfile controlling format, size and layout mode; defaults to get_profile().
+        :param on_fix: Optional callback invoked with the new DOT code after each fix.
+        :param on_attempt: Optional callback invoked with the attempt number before each render.
+        :return: Rendered image bytes.
+        """
+        profile = profile or get_profile()
+        calls = {
+            "select": lambda dot_code: get_layout_selector().aselect(dot_code),
+            "render": lambda dot_code, engine: render_with_profile_async(dot_code, profile, engine=engine),
+            "fix": self.afix_dot_code,
+        }
+        return await arun_steps(self._render_steps(dot_code, profile, on_fix, on_attempt), calls)
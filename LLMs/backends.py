@@ -0,0 +1,340 @@
+import os
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from urllib.parse import parse_qsl
+from dotenv import load_dotenv
+from client_pool import get_client_pool
+from metrics import LLM_TOKENS, STREAM_EARLY_STOPS, record_token_usage, stage_timer
+from prompt_templates import estimate_tokens
+from resilience import (DeadlineExceededError, ResilienceError, SlotPool, aresilient_call, remaining_time,
+                        resilient_call, timeout_kwargs)
+
+load_dotenv()
+
+PROVIDERS = ("openrouter", "groq", "openai")
+DEFAULT_MODELS = {
+    "openrouter": os.getenv("OPENROUTER_MODEL", "anthropic/claude-3.5-haiku-20241022:beta"),
+    "groq": os.getenv("GROQ_MODEL", "llama-3.3-70b-versatile"),
+    "openai": os.getenv("OPENAI_MODEL", "gpt-4o-mini"),
+}
+STAGES = ("generate", "fix", "explain", "refine")
+
+# Sent to OpenRouter with every request
+OPENROUTER_PROVIDER_CONFIG = {
+    "provider": {
+        "order": ["Anthropic", "Google Vertex"]
+    },
+    "allow_fallbacks": False
+}
+
+
+class Backend:
+    def __init__(self, provider, model=None, timeout=None, max_concurrency=None):
+        """
+        One model of one provider, called through the shared client pool with the
+        provider's circuit breaker and retry policy.
+        :param timeout: Upper bound in seconds for one call, below the request deadline.
+        :param max_concurrency: Calls this worker makes to the model at the same time;
+            further calls wait for a slot within the request deadline. None for no limit.
+        """
+        if provider not in PROVIDERS:
+            raise ValueError(f"Unknown LLM provider '{provider}'. Use one of {', '.join(PROVIDERS)}.")
+        self.provider = provider
+        self.model = model or DEFAULT_MODELS[provider]
+        self.name = f"{provider}:{self.model}"
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.client_pool = get_client_pool()
+        # Shared by sync and async calls, which both happen in the ASGI app (jobs run sync)
+        self._slots = SlotPool(max_concurrency) if max_concurrency else None
+        self._lock = threading.Lock()
+        self.in_flight = 0
+
+    def __repr__(self):
+        return f"Backend({self.spec!r})"
+
+    @property
+    def spec(self):
+        options = [(name, value) for name, value in (("timeout", self.timeout), ("concurrency", self.max_concurrency))
+                   if value]
+        return self.name + ("?" + "&".join(f"{name}={value:g}" for name, value in options) if options else "")
+
+    def client(self):
+        # Looked up on every use so a recycled client is picked up. Retries happen in
+        # resilient_call, so the SDK's own are turned off.
+        if self.provider == "openrouter":
+            return self.client_pool.openrouter(sdk_retries=False)
+        if self.provider == "groq":
+            return self.client_pool.groq(sdk_retries=False)
+        return self.client_pool.openai()
+
+    def async_client(self):
+        if self.provider == "openrouter":
+            return self.client_pool.async_openrouter(sdk_retries=False)
+        if self.provider == "groq":
+            return self.client_pool.async_groq(sdk_retries=False)
+        raise ValueError("The openai provider has no async client; use it from the Flask app.")
+
+    def _request(self, prompt, timeout, stream=False):
+        request = {"model": self.model, "messages": prompt.messages()}
+        if self.provider == "openrouter":
+            request["extra_headers"] = {"X-Custom-Provider": str(OPENROUTER_PROVIDER_CONFIG)}
+        if stream:
+            request["stream"] = True
+            if self.provider != "groq":
+                # Groq reports a stream's usage in its last chunk without being asked
+                request["stream_options"] = {"include_usage": True}
+        timeout = timeout if timeout is not None else self.timeout
+        request.update(timeout_kwargs(timeout, self.timeout or self.client_pool.request_timeout))
+        return request
+
+    def _count(self, delta):
+        with self._lock:
+            self.in_flight += delta
+
+    @contextmanager
+    def slot(self):
+        """
+        Hold one of the backend's concurrency slots.
+        :raises DeadlineExceededError: No slot became free before the request deadline.
+        """
+        if self._slots is not None and not self._slots.acquire(timeout=remaining_time()):
+            raise DeadlineExceededError(f"Request deadline exceeded while waiting for '{self.name}'.")
+        self._count(1)
+        try:
+            yield
+        finally:
+            self._count(-1)
+            if self._slots is not None:
+                self._slots.release()
+
+    @asynccontextmanager
+    async def aslot(self):
+        if self._slots is not None and not await self._slots.aacquire(timeout=remaining_time()):
+            raise DeadlineExceededError(f"Request deadline exceeded while waiting for '{self.name}'.")
+        self._count(1)
+        try:
+            yield
+        finally:
+            self._count(-1)
+            if self._slots is not None:
+                self._slots.release()
+
+    def api_error(self, e):
+        """
+        Count a failed call against the provider's connections.
+        :return: The exception to raise for it.
+        """
+        if isinstance(e, ResilienceError):
+            return e
+        self.client_pool.record_error(self.provider, e)
+        return Exception(f"Error in {self.name} API call: {e}")
+
+    def complete(self, prompt, stage):
+        """
+        One chat completion.
+        :param prompt: prompt_templates.Prompt.
+        :param stage: Pipeline stage, for metrics and traces.
+        :return: The response text.
+        """
+        def create(timeout):
+            return self.client().chat.completions.create(**self._request(prompt, timeout))
+
+        try:
+            with self.slot(), stage_timer(stage, model=self.model):
+                response = resilient_call(self.provider, create)
+        except Exception as e:
+            raise self.api_error(e) from e
+        self.client_pool.record_success(self.provider)
+        record_token_usage(self.provider, self.model, response)
+        return response.choices[0].message.content
+
+    async def acomplete(self, prompt, stage):
+        """
+        Asyncio variant of complete.
+        """
+        async def create(timeout):
+            return await self.async_client().chat.completions.create(**self._request(prompt, timeout))
+
+        try:
+            async with self.aslot():
+                with stage_timer(stage, model=self.model):
+                    response = await aresilient_call(self.provider, create)
+        except Exception as e:
+            raise self.api_error(e) from e
+        self.client_pool.record_success(self.provider)
+        record_token_usage(self.provider, self.model, response)
+        return response.choices[0].message.content
+
+    def _stopped_early(self, prompt, text):
+        # The usage chunk never arrives on a closed stream, so count what was sent and received
+        STREAM_EARLY_STOPS.inc(backend=self.provider, model=self.model)
+        LLM_TOKENS.inc(estimate_tokens(str(prompt)), backend=self.provider, model=self.model, kind="prompt")
+        LLM_TOKENS.inc(estimate_tokens(text), backend=self.provider, model=self.model, kind="completion")
+
+    def complete_streamed(self, prompt, stage, new_extractor):
+        """
+        One streamed chat completion, closed as soon as the extractor has what it needs,
+        which stops the generation and its billing. Retries start a new extractor.
+        :param new_extractor: Factory of objects with feed(chunk) returning True to stop,
+            e.g. dot_lint.DotStreamExtractor.
+        :return: The extractor after the last chunk it was fed.
+        """
+        def create(timeout):
+            extractor = new_extractor()
+            stream = self.client().chat.completions.create(**self._request(prompt, timeout, stream=True))
+            try:
+                for chunk in stream:
+                    record_token_usage(self.provider, self.model, chunk)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if extractor.feed(chunk.choices[0].delta.content):
+                            self._stopped_early(prompt, extractor.text)
+                            break
+            finally:
+                stream.close()
+            return extractor
+
+        try:
+            with self.slot(), stage_timer(stage, model=self.model):
+                extractor = resilient_call(self.provider, create)
+        except Exception as e:
+            raise self.api_error(e) from e
+        self.client_pool.record_success(self.provider)
+        return extractor
+
+    async def acomplete_streamed(self, prompt, stage, new_extractor):
+        """
+        Asyncio variant of complete_streamed.
+        """
+        async def create(timeout):
+            extractor = new_extractor()
+            stream = await self.async_client().chat.completions.create(**self._request(prompt, timeout, stream=True))
+            try:
+                async for chunk in stream:
+                    record_token_usage(self.provider, self.model, chunk)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if extractor.feed(chunk.choices[0].delta.content):
+                            self._stopped_early(prompt, extractor.text)
+                            break
+            finally:
+                await stream.close()
+            return extractor
+
+        try:
+            async with self.aslot():
+                with stage_timer(stage, model=self.model):
+                    extractor = await aresilient_call(self.provider, create)
+        except Exception as e:
+            raise self.api_error(e) from e
+        self.client_pool.record_success(self.provider)
+        return extractor
+
+    def stream(self, prompt, timeout):
+        """
+        Stream a chat completion; the caller guards it with resilience.guarded_stream.
+        Closing the generator early (a reset or a disconnected client) closes the
+        response, so its pooled connection is not held until garbage collection.
+        :return: Generator of text chunks.
+        """
+        with self.slot():
+            stream = self.client().chat.completions.create(**self._request(prompt, timeout, stream=True))
+            try:
+                for chunk in stream:
+                    record_token_usage(self.provider, self.model, chunk)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+            finally:
+                stream.close()
+
+    async def astream(self, prompt, timeout):
+        async with self.aslot():
+            stream = await self.async_client().chat.completions.create(**self._request(prompt, timeout, stream=True))
+            try:
+                async for chunk in stream:
+                    record_token_usage(self.provider, self.model, chunk)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+            finally:
+                await stream.close()
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def parse_backend_spec(spec):
+    """
+    Parse "provider[:model][?timeout=<seconds>&concurrency=<n>]", e.g. "groq",
+    "openrouter:google/gemini-flash-1.5" or "groq:llama-3.1-8b-instant?timeout=15&concurrency=8".
+    :return: (provider, model or None, timeout or None, max_concurrency or None)
+    """
+    spec, _, query = spec.strip().partition("?")
+    provider, _, model = spec.partition(":")
+    options = dict(parse_qsl(query))
+    unknown = set(options) - {"timeout", "concurrency"}
+    if unknown:
+        raise ValueError(f"Unknown backend option(s) {', '.join(sorted(unknown))} in '{spec}'.")
+    timeout = float(options["timeout"]) if "timeout" in options else None
+    concurrency = int(options["concurrency"]) if "concurrency" in options else None
+    return provider.strip(), model.strip() or None, timeout, concurrency
+
+
+def get_backend(spec):
+    """
+    The worker's Backend for a spec. Backends are shared by every handler, so a
+    concurrency limit holds across stages and handlers using the same spec.
+    """
+    provider, model, timeout, concurrency = parse_backend_spec(spec)
+    backend = Backend(provider, model, timeout, concurrency)
+    with _backends_lock:
+        return _backends.setdefault(backend.spec, backend)
+
+
+def parse_backends(spec):
+    """
+    Parse a comma-separated fallback chain of backend specs.
+    :return: List of Backend, primary first.
+    """
+    backends = [get_backend(item) for item in (spec or "").split(",") if item.strip()]
+    if not backends:
+        raise ValueError("A backend chain needs at least one backend.")
+    return backends
+
+
+def stage_backends(openrouter_model=None, groq_model=None, overrides=None):
+    """
+    Backend chain of every pipeline stage. Each stage defaults to the chain in
+    LLM_<STAGE>_BACKENDS (e.g. LLM_EXPLAIN_BACKENDS="groq:llama-3.1-8b-instant,openrouter"),
+    else to OpenRouter for DOT code and Groq for explanations, each falling back to the
+    other; refine follows fix. LLM_FALLBACK=off keeps only the first backend of each chain.
+    :param overrides: Dict of stage -> spec string or list of Backend, taking precedence.
+    :return: Dict of stage -> list of Backend.
+    """
+    openrouter = f"openrouter:{openrouter_model or DEFAULT_MODELS['openrouter']}"
+    groq = f"groq:{groq_model or DEFAULT_MODELS['groq']}"
+    defaults = {
+        "generate": f"{openrouter},{groq}",
+        "fix": f"{openrouter},{groq}",
+        "explain": f"{groq},{openrouter}",
+    }
+    overrides = overrides or {}
+    unknown = set(overrides) - set(STAGES)
+    if unknown:
+        raise ValueError(f"Unknown pipeline stage(s) {', '.join(sorted(unknown))}. Use {', '.join(STAGES)}.")
+
+    fallback = os.getenv("LLM_FALLBACK", "on").lower() not in ("0", "off", "false", "no")
+    stages = {}
+    for stage in STAGES:
+        # Refinements are edits like fixes, so they use the fix chain unless configured
+        chain = (overrides.get(stage) or os.getenv(f"LLM_{stage.upper()}_BACKENDS")
+                 or defaults.get(stage) or stages["fix"])
+        backends = parse_backends(chain) if isinstance(chain, str) else list(chain)
+        stages[stage] = backends if fallback else backends[:1]
+    return stages
+
+
+def backend_stats():
+    with _backends_lock:
+        backends = list(_backends.values())
+    return {backend.spec: {"in_flight": backend.in_flight, "max_concurrency": backend.max_concurrency}
+            for backend in backends}
@@ -0,0 +1,391 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from dotenv import load_dotenv
+from jobs import FAILED, SUCCEEDED, error_status
+from metrics import BATCH_ITEMS
+from negotiation import NotAcceptableError, result_metadata
+from pipeline import run_pipeline
+from render_profiles import profile_from_request
+from resilience import request_deadline, submit_in_context
+from result_cache import CachedResult, get_result_cache, handler_cache_key
+from singleflight import get_single_flight
+
+load_dotenv()
+
+NDJSON_TYPE = "application/x-ndjson"
+ZIP_TYPE = "application/zip"
+BATCH_OUTPUTS = {"ndjson": NDJSON_TYPE, "zip": ZIP_TYPE}
+
+
+class BatchItem:
+    def __init__(self, cache_key, prompt, indexes):
+        """
+        One distinct prompt of a batch.
+        :param indexes: Positions of the prompt, and of its duplicates, in the submitted list.
+        """
+        self.cache_key = cache_key
+        self.prompt = prompt
+        self.indexes = indexes
+
+
+class BatchOutcome:
+    def __init__(self, item, result=None, error=None):
+        """
+        Finished BatchItem: its CachedResult, or the exception it failed with.
+        """
+        self.item = item
+        self.result = result
+        self.error = error
+
+    @property
+    def status(self):
+        return FAILED if self.error is not None else SUCCEEDED
+
+    def to_dict(self):
+        """
+        NDJSON line and manifest entry: the prompt and its positions, then the result
+        metadata of /api/analyze, or the error with the status /api/analyze would have
+        answered with (and retry_after for 429 and 503).
+        """
+        body = {"index": self.item.indexes[0], "indexes": self.item.indexes, "prompt": self.item.prompt,
+                "status": self.status}
+        if self.error is None:
+            body["result"] = result_metadata(self.item.cache_key, self.result)
+        else:
+            body["error"] = str(self.error)
+            body["error_status"] = error_status(self.error)
+            if hasattr(self.error, "retry_after"):
+                body["retry_after"] = self.error.retry_after
+        return body
+
+
+def max_batch_size():
+    return int(os.getenv("BATCH_MAX_PROMPTS", "200"))
+
+
+def batch_concurrency(requested=None):
+    """
+    Prompts of one batch running at the same time: BATCH_CONCURRENCY (default 4), or
+    fewer when the request asks for it.
+    :raises ValueError: requested is not a positive integer.
+    """
+    limit = int(os.getenv("BATCH_CONCURRENCY", "4"))
+    if requested is None:
+        return limit
+    if isinstance(requested, bool) or not isinstance(requested, int) or requested < 1:
+        raise ValueError("concurrency must be a positive integer")
+    return min(requested, limit)
+
+
+def batch_items(prompts, cache_key, max_size=None):
+    """
+    Validate a batch and merge identical prompts, which would share one cache key anyway.
+    :param prompts: List of prompt strings.
+    :param cache_key: Callable mapping a prompt to its result cache key.
+    :param max_size: Most prompts allowed; BATCH_MAX_PROMPTS (default 200) when None.
+    :return: List of BatchItem, in order of first appearance.
+    :raises ValueError: prompts is not a non-empty list of non-empty strings, or longer
+        than max_size.
+    """
+    max_size = max_size or max_batch_size()
+    if not isinstance(prompts, list) or not prompts:
+        raise ValueError("'prompts' must be a non-empty list")
+    if len(prompts) > max_size:
+        raise ValueError(f"A batch holds at most {max_size} prompts")
+    items = {}
+    for index, prompt in enumerate(prompts):
+        if not isinstance(prompt, str) or not prompt.strip():
+            raise ValueError(f"Prompt {index} is empty or not a string")
+        key = cache_key(prompt)
+        if key in items:
+            items[key].indexes.append(index)
+            BATCH_ITEMS.inc(status="deduplicated")
+        else:
+            items[key] = BatchItem(key, prompt, [index])
+    return list(items.values())
+
+
+def batch_output(accept_mimetypes, requested=None):
+    """
+    Container of a batch response: 'output' from the body ("ndjson" or "zip"), else the
+    best match of the Accept header, defaulting to NDJSON.
+    :return: "ndjson" or "zip".
+    :raises ValueError: requested is not one of them.
+    :raises NotAcceptableError: Accept allows neither.
+    """
+    if requested is not None:
+        if requested not in BATCH_OUTPUTS:
+            raise ValueError(f"output must be one of {', '.join(BATCH_OUTPUTS)}")
+        return requested
+    if not accept_mimetypes:
+        return "ndjson"
+    match = accept_mimetypes.best_match([NDJSON_TYPE, ZIP_TYPE, "application/json"])
+    if match is None:
+        raise NotAcceptableError(f"Batches are returned as {NDJSON_TYPE} or {ZIP_TYPE}")
+    return "zip" if match == ZIP_TYPE else "ndjson"
+
+
+def batch_rate_wait():
+    return float(os.getenv("BATCH_RATE_WAIT", "60"))
+
+
+def batch_rate_budget():
+    return float(os.getenv("BATCH_RATE_BUDGET", "180"))
+
+
+class BatchPacer:
+    def __init__(self, controller, buckets):
+        """
+        Charges the prompts of a batch against the client's rate limit, as if the distinct
+        prompts were sent one by one. The gate in front of the endpoint paid for the first;
+        every other prompt waits for its token before it runs, so a batch larger than the
+        bucket runs at the client's rate instead of getting around it.
+        Waiting ends BATCH_RATE_BUDGET (default 180 s) after the batch started, and
+        max_prompts caps a batch to what the bucket pays for in that time, so that with
+        the REQUEST_DEADLINE of its last prompt a batch ends well inside GUNICORN_TIMEOUT.
+        :param buckets: Buckets of the request (see admission.rate_limit_buckets); None
+            when admission control is off, which makes pacing a no-op.
+        """
+        self.controller = controller
+        self.buckets = buckets
+        # The last token of a full batch comes due as the budget ends; one refill of slack
+        # keeps it from missing by a hair
+        slack = 1 / controller.rate if buckets else 0
+        self.deadline = time.monotonic() + batch_rate_budget() + slack
+
+    def max_prompts(self):
+        """
+        BATCH_MAX_PROMPTS, or fewer when it would not fit the budget: a full bucket plus
+        the tokens it refills within BATCH_RATE_BUDGET (100 with the default 30/min and
+        bursts of 10).
+        """
+        if not self.buckets:
+            return max_batch_size()
+        return min(max_batch_size(), int(self.controller.burst + self.controller.rate * batch_rate_budget()))
+
+    def _timeout(self, item):
+        if not self.buckets or item.indexes[0] == 0:
+            return None
+        return max(0.0, min(batch_rate_wait(), self.deadline - time.monotonic()))
+
+    def pace(self, item):
+        """
+        Wait for the item's token.
+        :raises AdmissionError: The token did not come within BATCH_RATE_WAIT (default
+            60 s) or before the budget ran out.
+        """
+        timeout = self._timeout(item)
+        if timeout is not None:
+            self.controller.wait_rate(self.buckets, timeout=timeout)
+
+    async def apace(self, item):
+        """
+        Asyncio variant of pace.
+        """
+        timeout = self._timeout(item)
+        if timeout is not None:
+            await self.controller.await_rate(self.buckets, timeout=timeout)
+
+
+def _record(outcome):
+    BATCH_ITEMS.inc(status=outcome.status)
+    if outcome.error is not None:
+        print(f"Batch prompt {outcome.item.indexes[0]} failed: {outcome.error}")
+    return outcome
+
+
+def run_batch(items, compute, concurrency=None):
+    """
+    Run the items on a pool of batch threads, concurrency at a time. LLM clients, the
+    render pool, the result cache and single-flight are the worker's, so a batch shares
+    them with other requests and a prompt already cached or in flight is not generated again.
+    :param compute: Callable returning the CachedResult of a BatchItem.
+    :return: Generator of BatchOutcome in order of completion. Closing it early cancels
+        the items that have not started.
+    """
+    def run(item):
+        try:
+            return _record(BatchOutcome(item, compute(item)))
+        except Exception as e:
+            return _record(BatchOutcome(item, error=e))
+
+    executor = ThreadPoolExecutor(max_workers=concurrency or batch_concurrency(), thread_name_prefix="batch")
+    futures = [submit_in_context(executor, run, item) for item in items]
+    try:
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        # cancel_futures needs Python 3.9; the image runs 3.8
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+async def arun_batch(items, compute, concurrency=None):
+    """
+    Asyncio variant of run_batch.
+    :param compute: Coroutine function returning the CachedResult of a BatchItem.
+    """
+    semaphore = asyncio.Semaphore(concurrency or batch_concurrency())
+
+    async def run(item):
+        async with semaphore:
+            try:
+                return _record(BatchOutcome(item, await compute(item)))
+            except Exception as e:
+                return _record(BatchOutcome(item, error=e))
+
+    tasks = [asyncio.ensure_future(run(item)) for item in items]
+    try:
+        for next_outcome in asyncio.as_completed(tasks):
+            yield await next_outcome
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def ndjson_line(body):
+    return (json.dumps(body) + "\n").encode("utf-8")
+
+
+def batch_summary(prompt_count, outcomes):
+    """
+    Last NDJSON line of a batch.
+    """
+    succeeded = sum(1 for outcome in outcomes if outcome.error is None)
+    return {"done": True, "prompts": prompt_count, "unique": len(outcomes), "succeeded": succeeded,
+            "failed": len(outcomes) - succeeded}
+
+
+class BatchArchive:
+    def __init__(self, fileobj, prompt_count):
+        """
+        Zip archive of a batch: per prompt the DOT code, the image and the explanation,
+        named after the prompt's position, plus manifest.json with the NDJSON lines
+        (with the files of each prompt) and the summary.
+        """
+        self.zip = zipfile.ZipFile(fileobj, "w", zipfile.ZIP_DEFLATED)
+        self.prompt_count = prompt_count
+        self.width = len(str(prompt_count))
+        self.outcomes = []
+        self.entries = []
+
+    def name(self, item):
+        slug = re.sub(r"[^a-z0-9]+", "-", item.prompt.lower()).strip("-")[:40].rstrip("-")
+        return f"{item.indexes[0] + 1:0{self.width}d}-{slug or 'diagram'}"
+
+    def add(self, outcome):
+        entry = outcome.to_dict()
+        if outcome.error is None:
+            name, result = self.name(outcome.item), outcome.result
+            extension = "jpg" if result.image_format == "jpeg" else result.image_format
+            entry["files"] = [f"{name}.dot", f"{name}.{extension}", f"{name}.md"]
+            self.zip.writestr(entry["files"][0], result.dot_code)
+            # Raster images are compressed already
+            self.zip.writestr(entry["files"][1], result.image,
+                              zipfile.ZIP_DEFLATED if extension == "svg" else zipfile.ZIP_STORED)
+            self.zip.writestr(entry["files"][2], result.explanation)
+        self.outcomes.append(outcome)
+        self.entries.append(entry)
+
+    def close(self):
+        manifest = {"items": sorted(self.entries, key=lambda entry: entry["index"]),
+                    **batch_summary(self.prompt_count, self.outcomes)}
+        self.zip.writestr("manifest.json", json.dumps(manifest, indent=2))
+        self.zip.close()
+        return manifest
+
+
+def write_archive(fileobj, prompt_count, outcomes):
+    """
+    Write the outcomes of run_batch to a zip archive as they finish.
+    :return: The manifest.
+    """
+    archive = BatchArchive(fileobj, prompt_count)
+    for outcome in outcomes:
+        archive.add(outcome)
+    return archive.close()
+
+
+def zip_response_headers(filename="diagrams.zip"):
+    return {"Content-Type": ZIP_TYPE, "Content-Disposition": f'attachment; filename="{filename}"'}
+
+
+def read_prompts(path):
+    """
+    Prompts of a batch file: a JSON list of strings, or one prompt per line (blank lines
+    and lines starting with # are skipped). "-" reads standard input.
+    """
+    text = sys.stdin.read() if path == "-" else open(path, encoding="utf-8").read()
+    if text.lstrip().startswith("["):
+        return json.loads(text)
+    return [line.strip() for line in text.splitlines() if line.strip() and not line.lstrip().startswith("#")]
+
+
+def main(argv=None):
+    """
+    Run a batch offline, with the same engine and result cache as POST /api/batch:
+        python batch.py lectures.txt --output diagrams.zip --profile full --concurrency 8
+    Without --output, NDJSON lines are written to standard output as prompts finish.
+    """
+    parser = argparse.ArgumentParser(description="Generate a diagram for every prompt of a file.")
+    parser.add_argument("prompts", help="file with one prompt per line or a JSON list; - for stdin")
+    parser.add_argument("--output", "-o", help="write a .zip archive or an .ndjson file instead of stdout")
+    parser.add_argument("--profile", help="render profile: preview or full")
+    parser.add_argument("--format", help="image format: svg, png, webp or jpeg")
+    parser.add_argument("--layout", help="layout mode: declared or auto")
+    parser.add_argument("--concurrency", type=int, help="prompts run at the same time (default BATCH_CONCURRENCY)")
+    args = parser.parse_args(argv)
+
+    from router_groq_llms import GrokHandler
+
+    prompts = read_prompts(args.prompts)
+    profile = profile_from_request({"profile": args.profile, "format": args.format, "layout": args.layout})
+    query_handler = GrokHandler()
+    result_cache = get_result_cache()
+    items = batch_items(prompts, lambda prompt: handler_cache_key(query_handler, prompt, profile))
+
+    def compute(item):
+        cached = result_cache.get(item.cache_key)
+        if cached is not None:
+            return cached
+
+        def run():
+            with request_deadline():
+                result = run_pipeline(query_handler, item.prompt, profile)
+            computed = CachedResult(result.dot_code, result.image, result.explanation, result.image_format,
+                                    result.user_prompt)
+            result_cache.put(item.cache_key, computed)
+            return computed
+
+        return get_single_flight().do(item.cache_key, run)[0]
+
+    outcomes = run_batch(items, compute, args.concurrency or batch_concurrency())
+    if args.output and args.output.endswith(".zip"):
+        with open(args.output, "wb") as archive_file:
+            summary = write_archive(archive_file, len(prompts), outcomes)
+        summary.pop("items")
+    else:
+        finished = []
+        with open(args.output, "wb") if args.output else nullcontext(sys.stdout.buffer) as out:
+            for outcome in outcomes:
+                finished.append(outcome)
+                out.write(ndjson_line(outcome.to_dict()))
+                out.flush()
+            summary = batch_summary(len(prompts), finished)
+            out.write(ndjson_line(summary))
+    print(f"{summary['succeeded']} of {summary['unique']} distinct prompts succeeded "
+          f"({summary['prompts']} submitted).", file=sys.stderr)
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
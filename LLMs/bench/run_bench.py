@@ -0,0 +1,313 @@
+"""
+Offline load benchmark for /api/analyze.
+
+Starts the stub LLM server (bench/stub_llm.py), starts the app in one or more server
+modes pointed at the stub, and drives it at fixed concurrency levels. For each mode
+and level it reports latency percentiles, throughput, average render time (from the
+app's /metrics) and the server's memory growth per in-flight request.
+
+Run from the LLMs directory, e.g.
+    python bench/run_bench.py --modes sync,async --concurrency 1,8,32 --requests 64
+    python bench/run_bench.py --modes async --endpoint stream --dot-latency 0.5
+    python bench/run_bench.py --url http://127.0.0.1:5000 --concurrency 4   # server already running
+
+Only the Graphviz 'dot' binary has to be installed; no network access is needed.
+"""
+import argparse
+import http.client
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from stub_llm import add_latency_arguments, config_from_args, start_stub_server  # noqa: E402
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROMPTS = [
+    "Explain how user login works in a web app",
+    "Show the steps of principal component analysis",
+    "Draw a CI/CD build pipeline",
+    "Explain the order fulfilment process",
+]
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def server_command(mode, port, workers):
+    """
+    Command line for a server mode, matching the Dockerfile's SERVER_MODE options.
+    """
+    if mode == "sync":
+        return [sys.executable, "-m", "gunicorn", "--bind", f"127.0.0.1:{port}",
+                "--workers", str(workers), "--timeout", "300", "main:app"]
+    if mode == "async":
+        return [sys.executable, "-m", "uvicorn", "asgi:app", "--host", "127.0.0.1", "--port", str(port),
+                "--workers", str(workers), "--log-level", "warning"]
+    if mode == "flask":
+        # Flask's threaded development server; handy where gunicorn is not installed
+        return [sys.executable, "-c",
+                f"import main; main.app.run(host='127.0.0.1', port={port}, threaded=True)"]
+    raise ValueError(f"Unknown server mode '{mode}'. Use sync, async or flask.")
+
+
+def start_app(mode, stub_url, workers):
+    port = _free_port()
+    env = dict(os.environ)
+    env.update({
+        "OPENROUTER_BASE_URL": f"{stub_url}/api/v1",
+        "GROQ_API_BASE": stub_url,
+        "OPENROUTER_API_KEY": "bench",
+        "GROQ_API_KEY": "bench",
+        "PYTHONUNBUFFERED": "1",
+    })
+    env.pop("RESULT_CACHE_DB", None)
+    process = subprocess.Popen(server_command(mode, port, workers), cwd=APP_DIR, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{mode} server exited: {process.stderr.read().decode(errors='replace')[-2000:]}")
+        try:
+            status, _, _ = request(base_url, "GET", "/metrics")
+            if status == 200:
+                return process, base_url
+        except OSError:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"{mode} server did not become ready within 60s")
+
+
+def stop_app(process):
+    process.terminate()
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def request(base_url, method, path, body=None, headers=None, timeout=300):
+    """
+    One HTTP request on a fresh connection.
+    :return: (status, body bytes, seconds until the first body byte)
+    """
+    parts = urlsplit(base_url)
+    connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=timeout)
+    start = time.perf_counter()
+    try:
+        payload = json.dumps(body).encode("utf-8") if body is not None else None
+        all_headers = {"Content-Type": "application/json"} if payload is not None else {}
+        all_headers.update(headers or {})
+        connection.request(method, path, body=payload, headers=all_headers)
+        response = connection.getresponse()
+        first = response.read(1)
+        first_byte = time.perf_counter() - start
+        return response.status, first + response.read(), first_byte
+    finally:
+        connection.close()
+
+
+def process_tree_rss(pid):
+    """
+    Resident memory in bytes of a process and all its descendants, or None if unknown.
+    """
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+    if psutil is not None:
+        try:
+            parent = psutil.Process(pid)
+            return sum(p.memory_info().rss for p in [parent] + parent.children(recursive=True))
+        except psutil.Error:
+            return None
+
+    if not os.path.isdir("/proc"):
+        return None
+    children = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+                children.setdefault(ppid, []).append(int(entry))
+            except (OSError, IndexError, ValueError):
+                continue
+    total, stack = 0, [pid]
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    while stack:
+        current = stack.pop()
+        try:
+            with open(f"/proc/{current}/statm") as f:
+                total += int(f.read().split()[1]) * page_size
+        except (OSError, IndexError, ValueError):
+            pass
+        stack.extend(children.get(current, []))
+    return total
+
+
+class MemorySampler:
+    def __init__(self, pid, interval=0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            rss = process_tree_rss(self.pid)
+            if rss is not None:
+                self.peak = rss if self.peak is None else max(self.peak, rss)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def render_stage_totals(base_url):
+    """
+    (sum, count) of the render stage histogram. With several workers this is the
+    view of whichever worker answered the scrape.
+    """
+    status, body, _ = request(base_url, "GET", "/metrics")
+    if status != 200:
+        return 0.0, 0
+    text = body.decode("utf-8")
+    total = count = 0.0
+    for name, value in re.findall(r'^text2block_stage_duration_seconds_(sum|count)\{stage="render",[^}]*\} (\S+)$',
+                                  text, re.M):
+        if name == "sum":
+            total += float(value)
+        else:
+            count += float(value)
+    return total, int(count)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return float("nan")
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def run_level(base_url, endpoint, concurrency, total_requests, server_pid=None):
+    path = "/api/analyze/stream" if endpoint == "stream" else "/api/analyze"
+    run_id = uuid.uuid4().hex[:8]
+
+    def one(index):
+        # Unique prompts so the result cache never answers
+        prompt = f"{PROMPTS[index % len(PROMPTS)]} (bench {run_id}-{index})"
+        start = time.perf_counter()
+        status, body, first_byte = request(base_url, "POST", path, {"prompt": prompt})
+        ok = status == 200 and (endpoint != "stream" or b"event: done" in body)
+        return ok, time.perf_counter() - start, first_byte
+
+    render_sum_before, render_count_before = render_stage_totals(base_url)
+    baseline_rss = process_tree_rss(server_pid) if server_pid else None
+
+    sampler = MemorySampler(server_pid) if server_pid else None
+    started = time.perf_counter()
+    with sampler or nullcontext():
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(one, range(total_requests)))
+    wall = time.perf_counter() - started
+
+    render_sum_after, render_count_after = render_stage_totals(base_url)
+    latencies = sorted(latency for ok, latency, _ in results if ok)
+    first_bytes = sorted(first_byte for ok, _, first_byte in results if ok)
+    renders = render_count_after - render_count_before
+
+    memory_per_request = None
+    if baseline_rss is not None and sampler is not None and sampler.peak is not None:
+        memory_per_request = max(0, sampler.peak - baseline_rss) / concurrency
+
+    return {
+        "concurrency": concurrency,
+        "requests": total_requests,
+        "errors": sum(1 for ok, _, _ in results if not ok),
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "ttfb_p50": percentile(first_bytes, 0.50),
+        "requests_per_second": len(latencies) / wall if wall else 0.0,
+        "render_avg": (render_sum_after - render_sum_before) / renders if renders else float("nan"),
+        "memory_mb_per_request": memory_per_request / 1024 / 1024 if memory_per_request is not None else None,
+    }
+
+
+def format_row(mode, row):
+    memory = f"{row['memory_mb_per_request']:.1f}" if row["memory_mb_per_request"] is not None else "n/a"
+    return (f"{mode:<6} {row['concurrency']:>5} {row['requests']:>6} {row['errors']:>6} "
+            f"{row['p50']:>7.2f} {row['p95']:>7.2f} {row['p99']:>7.2f} {row['ttfb_p50']:>8.2f} "
+            f"{row['requests_per_second']:>7.2f} {row['render_avg'] * 1000:>9.1f} {memory:>8}")
+
+
+HEADER = (f"{'mode':<6} {'conc':>5} {'reqs':>6} {'errors':>6} {'p50 s':>7} {'p95 s':>7} {'p99 s':>7} "
+          f"{'ttfb s':>8} {'req/s':>7} {'render ms':>9} {'MB/req':>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", default="sync,async", help="comma-separated server modes: sync, async, flask")
+    parser.add_argument("--url", help="benchmark an already running server instead of starting one")
+    parser.add_argument("--workers", type=int, default=2, help="server worker processes")
+    parser.add_argument("--endpoint", choices=("analyze", "stream"), default="analyze")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=32, help="requests per concurrency level")
+    parser.add_argument("--json", help="also write the results to this file")
+    add_latency_arguments(parser)
+    args = parser.parse_args()
+
+    levels = [int(level) for level in args.concurrency.split(",")]
+    stub, stub_url = start_stub_server(config_from_args(args))
+    results = {}
+    print(HEADER)
+    try:
+        modes = ["remote"] if args.url else [mode.strip() for mode in args.modes.split(",")]
+        for mode in modes:
+            process = None
+            base_url = args.url
+            if base_url is None:
+                process, base_url = start_app(mode, stub_url, args.workers)
+            try:
+                results[mode] = []
+                for level in levels:
+                    row = run_level(base_url, args.endpoint, level, args.requests,
+                                    process.pid if process is not None else None)
+                    results[mode].append(row)
+                    print(format_row(mode, row), flush=True)
+            finally:
+                if process is not None:
+                    stop_app(process)
+    finally:
+        stub.shutdown()
+
+    print(f"stub calls: {stub.RequestHandlerClass.config.calls}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Startup time and memory benchmark for a server worker.
+
+Each run starts a fresh interpreter that imports the app module and builds its query
+handler (with its LLM clients), i.e. what a gunicorn/uvicorn worker does before it
+serves its first request. It reports the median wall time, the peak RSS of the
+process and which heavyweight optional packages ended up loaded.
+
+Run from the LLMs directory, e.g.
+    python bench/startup_bench.py --runs 5
+    python bench/startup_bench.py --app asgi
+To compare with an older revision, check it out next to this one and point --app-dir at it:
+    git worktree add /tmp/before <commit> && python bench/startup_bench.py --app-dir /tmp/before/LLMs
+
+No network access is needed; API keys are set to dummy values when missing.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ["cv2", "numpy", "langchain", "langchain_core", "langchain_groq", "groq", "fastembed", "tiktoken"]
+
+# Runs in the child interpreter; prints one JSON line
+CHILD = """
+import json, resource, sys, time
+start = time.perf_counter()
+app = __import__(sys.argv[1])
+imported = time.perf_counter()
+app.get_query_handler()
+ready = time.perf_counter()
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({
+    "import_s": imported - start,
+    "ready_s": ready - start,
+    # Kilobytes on Linux, bytes on macOS
+    "peak_rss_mb": peak / (1024 * 1024 if sys.platform == "darwin" else 1024),
+    "modules": len(sys.modules),
+    "heavy": [name for name in sys.argv[2].split(",") if name in sys.modules],
+}))
+"""
+
+
+def run_once(app, app_dir):
+    env = dict(os.environ)
+    env.setdefault("OPENROUTER_API_KEY", "bench")
+    env.setdefault("GROQ_API_KEY", "bench")
+    env["PYTHONPATH"] = app_dir
+    completed = subprocess.run(
+        [sys.executable, "-c", CHILD, app, ",".join(HEAVY_MODULES)],
+        cwd=app_dir, env=env, capture_output=True, text=True, check=False,
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"Starting '{app}' failed:\n{completed.stderr}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--app", default="main", help="App module to start: main (Flask) or asgi (Quart).")
+    parser.add_argument("--app-dir", default=APP_DIR, help="Directory containing the app, e.g. another checkout.")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    results = [run_once(args.app, os.path.abspath(args.app_dir)) for _ in range(args.runs)]
+    print(f"{args.app} in {os.path.abspath(args.app_dir)} ({args.runs} runs)")
+    print(f"  import:        {statistics.median(r['import_s'] for r in results) * 1000:8.1f} ms (median)")
+    print(f"  ready:         {statistics.median(r['ready_s'] for r in results) * 1000:8.1f} ms (median)")
+    print(f"  peak RSS:      {statistics.median(r['peak_rss_mb'] for r in results):8.1f} MB (median)")
+    print(f"  modules:       {results[-1]['modules']:8d}")
+    print(f"  heavy modules: {', '.join(results[-1]['heavy']) or 'none'}")
+
+
+if __name__ == "__main__":
+    main()
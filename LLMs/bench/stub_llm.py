@@ -0,0 +1,252 @@
+"""
+Local stand-in for the OpenRouter and Groq chat completion APIs, for benchmarks
+that must not touch the network or spend tokens.
+
+It replays recorded responses (bench/recorded_responses.json). DOT generation requests
+cycle through the recorded diagrams, some of which are broken so that fix_dot_code
+runs; fix requests get a recorded fixed diagram and explanation requests a recorded
+explanation. Every call waits for a configurable latency first.
+
+Point the app at it with
+    OPENROUTER_BASE_URL=http://127.0.0.1:8765/api/v1
+    GROQ_API_BASE=http://127.0.0.1:8765
+and run it with
+    python bench/stub_llm.py --port 8765 --dot-latency 1.5 --text-latency 2
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RECORDED_RESPONSES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recorded_responses.json")
+
+
+class StubConfig:
+    def __init__(self, responses, dot_latency=1.0, fix_latency=1.0, text_latency=1.5,
+                 jitter=0.2, token_delay=0.01, seed=None):
+        """
+        :param responses: Dict with 'dot_code', 'fixed_dot_code' and 'explanation' lists.
+        :param dot_latency: Seconds before a DOT generation response.
+        :param fix_latency: Seconds before a fix response.
+        :param text_latency: Seconds before the first token of an explanation.
+        :param jitter: Relative random variation applied to every latency (0.2 = +-20%).
+        :param token_delay: Generation time per 16-character chunk, streamed or not.
+        """
+        self.responses = responses
+        self.latencies = {"dot_code": dot_latency, "fixed_dot_code": fix_latency, "explanation": text_latency}
+        self.jitter = jitter
+        self.token_delay = token_delay
+        self._random = random.Random(seed)
+        self._counters = {kind: itertools.count() for kind in responses}
+        self._lock = threading.Lock()
+        self.calls = {kind: 0 for kind in responses}
+
+    def next_response(self, kind):
+        with self._lock:
+            index = next(self._counters[kind])
+            self.calls[kind] += 1
+            delay = self.latencies[kind] * (1 + self._random.uniform(-self.jitter, self.jitter))
+        choices = self.responses[kind]
+        return choices[index % len(choices)], max(delay, 0.0)
+
+
+def classify_prompt(prompt):
+    """
+    Which recorded response answers a prompt built by GrokHandler.
+    """
+    lowered = prompt.lower()
+    if "fix the errors" in lowered or "fix graphviz dot code" in lowered:
+        return "fixed_dot_code"
+    if "text response" in lowered or "explain flowcharts" in lowered:
+        return "explanation"
+    return "dot_code"
+
+
+def _message_text(message):
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        # Content parts instead of a plain string
+        return "".join(part.get("text", "") for part in content)
+    return content
+
+
+def _token_count(text):
+    # Close enough to a BPE tokenizer for payload accounting
+    return max(1, len(text) // 4)
+
+
+def _chunks(text, size=16):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {"object": "list", "data": []})
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        prompt = "\n".join(_message_text(message) for message in request.get("messages") or [])
+        model = request.get("model", "stub")
+
+        content, delay = self.config.next_response(classify_prompt(prompt))
+        time.sleep(delay)
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        usage = {
+            "prompt_tokens": _token_count(prompt),
+            "completion_tokens": _token_count(content),
+            "total_tokens": _token_count(prompt) + _token_count(content),
+        }
+        if not request.get("stream"):
+            # The model generates the whole completion either way, streamed or not
+            time.sleep(self.config.token_delay * len(_chunks(content)))
+            self._send_json(200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def event(delta, finish_reason=None, extra=None):
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            chunk.update(extra or {})
+            self._write_chunk(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+
+        event({"role": "assistant", "content": ""})
+        for piece in _chunks(content):
+            time.sleep(self.config.token_delay)
+            event({"content": piece})
+        event({}, finish_reason="stop", extra={"x_groq": {"usage": usage}})
+        if (request.get("stream_options") or {}).get("include_usage"):
+            # OpenAI-style trailing chunk with no choices, only token counts
+            usage_chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [],
+                "usage": usage,
+            }
+            self._write_chunk(f"data: {json.dumps(usage_chunk)}\n\n".encode("utf-8"))
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients abandoning a response (e.g. a cancelled explanation) are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def load_responses(path=RECORDED_RESPONSES):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def start_stub_server(config, host="127.0.0.1", port=0):
+    """
+    Serve the stub from a daemon thread.
+    :param port: 0 picks a free port.
+    :return: (server, base URL); call server.shutdown() to stop it.
+    """
+    handler = type("ConfiguredStubHandler", (StubHandler,), {"config": config})
+    server = StubServer((host, port), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def add_latency_arguments(parser):
+    parser.add_argument("--responses", default=RECORDED_RESPONSES, help="recorded responses JSON file")
+    parser.add_argument("--dot-latency", type=float, default=1.0, help="seconds per DOT generation call")
+    parser.add_argument("--fix-latency", type=float, default=1.0, help="seconds per fix_dot_code call")
+    parser.add_argument("--text-latency", type=float, default=1.5, help="seconds before an explanation starts")
+    parser.add_argument("--jitter", type=float, default=0.2, help="relative latency variation")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="generation seconds per 16-character chunk")
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def config_from_args(args):
+    return StubConfig(
+        load_responses(args.responses),
+        dot_latency=args.dot_latency,
+        fix_latency=args.fix_latency,
+        text_latency=args.text_latency,
+        jitter=args.jitter,
+        token_delay=args.token_delay,
+        seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_latency_arguments(parser)
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(config_from_args(args), args.host, args.port)
+    print(f"Stub LLM server on {base_url}")
+    print(f"  OPENROUTER_BASE_URL={base_url}/api/v1")
+    print(f"  GROQ_API_BASE={base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+import os
+import threading
+import time
+import httpx
+from openai import AsyncOpenAI, OpenAI
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Overridable so benchmarks can point the app at a local stub server (see bench/stub_llm.py)
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+# Groq serves an OpenAI-compatible API under /openai/v1, so the OpenAI SDK is all it needs
+GROQ_API_BASE = os.getenv("GROQ_API_BASE", "https://api.groq.com")
+GROQ_BASE_URL = f"{GROQ_API_BASE.rstrip('/')}/openai/v1"
+OPENROUTER_HEADERS = {
+    "HTTP-Referer": "null",
+    "X-Title": "Text2Block",
+}
+
+
+class _PooledHttpClient:
+    def __init__(self, http_client):
+        self.http_client = http_client
+        # Created on first async use; it must live on the event loop of the ASGI worker
+        self.async_http_client = None
+        self.created_at = time.monotonic()
+        self.consecutive_errors = 0
+
+
+class ClientPool:
+    def __init__(self, max_connections=None, max_keepalive_connections=None,
+                 keepalive_expiry=None, request_timeout=None, max_client_age=None,
+                 max_consecutive_errors=None):
+        """
+        Process-wide registry of LLM clients that share keep-alive HTTP connection pools.
+        Each backend (openrouter, openai, groq) gets one httpx client, reused by every
+        handler and request in this worker. A backend's connections are recycled once
+        they are older than max_client_age seconds or after max_consecutive_errors
+        connection failures in a row.
+        """
+        self.max_connections = max_connections or int(os.getenv("LLM_POOL_MAX_CONNECTIONS", "50"))
+        self.max_keepalive_connections = max_keepalive_connections or int(
+            os.getenv("LLM_POOL_MAX_KEEPALIVE", "20"))
+        self.keepalive_expiry = keepalive_expiry or float(os.getenv("LLM_POOL_KEEPALIVE_EXPIRY", "60"))
+        self.request_timeout = request_timeout or float(os.getenv("LLM_REQUEST_TIMEOUT", "120"))
+        self.max_client_age = max_client_age or float(os.getenv("LLM_POOL_MAX_CLIENT_AGE", "3600"))
+        self.max_consecutive_errors = max_consecutive_errors or int(
+            os.getenv("LLM_POOL_MAX_CONSECUTIVE_ERRORS", "3"))
+
+        self._lock = threading.RLock()
+        self._http_clients = {}
+        self._clients = {}
+
+    def _client_options(self):
+        return {
+            "limits": httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+            "timeout": httpx.Timeout(self.request_timeout, connect=10.0),
+        }
+
+    def _build_http_client(self):
+        return httpx.Client(**self._client_options())
+
+    def _retire(self, backend):
+        """
+        Drop a backend's HTTP client and every LLM client built on top of it.
+        The old connections are closed after a grace period so in-flight calls can finish;
+        async connections are left to the garbage collector, as closing them needs the event loop.
+        """
+        pooled = self._http_clients.pop(backend, None)
+        for key in [key for key in self._clients if key[0] == backend]:
+            del self._clients[key]
+        if pooled is not None:
+            timer = threading.Timer(self.request_timeout, pooled.http_client.close)
+            timer.daemon = True
+            timer.start()
+
+    def _pooled(self, backend):
+        pooled = self._http_clients.get(backend)
+        if pooled is not None and time.monotonic() - pooled.created_at > self.max_client_age:
+            print(f"Recycling '{backend}' HTTP client after {self.max_client_age:.0f}s.")
+            self._retire(backend)
+            pooled = None
+        if pooled is None:
+            pooled = _PooledHttpClient(self._build_http_client())
+            self._http_clients[backend] = pooled
+        return pooled
+
+    def _async_http_client(self, pooled):
+        if pooled.async_http_client is None:
+            pooled.async_http_client = httpx.AsyncClient(**self._client_options())
+        return pooled.async_http_client
+
+    def _get(self, key, factory):
+        with self._lock:
+            pooled = self._pooled(key[0])
+            client = self._clients.get(key)
+            if client is None:
+                client = factory(pooled)
+                self._clients[key] = client
+            return client
+
+    def openrouter(self, sdk_retries=True):
+        """
+        Shared OpenAI-compatible client for OpenRouter.
+        :param sdk_retries: False for a client without the SDK's own retries, for callers
+            that retry through resilience.resilient_call.
+        """
+        api_key = os.getenv("OPENROUTER_API_KEY")
+        if not api_key:
+            raise ValueError("OPENROUTER_API_KEY environment variable not set.")
+
+        return self._get(("openrouter",) + _retry_key(sdk_retries), lambda pooled: OpenAI(
+            base_url=OPENROUTER_BASE_URL,
+            api_key=api_key,
+            default_headers=OPENROUTER_HEADERS,
+            http_client=pooled.http_client,
+            **_retry_options(sdk_retries),
+        ))
+
+    def async_openrouter(self, sdk_retries=True):
+        """
+        Shared AsyncOpenAI client for OpenRouter, used by the ASGI app.
+        """
+        api_key = os.getenv("OPENROUTER_API_KEY")
+        if not api_key:
+            raise ValueError("OPENROUTER_API_KEY environment variable not set.")
+
+        return self._get(("openrouter", "async") + _retry_key(sdk_retries), lambda pooled: AsyncOpenAI(
+            base_url=OPENROUTER_BASE_URL,
+            api_key=api_key,
+            default_headers=OPENROUTER_HEADERS,
+            http_client=self._async_http_client(pooled),
+            **_retry_options(sdk_retries),
+        ))
+
+    def openai(self):
+        """
+        Shared client for the OpenAI API.
+        """
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            raise ValueError("OPENAI_API_KEY environment variable not set.")
+
+        return self._get(("openai",), lambda pooled: OpenAI(api_key=api_key, http_client=pooled.http_client))
+
+    def groq(self, sdk_retries=True):
+        """
+        Shared OpenAI-compatible client for Groq; the model is chosen per call.
+        """
+        api_key = os.getenv("GROQ_API_KEY")
+        if not api_key:
+            raise ValueError("GROQ_API_KEY environment variable not set.")
+
+        return self._get(("groq",) + _retry_key(sdk_retries), lambda pooled: OpenAI(
+            base_url=GROQ_BASE_URL,
+            api_key=api_key,
+            http_client=pooled.http_client,
+            **_retry_options(sdk_retries),
+        ))
+
+    def async_groq(self, sdk_retries=True):
+        """
+        Shared AsyncOpenAI client for Groq, used by the ASGI app.
+        """
+        api_key = os.getenv("GROQ_API_KEY")
+        if not api_key:
+            raise ValueError("GROQ_API_KEY environment variable not set.")
+
+        return self._get(("groq", "async") + _retry_key(sdk_retries), lambda pooled: AsyncOpenAI(
+            base_url=GROQ_BASE_URL,
+            api_key=api_key,
+            http_client=self._async_http_client(pooled),
+            **_retry_options(sdk_retries),
+        ))
+
+    def record_success(self, backend):
+        with self._lock:
+            pooled = self._http_clients.get(backend)
+            if pooled is not None:
+                pooled.consecutive_errors = 0
+
+    def record_error(self, backend, error):
+        """
+        Count a failed call against a backend. Only transport-level failures count
+        towards recycling; API errors such as 4xx responses leave the connections alone.
+        """
+        if not _is_connection_error(error):
+            return
+        with self._lock:
+            pooled = self._http_clients.get(backend)
+            if pooled is None:
+                return
+            pooled.consecutive_errors += 1
+            if pooled.consecutive_errors >= self.max_consecutive_errors:
+                print(f"Recycling '{backend}' HTTP client after {pooled.consecutive_errors} connection errors.")
+                self._retire(backend)
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            return {
+                backend: {
+                    "age_seconds": round(now - pooled.created_at, 1),
+                    "consecutive_errors": pooled.consecutive_errors,
+                }
+                for backend, pooled in self._http_clients.items()
+            }
+
+    def close(self):
+        with self._lock:
+            for pooled in self._http_clients.values():
+                pooled.http_client.close()
+            self._http_clients.clear()
+            self._clients.clear()
+
+
+def _retry_key(sdk_retries):
+    return () if sdk_retries else ("no-retries",)
+
+
+def _retry_options(sdk_retries):
+    return {} if sdk_retries else {"max_retries": 0}
+
+
+def _is_connection_error(error):
+    import openai
+
+    connection_errors = (httpx.TransportError, openai.APIConnectionError)
+
+    seen = set()
+    while error is not None and id(error) not in seen:
+        if isinstance(error, connection_errors):
+            return True
+        seen.add(id(error))
+        error = error.__cause__ or error.__context__
+    return False
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_client_pool():
+    """
+    Return this worker's ClientPool, creating it on first use. A pool inherited
+    across fork (e.g. gunicorn --preload) is replaced, since sockets must not be shared.
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ClientPool()
+            _pool_pid = os.getpid()
+        return _pool
@@ -0,0 +1,378 @@
+import re
+from collections import defaultdict
+from dot_lint import DotSyntaxError, extract_dot_code, graph_body_start, lint_dot, strip_preamble, tokenize_dot
+
+# Fill colors are pastel so black labels stay readable; line and text colors are saturated
+FILL_COLORS = {
+    "red": "#FFCDD2", "pink": "#F8BBD0", "purple": "#E1BEE7", "violet": "#E1BEE7", "blue": "#BBDEFB",
+    "cyan": "#B2EBF2", "teal": "#B2DFDB", "green": "#C8E6C9", "yellow": "#FFF9C4", "orange": "#FFE0B2",
+    "brown": "#D7CCC8", "gray": "#E0E0E0", "grey": "#E0E0E0", "white": "#FFFFFF", "black": "#424242",
+}
+LINE_COLORS = {
+    "red": "#E53935", "pink": "#D81B60", "purple": "#8E24AA", "violet": "#8E24AA", "blue": "#1E88E5",
+    "cyan": "#00ACC1", "teal": "#00897B", "green": "#43A047", "yellow": "#FDD835", "orange": "#FB8C00",
+    "brown": "#6D4C41", "gray": "#757575", "grey": "#757575", "white": "#FFFFFF", "black": "#000000",
+}
+SHAPES = {
+    "rectangle": "box", "rectangles": "box", "square": "box", "squares": "box",
+    "ellipse": "ellipse", "ellipses": "ellipse", "oval": "ellipse", "ovals": "ellipse",
+    "circle": "circle", "circles": "circle", "diamond": "diamond", "diamonds": "diamond",
+    "hexagon": "hexagon", "hexagons": "hexagon", "parallelogram": "parallelogram", "parallelograms": "parallelogram",
+    "box": "box", "boxes": "box",
+}
+DIRECTIONS = [
+    (r"left to right|horizontal(?:ly)?|sideways", "LR"),
+    (r"right to left", "RL"),
+    (r"top to bottom|top down|vertical(?:ly)?", "TB"),
+    (r"bottom to top|bottom up", "BT"),
+]
+EDGE_STYLES = {"dashed": "dashed", "dotted": "dotted", "bold": "bold", "solid": "solid"}
+
+# Checked in this order, so "the text in the boxes" targets the text
+_TARGETS = [
+    ("text", r"text|fonts?|labels?|writing"),
+    ("background", r"background|canvas"),
+    ("edge", r"edges?|arrows?|lines?|connectors?|connections?|links?"),
+    ("node", r"nodes?|boxes|box|shapes?|steps?|blocks?|elements?|it|everything|diagram|chart|flowchart|graph"),
+]
+# Words that ask for a different graph rather than a different look
+_STRUCTURAL_RE = re.compile(
+    r"\b(?:add|adds|adding|remove|delete|insert|rename|connect|split|merge|replace|include|drop|move|"
+    r"new|another|between|after|before|instead|explain|more|fewer)\b"
+)
+_CLAUSE_SPLIT_RE = re.compile(r"\s*(?:[,;.]|\band\b|\bthen\b)\s*")
+_HEX_RE = re.compile(r"#[0-9a-f]{6}\b")
+_COLOR_RE = re.compile(r"\b(" + "|".join(FILL_COLORS) + r")\b")
+_SHAPE_RE = re.compile(r"\b(" + "|".join(SHAPES) + r")\b")
+
+
+class StyleEdit:
+    def __init__(self, scope, attribute, value, merge=False):
+        """
+        One deterministic change.
+        :param scope: "node", "edge" or "graph".
+        :param merge: Add value to a comma-separated style list instead of replacing it.
+        """
+        self.scope = scope
+        self.attribute = attribute
+        self.value = value
+        self.merge = merge
+
+    def __repr__(self):
+        return f"StyleEdit({self.scope!r}, {self.attribute!r}, {self.value!r}, merge={self.merge})"
+
+
+def _parse_clause(clause, previous_target=None):
+    """
+    :param previous_target: Target of the preceding clause, for clauses such as "dashed"
+        in "make the arrows red and dashed".
+    :return: (edits or None, target)
+    """
+    if _STRUCTURAL_RE.search(clause):
+        return None, None
+    for pattern, rankdir in DIRECTIONS:
+        if re.search(rf"\b(?:{pattern})\b", clause):
+            return [StyleEdit("graph", "rankdir", rankdir)], None
+
+    target, target_span = previous_target, None
+    for name, pattern in _TARGETS:
+        match = re.search(rf"\b(?:{pattern})\b", clause)
+        if match:
+            target, target_span = name, match.span()
+            break
+
+    edits = []
+    hex_color = _HEX_RE.search(clause)
+    color_word = _COLOR_RE.search(clause)
+    if hex_color or color_word:
+        def color(palette):
+            return hex_color.group().upper() if hex_color else palette[color_word.group()]
+
+        if target == "edge":
+            edits.append(StyleEdit("edge", "color", color(LINE_COLORS)))
+        elif target == "text":
+            edits.append(StyleEdit("node", "fontcolor", color(LINE_COLORS)))
+            edits.append(StyleEdit("edge", "fontcolor", color(LINE_COLORS)))
+        elif target == "background":
+            edits.append(StyleEdit("graph", "bgcolor", color(FILL_COLORS)))
+        else:
+            edits.append(StyleEdit("node", "fillcolor", color(FILL_COLORS)))
+            edits.append(StyleEdit("node", "style", "filled", merge=True))
+
+    size = re.search(r"\bfont ?size (?:to |of )?(\d{1,2})\b", clause)
+    if size:
+        edits.append(StyleEdit("node", "fontsize", size.group(1)))
+        edits.append(StyleEdit("edge", "fontsize", size.group(1)))
+    elif target == "text" and re.search(r"\b(?:bigger|larger)\b", clause):
+        edits.append(StyleEdit("node", "fontsize", "18"))
+        edits.append(StyleEdit("edge", "fontsize", "16"))
+    elif target == "text" and re.search(r"\bsmaller\b", clause):
+        edits.append(StyleEdit("node", "fontsize", "10"))
+        edits.append(StyleEdit("edge", "fontsize", "9"))
+
+    if target == "edge":
+        style = re.search(r"\b(" + "|".join(EDGE_STYLES) + r")\b", clause)
+        if style:
+            edits.append(StyleEdit("edge", "style", EDGE_STYLES[style.group(1)]))
+        if re.search(r"\b(?:thick|thicker|heavier)\b", clause):
+            edits.append(StyleEdit("edge", "penwidth", "2"))
+        elif re.search(r"\b(?:thin|thinner|lighter)\b", clause):
+            edits.append(StyleEdit("edge", "penwidth", "1"))
+
+    if target in (None, "node"):
+        if re.search(r"\b(?:rounded|round corners|rounded corners)\b", clause):
+            edits.append(StyleEdit("node", "style", "rounded", merge=True))
+        # The word that named the target ("make the boxes blue") is not a shape request
+        shapes = [match for match in _SHAPE_RE.finditer(clause) if match.span() != target_span]
+        if shapes:
+            edits.append(StyleEdit("node", "shape", SHAPES[shapes[-1].group(1)]))
+
+    return edits or None, target
+
+
+def parse_style_instruction(instruction):
+    """
+    Understand instructions that only change the look of a diagram, such as
+    "make the boxes blue and the arrows dashed" or "lay it out left to right".
+    :return: List of StyleEdit, or None when any part of the instruction needs the LLM.
+    """
+    text = instruction.casefold().strip()
+    edits, target = [], None
+    for clause in _CLAUSE_SPLIT_RE.split(text):
+        clause = clause.strip(" !?'\"")
+        if not clause:
+            continue
+        clause_edits, target = _parse_clause(clause, target)
+        if clause_edits is None:
+            return None
+        edits.extend(clause_edits)
+    return edits or None
+
+
+class _AttrList:
+    def __init__(self, owner, depth, open_token, close_token):
+        self.owner = owner
+        self.depth = depth
+        self.start = open_token.start
+        self.end = close_token.end
+        # [name, raw value text] in source order
+        self.pairs = []
+        self.changed = False
+
+    def get(self, name):
+        for pair_name, value in self.pairs:
+            if pair_name == name:
+                return value
+        return None
+
+    def remove(self, name):
+        kept = [pair for pair in self.pairs if pair[0] != name]
+        if len(kept) != len(self.pairs):
+            self.pairs = kept
+            self.changed = True
+
+    def merge_style(self, token):
+        for pair in self.pairs:
+            if pair[0] == "style":
+                values = [v.strip() for v in pair[1].strip('"').split(",") if v.strip()]
+                if token not in values:
+                    pair[1] = '"' + ",".join(values + [token]) + '"'
+                    self.changed = True
+
+    def text(self):
+        return "[" + ", ".join(f"{name}={value}" for name, value in self.pairs) + "]"
+
+
+def _list_owner(tokens, index, previous_list):
+    previous = tokens[index - 1]
+    if previous.value == "]" and previous_list is not None:
+        return previous_list.owner
+    if previous.kind == "id" and previous.value.lower() in ("node", "edge", "graph"):
+        return previous.value.lower() + "_default"
+    if previous.value == "}":
+        return "edge"
+    position = index - 1
+    # Skip ports, e.g. a:n -> b:s
+    while position >= 2 and tokens[position - 1].value == ":":
+        position -= 2
+    if position >= 1 and tokens[position - 1].kind == "edgeop":
+        return "edge"
+    return "node"
+
+
+def _scan(dot_code):
+    """
+    :return: (attribute lists, root-level "name=value" statements as (name, start, end)).
+    """
+    tokens, issues = tokenize_dot(dot_code)
+    if issues:
+        raise DotSyntaxError("; ".join(issues))
+    lists, assignments = [], []
+    depth, index = 0, 0
+    while index < len(tokens):
+        token = tokens[index]
+        if token.value == "{":
+            depth += 1
+        elif token.value == "}":
+            depth -= 1
+        elif token.value == "[" and index > 0:
+            owner = _list_owner(tokens, index, lists[-1] if lists else None)
+            close = index + 1
+            pairs = []
+            while close < len(tokens) and tokens[close].value != "]":
+                if close + 2 < len(tokens) and tokens[close + 1].value == "=":
+                    value_end = close + 2
+                    # Concatenated strings: "a" + "b"
+                    while value_end + 2 < len(tokens) and tokens[value_end + 1].value == "+":
+                        value_end += 2
+                    pairs.append([tokens[close].value, dot_code[tokens[close + 2].start:tokens[value_end].end]])
+                    close = value_end + 1
+                else:
+                    close += 1
+            if close >= len(tokens):
+                raise DotSyntaxError("unclosed attribute list")
+            attr_list = _AttrList(owner, depth, token, tokens[close])
+            attr_list.pairs = pairs
+            lists.append(attr_list)
+            index = close
+        elif token.value == "=" and depth == 1 and 0 < index < len(tokens) - 1:
+            end = tokens[index + 1].end
+            if index + 2 < len(tokens) and tokens[index + 2].value == ";":
+                end = tokens[index + 2].end
+            assignments.append((tokens[index - 1].value, tokens[index - 1].start, end))
+        index += 1
+    return lists, assignments
+
+
+def apply_style_edits(dot_code, edits):
+    """
+    Apply StyleEdits to DOT code without an LLM. Conflicting attributes are removed
+    from node/edge statements and defaults, and the new values are declared as
+    defaults right after the graph's opening brace, so they reach every element.
+    :return: Edited DOT code.
+    :raises DotSyntaxError: The code cannot be edited safely or the result does not parse.
+    """
+    body_start = graph_body_start(dot_code)
+    if body_start == -1:
+        raise DotSyntaxError("DOT code has no graph header")
+    lists, assignments = _scan(dot_code)
+    owners = {"node": ("node", "node_default"), "edge": ("edge", "edge_default"), "graph": ("graph_default",)}
+    defaults = defaultdict(dict)
+    removed_assignments = []
+
+    for edit in edits:
+        scoped = [attr_list for attr_list in lists if attr_list.owner in owners[edit.scope]
+                  and (edit.scope != "graph" or attr_list.depth == 1)]
+        if edit.merge:
+            for attr_list in scoped:
+                attr_list.merge_style(edit.value)
+            if not any(attr_list.get("style") for attr_list in scoped if attr_list.owner.endswith("_default")):
+                current = defaults[edit.scope].get(edit.attribute, "")
+                values = [v for v in current.split(",") if v] + [edit.value]
+                defaults[edit.scope][edit.attribute] = ",".join(dict.fromkeys(values))
+            continue
+
+        for attr_list in scoped:
+            attr_list.remove(edit.attribute)
+        if edit.scope == "graph":
+            removed_assignments += [(start, end) for name, start, end in assignments if name == edit.attribute]
+        defaults[edit.scope][edit.attribute] = edit.value
+
+    changes = [(attr_list.start, attr_list.end, attr_list.text()) for attr_list in lists if attr_list.changed]
+    changes += [(start, end, "") for start, end in set(removed_assignments)]
+    declarations = []
+    for name, value in defaults["graph"].items():
+        declarations.append(f'{name}="{value}";')
+    for scope in ("node", "edge"):
+        if defaults[scope]:
+            attributes = ", ".join(f'{name}="{value}"' for name, value in defaults[scope].items())
+            declarations.append(f"{scope} [{attributes}];")
+    if declarations:
+        changes.append((body_start, body_start, "\n  " + "\n  ".join(declarations)))
+
+    for start, end, text in sorted(changes, key=lambda change: change[0], reverse=True):
+        dot_code = dot_code[:start] + text + dot_code[end:]
+
+    issues = lint_dot(dot_code)
+    if issues:
+        raise DotSyntaxError("Style edit produced invalid DOT code: " + "; ".join(issues))
+    return dot_code
+
+
+def style_refinement(dot_code, instruction):
+    """
+    :return: The DOT code with a style-only instruction applied, or None when the
+        instruction needs the LLM (or the code cannot be edited locally).
+    """
+    edits = parse_style_instruction(instruction)
+    if edits is None:
+        return None
+    try:
+        return apply_style_edits(dot_code, edits)
+    except DotSyntaxError as e:
+        print(f"Style edit not applied locally: {e}")
+        return None
+
+
+def number_lines(dot_code):
+    """
+    DOT code with 1-based line numbers, as shown to the LLM for diff requests.
+    """
+    return "\n".join(f"{number}| {line}" for number, line in enumerate(dot_code.split("\n"), 1))
+
+
+_DIFF_RE = re.compile(r"^\s*(DELETE|REPLACE|INSERT AFTER)\s+(\d+)\s*(?::[ \t]?(.*))?$", re.I)
+
+
+def apply_line_diff(dot_code, diff_text):
+    """
+    Apply edit commands against the numbered lines of dot_code:
+      DELETE <n>
+      REPLACE <n>: <new line>
+      INSERT AFTER <n>: <new line>     (n may be 0 to insert at the top)
+    Line numbers refer to the original code, whatever the order of the commands.
+    :raises ValueError: The diff is empty, malformed or refers to missing lines.
+    """
+    lines = dot_code.split("\n")
+    deleted, replaced, inserted = set(), {}, defaultdict(list)
+    for raw in diff_text.strip().split("\n"):
+        if not raw.strip() or raw.strip().startswith("```"):
+            continue
+        match = _DIFF_RE.match(raw)
+        if match is None:
+            raise ValueError(f"Unrecognised edit command: {raw.strip()!r}")
+        command, number, content = match.group(1).upper(), int(match.group(2)), match.group(3) or ""
+        if not (0 if command == "INSERT AFTER" else 1) <= number <= len(lines):
+            raise ValueError(f"Edit command refers to missing line {number}")
+        if command == "INSERT AFTER":
+            inserted[number].append(content)
+        elif number in deleted or number in replaced:
+            raise ValueError(f"Conflicting edit commands for line {number}")
+        elif command == "DELETE":
+            deleted.add(number)
+        else:
+            replaced[number] = content
+    if not (deleted or replaced or inserted):
+        raise ValueError("The edit contained no commands")
+
+    result = list(inserted[0])
+    for number, line in enumerate(lines, 1):
+        if number in replaced:
+            result.append(replaced[number])
+        elif number not in deleted:
+            result.append(line)
+        result.extend(inserted[number])
+    return "\n".join(result)
+
+
+def apply_refinement(dot_code, response_text):
+    """
+    Turn the LLM's reply to a refine prompt into new, locally repaired DOT code.
+    Replies that contain a whole graph instead of edit commands are accepted as well.
+    :raises ValueError: The reply is neither.
+    """
+    text = strip_preamble(response_text)
+    if re.match(r"(?i)(?:strict\s+)?(?:di)?graph\b", text) and graph_body_start(text) != -1:
+        return extract_dot_code(text)
+    # Repair the patched code like freshly generated code
+    return extract_dot_code(apply_line_diff(dot_code, response_text))
@@ -0,0 +1,483 @@
+import re
+
+KEYWORDS = {"strict", "graph", "digraph", "subgraph", "node", "edge"}
+
+COLOR_ATTRIBUTES = r"(?:color|fillcolor|fontcolor|bgcolor|pencolor|labelfontcolor)"
+LABEL_ATTRIBUTES = r"(?:label|xlabel|headlabel|taillabel|tooltip)"
+
+_HEADER_RE = re.compile(r"(?i)\b(?:strict\s+)?(?:di)?graph\b(?:[ \t]+[^\s{};\[\]:]+)*\s*\{")
+_FENCE_RE = re.compile(r"(?m)^\s*```[\w-]*\s*$\n?")
+_VALID_ID_RE = re.compile(r"^(?:[A-Za-z_\u0080-\uffff][\w\u0080-\uffff]*|-?(?:\.\d+|\d+(?:\.\d*)?)|\"(?:[^\"\\]|\\.)*\")$")
+
+_TOKEN_RE = re.compile(r"""
+    (?P<ws>[ \t\r\f\v]+)
+  | (?P<newline>\n)
+  | (?P<comment>//[^\n]*|/\*.*?\*/)
+  | (?P<string>"(?:[^"\\]|\\.)*")
+  | (?P<edgeop>->|--)
+  | (?P<id>[A-Za-z_\u0080-\uffff][\w\u0080-\uffff]*|-?(?:\.\d+|\d+(?:\.\d*)?))
+  | (?P<punct>[{}\[\];,=:+])
+  | (?P<html><)
+  | (?P<unterminated>")
+  | (?P<other>.)
+""", re.S | re.X)
+
+
+class DotSyntaxError(ValueError):
+    pass
+
+
+class DotToken:
+    def __init__(self, kind, value, line, start=None):
+        self.kind = kind
+        self.value = value
+        self.line = line
+        # Offset of the token in the DOT code
+        self.start = start
+
+    @property
+    def end(self):
+        return self.start + len(self.value)
+
+
+def tokenize_dot(dot_code):
+    """
+    Split DOT code into tokens, skipping whitespace and comments.
+    :return: (tokens, issues) where issues lists lexical errors such as unterminated strings.
+    """
+    tokens, issues = [], []
+    line, pos = 1, 0
+    at_line_start = True
+    while pos < len(dot_code):
+        # '#' starts a preprocessor-style comment only at the beginning of a line
+        if at_line_start and dot_code[pos] == "#":
+            end = dot_code.find("\n", pos)
+            pos = len(dot_code) if end == -1 else end
+            continue
+
+        match = _TOKEN_RE.match(dot_code, pos)
+        kind, value = match.lastgroup, match.group()
+        if kind == "html":
+            end = _match_html(dot_code, pos)
+            if end == -1:
+                issues.append(f"line {line}: unterminated HTML label")
+                break
+            value = dot_code[pos:end]
+            kind = "string"
+        elif kind == "unterminated":
+            issues.append(f"line {line}: unterminated string")
+            break
+
+        if kind not in ("ws", "newline", "comment"):
+            tokens.append(DotToken(kind, value, line, pos))
+        line += value.count("\n")
+        at_line_start = kind == "newline" or (at_line_start and kind == "ws")
+        pos += len(value)
+    return tokens, issues
+
+
+def _match_html(dot_code, pos):
+    depth = 0
+    for index in range(pos, len(dot_code)):
+        if dot_code[index] == "<":
+            depth += 1
+        elif dot_code[index] == ">":
+            depth -= 1
+            if depth == 0:
+                return index + 1
+    return -1
+
+
+def lint_dot(dot_code):
+    """
+    Check DOT code for syntax errors without running Graphviz.
+    :param dot_code: DOT source to check.
+    :return: List of human readable issues; empty when no problem was found.
+    """
+    tokens, issues = tokenize_dot(dot_code)
+    if issues:
+        return issues
+    if not tokens:
+        return ["DOT code is empty"]
+
+    index = 0
+    if tokens[index].value.lower() == "strict":
+        index += 1
+    if index >= len(tokens) or tokens[index].value.lower() not in ("graph", "digraph"):
+        return [f"line {tokens[0].line}: DOT code must start with 'graph' or 'digraph'"]
+    directed = tokens[index].value.lower() == "digraph"
+    index += 1
+    if index < len(tokens) and tokens[index].kind in ("id", "string"):
+        index += 1
+    if index >= len(tokens) or tokens[index].value != "{":
+        line = tokens[min(index, len(tokens) - 1)].line
+        return [f"line {line}: graph name must be a single word followed by '{{'"]
+
+    stack = []
+    for position in range(index, len(tokens)):
+        token = tokens[position]
+        previous = tokens[position - 1] if position > 0 else None
+        following = tokens[position + 1] if position + 1 < len(tokens) else None
+
+        if token.value in ("{", "["):
+            stack.append(token)
+        elif token.value in ("}", "]"):
+            expected = "{" if token.value == "}" else "["
+            if not stack or stack[-1].value != expected:
+                issues.append(f"line {token.line}: unexpected '{token.value}'")
+                continue
+            stack.pop()
+            if not stack and following is not None:
+                issues.append(f"line {following.line}: unexpected content after the closing '}}' of the graph")
+                break
+        elif token.kind == "edgeop":
+            if directed and token.value == "--":
+                issues.append(f"line {token.line}: '--' used in a digraph; use '->'")
+            elif not directed and token.value == "->":
+                issues.append(f"line {token.line}: '->' used in an undirected graph; use '--'")
+            for neighbour in (previous, following):
+                if neighbour is not None and neighbour.kind == "id" and \
+                        neighbour.value.lower() in KEYWORDS - {"subgraph"}:
+                    issues.append(f"line {neighbour.line}: keyword '{neighbour.value}' used as a node name; quote it")
+        elif token.value == "=":
+            if previous is None or previous.kind not in ("id", "string"):
+                issues.append(f"line {token.line}: '=' without an attribute name")
+            if following is None or following.kind not in ("id", "string"):
+                issues.append(f"line {token.line}: attribute without a value")
+        elif token.value == "+":
+            if previous is None or previous.kind != "string" or following is None or following.kind != "string":
+                issues.append(f"line {token.line}: '+' is only allowed between quoted strings")
+        elif token.kind == "other":
+            issues.append(f"line {token.line}: unexpected character '{token.value}'; quote names and values that contain it")
+
+    for token in stack:
+        issues.append(f"line {token.line}: '{token.value}' is never closed")
+    return issues
+
+
+def strip_preamble(text):
+    """
+    Remove markdown fences and any prose before the graph header.
+    """
+    text = _FENCE_RE.sub("", text)
+    match = _HEADER_RE.search(text)
+    if match is None:
+        return text.strip()
+    return text[match.start():].strip()
+
+
+def graph_body_start(dot_code):
+    """
+    Index just after the '{' that opens the top-level graph, or -1 if there is no header.
+    """
+    match = _HEADER_RE.search(dot_code)
+    return match.end() if match else -1
+
+
+def _fix_graph_name(dot_code):
+    match = _HEADER_RE.match(dot_code)
+    if match is None:
+        return dot_code
+    header = match.group()
+    keyword = re.match(r"(?i)(?:strict\s+)?(?:di)?graph\b", header).group()
+    name = header[len(keyword):-1].strip()
+    if not name or _VALID_ID_RE.match(name):
+        return dot_code
+    name = re.sub(r"\W+", "", name)
+    new_header = f"{keyword} {name} {{" if name else f"{keyword} {{"
+    return new_header + dot_code[match.end():]
+
+
+def _fix_hex_colors(dot_code):
+    # color=4CAF50 / color="4CAF50" -> color="#4CAF50"
+    dot_code = re.sub(
+        rf"\b({COLOR_ATTRIBUTES})\s*=\s*(\"?)([0-9A-Fa-f]{{6}}(?:[0-9A-Fa-f]{{2}})?)\2(?=[\s,;\]])",
+        r'\1="#\3"',
+        dot_code,
+    )
+    # color=#4CAF50 is not a valid DOT ID unless quoted
+    return re.sub(
+        rf"\b({COLOR_ATTRIBUTES})\s*=\s*(#[0-9A-Fa-f]{{3,8}})(?=[\s,;\]])",
+        r'\1="\2"',
+        dot_code,
+    )
+
+
+def _fix_multiword_labels(dot_code):
+    def quote(match):
+        value = match.group(2).strip()
+        if " " not in value:
+            return match.group()
+        return f'{match.group(1)}="{value}"'
+
+    return re.sub(
+        rf"\b({LABEL_ATTRIBUTES})\s*=\s*(?![\"<\s])([^\"\[\]\n,;=]+?)(?=\s*[,;\]\n]|\s+\w+\s*=)",
+        quote,
+        dot_code,
+    )
+
+
+def _quote_multiword_operands(dot_code, trailing):
+    lines = []
+    for line in dot_code.split("\n"):
+        match = re.match(r"^(\s*)((?:[^\[\]{}=\"]|\"[^\"]*\")*?)(\s*(?:\[.*)?;?\s*)$", line)
+        head = match.group(2) if match else ""
+        operands = re.split(r"\s*(?:->|--)\s*", head)
+        # The operands of an edge, and a node with an attribute list, are one name each;
+        # a run of words on its own is a list of nodes
+        statement = len(operands) > 1 or match and match.group(3).lstrip().startswith("[")
+        named = operands if trailing or statement else []
+        bare = [operand for operand in named if not operand.startswith('"') and " " in operand]
+        if bare and all(re.fullmatch(r"[A-Za-z_]\w*(?: \w+)*|\"[^\"]*\"", operand) for operand in operands) and \
+                operands[0].split(" ")[0].lower() not in KEYWORDS:
+            edge_ops = re.findall(r"->|--", head)
+            quoted = [f'"{operand}"' if index < len(named) and operand in bare else operand
+                      for index, operand in enumerate(operands)]
+            rebuilt = quoted[0]
+            for edge_op, operand in zip(edge_ops, quoted[1:]):
+                rebuilt += f" {edge_op} {operand}"
+            line = match.group(1) + rebuilt + match.group(3)
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def _fix_multiword_node_names(dot_code):
+    """
+    Quote runs of bare words that are meant as one node name: the operands of an edge,
+    all of them alike, and a node with an attribute list. A run on its own (``A B C``)
+    is valid DOT listing separate nodes, so it is only quoted when the graph does not
+    parse otherwise.
+    """
+    repaired = _quote_multiword_operands(dot_code, trailing=False)
+    everywhere = _quote_multiword_operands(dot_code, trailing=True)
+    if everywhere != repaired and lint_dot(repaired) and not lint_dot(everywhere):
+        return everywhere
+    return repaired
+
+
+def _brace_positions(dot_code):
+    tokens = []
+    for match in re.finditer(r'"(?:[^"\\]|\\.)*"|[{}]', dot_code, re.S):
+        if match.group() in ("{", "}"):
+            tokens.append((match.start(), match.group()))
+    return tokens
+
+
+def _fix_braces(dot_code):
+    """
+    Drop stray closing braces that end the graph early, cut trailing text after the
+    graph and close any braces left open (e.g. by a truncated completion).
+    """
+    while True:
+        depth, closed_at = 0, None
+        for position, brace in _brace_positions(dot_code):
+            depth += 1 if brace == "{" else -1
+            if depth == 0:
+                closed_at = position
+                break
+        if closed_at is None:
+            break
+        rest = dot_code[closed_at + 1:]
+        if "}" in rest and re.search(r"->|--|\[|=", rest[:rest.rfind("}")]):
+            # The graph closes before its last statements: the brace is a stray
+            dot_code = dot_code[:closed_at] + rest
+            continue
+        dot_code = dot_code[:closed_at + 1]
+        break
+
+    depth = sum(1 if brace == "{" else -1 for _, brace in _brace_positions(dot_code))
+    if depth > 0:
+        dot_code = dot_code.rstrip() + "\n" + "}\n" * depth
+    return dot_code.strip()
+
+
+def repair_dot(dot_code):
+    """
+    Fix common mechanical errors in LLM generated DOT code without an LLM call:
+    markdown fences and preamble, graph names with spaces, hex colors without '#',
+    unquoted multi-word labels and node names, and unbalanced braces.
+    :param dot_code: DOT code as returned by the LLM.
+    :return: (repaired DOT code, list of repairs that were applied)
+    """
+    repairs = []
+    dot_code = dot_code.strip()
+    steps = [
+        ("removed markdown fences or preamble", strip_preamble),
+        ("removed spaces from graph name", _fix_graph_name),
+        ("added '#' to hex colors", _fix_hex_colors),
+        ("quoted multi-word labels", _fix_multiword_labels),
+        ("quoted multi-word node names", _fix_multiword_node_names),
+        ("balanced braces", _fix_braces),
+    ]
+    for description, step in steps:
+        repaired = step(dot_code)
+        if repaired != dot_code:
+            repairs.append(description)
+            dot_code = repaired
+    return dot_code, repairs
+
+
+def extract_dot_code(response_text):
+    """
+    Pull the DOT code out of an LLM response and repair it locally.
+    :param response_text: Raw completion text.
+    :return: DOT code.
+    """
+    dot_code = response_text.strip()
+    if not _HEADER_RE.search(dot_code):
+        print("Warning: Generated DOT code does not contain 'digraph' or 'graph'.")
+        return dot_code
+
+    dot_code, repairs = repair_dot(dot_code)
+    if repairs:
+        print(f"Repaired DOT code locally: {', '.join(repairs)}.")
+    return dot_code
+
+
+# A line that continues the graph: a node, edge or attribute statement. A bare word is
+# not enough, since a one-word line of prose ("Done") looks just like a node statement
+_STATEMENT_RE = re.compile(r"""^\s*(?:"(?:[^"\\]|\\.)*"|[\w.\u0080-\uffff]+)\s*(?:->|--|\[|=|;)""")
+
+
+class DotStreamExtractor:
+    def __init__(self):
+        """
+        Finds the end of the graph in a streamed completion, so the stream can be closed
+        as soon as the top-level graph body is balanced instead of paying for the prose
+        or markdown models tend to add after it. Text before the graph header (preamble,
+        fences) is skipped; braces inside strings, HTML labels and comments are ignored.
+        """
+        self.text = ""
+        self.complete = False
+        self._start = None
+        self._pos = 0
+        self._depth = 0
+        self._mode = None
+        self._html_depth = 0
+        self._escaped = False
+        self._closed_at = None
+
+    def feed(self, chunk):
+        """
+        Add the next chunk of the completion.
+        :return: True once the graph is complete and the rest of the stream can be dropped.
+        """
+        self.text += chunk
+        if self.complete:
+            return True
+        if self._start is None:
+            match = _HEADER_RE.search(self.text)
+            if match is None:
+                return False
+            self._start, self._pos, self._depth = match.start(), match.end(), 1
+        while not self.complete:
+            if self._closed_at is not None:
+                if not self._decide_close(final=False):
+                    return False
+                continue
+            if not self._scan():
+                return False
+        return True
+
+    def _scan(self):
+        """
+        Advance through the received text until the top-level brace closes.
+        :return: False when more text is needed.
+        """
+        text = self.text
+        while self._pos < len(text):
+            char = text[self._pos]
+            if self._mode == "string":
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._mode = None
+            elif self._mode == "line_comment":
+                if char == "\n":
+                    self._mode = None
+            elif self._mode == "block_comment":
+                if char == "*":
+                    if self._pos + 1 >= len(text):
+                        return False
+                    if text[self._pos + 1] == "/":
+                        self._mode = None
+                        self._pos += 1
+            elif self._mode == "html":
+                self._html_depth += {"<": 1, ">": -1}.get(char, 0)
+                if self._html_depth == 0:
+                    self._mode = None
+            elif char == '"':
+                self._mode = "string"
+            elif char == "<":
+                self._mode, self._html_depth = "html", 1
+            elif char == "/":
+                if self._pos + 1 >= len(text):
+                    return False
+                following = text[self._pos + 1]
+                if following in "/*":
+                    self._mode = "line_comment" if following == "/" else "block_comment"
+                    self._pos += 1
+            elif char == "{":
+                self._depth += 1
+            elif char == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._closed_at = self._pos
+                    self._pos += 1
+                    return True
+            self._pos += 1
+        return False
+
+    def _decide_close(self, final):
+        """
+        Whether the brace that balanced the graph really ends it. Like repair_dot, a
+        brace followed by more statements is taken as a stray and scanning goes on;
+        this needs the first line after it, so it may have to wait for more text.
+        :return: False when more text is needed.
+        """
+        rest = self.text[self._closed_at + 1:].lstrip()
+        line, newline, _ = rest.partition("\n")
+        if not final and not newline and len(rest) < 200 and not rest.startswith("`"):
+            return False
+        if line and not rest.startswith("`") and _STATEMENT_RE.match(line):
+            self._closed_at, self._depth = None, 1
+        else:
+            self.complete = True
+        return True
+
+    @property
+    def dot_code(self):
+        """
+        The graph as far as it was received: up to its closing brace once complete,
+        otherwise all text, for extract_dot_code to repair.
+        """
+        if not self.complete and self._closed_at is not None:
+            self._decide_close(final=True)
+        if self.complete:
+            return self.text[self._start:self._closed_at + 1]
+        return self.text
+
+
+def dot_code_parses(dot_code):
+    """
+    Whether DOT code passes the syntax check once repaired locally. Quiet, for racing candidates.
+    """
+    return not lint_dot(repair_dot(dot_code)[0])
+
+
+def check_dot_code(dot_code):
+    """
+    Repair DOT code locally and make sure the result parses.
+    :param dot_code: Candidate DOT code.
+    :return: Repaired DOT code.
+    :raises DotSyntaxError: If errors remain that need an LLM fix round.
+    """
+    dot_code, repairs = repair_dot(dot_code)
+    if repairs:
+        print(f"Repaired DOT code locally: {', '.join(repairs)}.")
+    issues = lint_dot(dot_code)
+    if issues:
+        raise DotSyntaxError("DOT syntax check failed: " + "; ".join(issues))
+    return dot_code
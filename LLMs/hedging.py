@@ -0,0 +1,234 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dotenv import load_dotenv
+from metrics import HEDGE_REQUESTS
+from resilience import submit_in_context
+
+load_dotenv()
+
+# Hedged calls run here so the caller can wait on whichever backend answers first
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("HEDGE_MAX_WORKERS", "16")),
+    thread_name_prefix="hedge",
+)
+
+
+class LatencyTracker:
+    def __init__(self, window=None, initial_delay=None, percentile=None, min_delay=None, max_delay=None):
+        """
+        Rolling per-backend latency samples that decide how long to wait before hedging.
+        :param window: Samples kept per backend.
+        :param initial_delay: Hedge delay until a backend has enough samples.
+        :param percentile: Latency percentile of the primary backend used as hedge delay.
+        :param min_delay: Lower bound of the hedge delay, so fast backends are not doubled up.
+        :param max_delay: Upper bound of the hedge delay.
+        """
+        self.window = window or int(os.getenv("HEDGE_LATENCY_WINDOW", "200"))
+        self.initial_delay = initial_delay or float(os.getenv("HEDGE_DELAY", "3"))
+        self.percentile = percentile or float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+        self.min_delay = min_delay if min_delay is not None else float(os.getenv("HEDGE_MIN_DELAY", "0.5"))
+        self.max_delay = max_delay or float(os.getenv("HEDGE_MAX_DELAY", "15"))
+        self._lock = threading.Lock()
+        self._samples = {}
+
+    def record(self, backend, seconds):
+        with self._lock:
+            samples = self._samples.get(backend)
+            if samples is None:
+                samples = self._samples[backend] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def quantile(self, backend, fraction):
+        with self._lock:
+            samples = sorted(self._samples.get(backend, ()))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+    def hedge_delay(self, backend):
+        """
+        Seconds to give a backend before a hedge request is sent: its recent tail latency,
+        so only the slowest calls get hedged.
+        """
+        with self._lock:
+            enough = len(self._samples.get(backend, ())) >= 20
+        delay = self.quantile(backend, self.percentile) if enough else self.initial_delay
+        return min(self.max_delay, max(self.min_delay, delay))
+
+    def stats(self):
+        with self._lock:
+            backends = list(self._samples)
+        return {
+            backend: {
+                "p50": self.quantile(backend, 0.5),
+                "p95": self.quantile(backend, 0.95),
+                "hedge_delay": round(self.hedge_delay(backend), 3),
+            }
+            for backend in backends
+        }
+
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+def get_latency_tracker():
+    global _tracker
+    with _tracker_lock:
+        if _tracker is None:
+            _tracker = LatencyTracker()
+        return _tracker
+
+
+def parse_hedge_backends(spec):
+    """
+    Parse DOT_HEDGE_BACKENDS, e.g. "groq" or "openrouter:google/gemini-flash-1.5,groq".
+    :return: List of (provider, model or None) tuples; None means the handler's default model.
+    """
+    backends = []
+    for item in (spec or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        provider, _, model = item.partition(":")
+        if provider not in ("openrouter", "groq"):
+            raise ValueError(f"Unknown hedge backend '{item}'. Use 'groq', 'groq:<model>' or 'openrouter:<model>'.")
+        backends.append((provider, model or None))
+    return backends
+
+
+def _timed(tracker, name, call):
+    start = time.perf_counter()
+    result = call()
+    tracker.record(name, time.perf_counter() - start)
+    return result
+
+
+def hedged_call(backends, accept, tracker=None):
+    """
+    Call the first backend; whenever the current one is slower than its hedge delay,
+    fails, or returns something accept() rejects, start the next one. The first
+    accepted result wins and calls that have not started yet are cancelled; calls
+    already on the wire cannot be interrupted, so their results are dropped.
+    :param backends: List of (name, zero-argument callable), primary first.
+    :param accept: Predicate deciding whether a result is usable.
+    :return: The first accepted result, else the first result, else the first error is raised.
+    """
+    tracker = tracker or get_latency_tracker()
+    if len(backends) == 1:
+        name, call = backends[0]
+        return _timed(tracker, name, call)
+
+    pending = {}
+    launched = 0
+    fallback, errors = None, []
+
+    def launch():
+        nonlocal launched
+        name, call = backends[launched]
+        launched += 1
+        HEDGE_REQUESTS.inc(backend=name, outcome="launched")
+        pending[submit_in_context(_executor, _timed, tracker, name, call)] = name
+        return time.monotonic() + tracker.hedge_delay(name)
+
+    hedge_at = launch()
+    while pending or launched < len(backends):
+        if not pending:
+            hedge_at = launch()
+            continue
+        timeout = max(0.0, hedge_at - time.monotonic()) if launched < len(backends) else None
+        done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        if not done:
+            hedge_at = launch()
+            continue
+
+        for future in done:
+            name = pending.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                errors.append(e)
+                continue
+            if accept(result):
+                HEDGE_REQUESTS.inc(backend=name, outcome="won")
+                for other in pending:
+                    other.cancel()
+                    HEDGE_REQUESTS.inc(backend=pending[other], outcome="abandoned")
+                return result
+            if fallback is None:
+                fallback = result
+        # A failed or rejected answer: hedge right away instead of waiting out the delay
+        hedge_at = time.monotonic()
+
+    if fallback is not None:
+        return fallback
+    raise errors[0]
+
+
+async def _atimed(tracker, name, call):
+    start = time.perf_counter()
+    result = await call()
+    tracker.record(name, time.perf_counter() - start)
+    return result
+
+
+async def ahedged_call(backends, accept, tracker=None):
+    """
+    Asyncio variant of hedged_call; backends are zero-argument coroutine functions.
+    Losing calls are cancelled, which also aborts their HTTP requests.
+    """
+    tracker = tracker or get_latency_tracker()
+    if len(backends) == 1:
+        name, call = backends[0]
+        return await _atimed(tracker, name, call)
+
+    pending = {}
+    launched = 0
+    fallback, errors = None, []
+
+    def launch():
+        nonlocal launched
+        name, call = backends[launched]
+        launched += 1
+        HEDGE_REQUESTS.inc(backend=name, outcome="launched")
+        pending[asyncio.ensure_future(_atimed(tracker, name, call))] = name
+        return time.monotonic() + tracker.hedge_delay(name)
+
+    try:
+        hedge_at = launch()
+        while pending or launched < len(backends):
+            if not pending:
+                hedge_at = launch()
+                continue
+            timeout = max(0.0, hedge_at - time.monotonic()) if launched < len(backends) else None
+            done, _ = await asyncio.wait(list(pending), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                hedge_at = launch()
+                continue
+
+            for task in done:
+                name = pending.pop(task)
+                try:
+                    result = task.result()
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                if accept(result):
+                    HEDGE_REQUESTS.inc(backend=name, outcome="won")
+                    return result
+                if fallback is None:
+                    fallback = result
+            hedge_at = time.monotonic()
+    finally:
+        # Also runs when the caller is cancelled, so no task outlives the request
+        for task, name in pending.items():
+            task.cancel()
+            HEDGE_REQUESTS.inc(backend=name, outcome="abandoned")
+
+    if fallback is not None:
+        return fallback
+    raise errors[0]
@@ -0,0 +1,331 @@
+import ipaddress
+import json
+import os
+import queue
+import socket
+import sqlite3
+import threading
+import time
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from dotenv import load_dotenv
+from metrics import JOB_DURATION, JOBS_FINISHED
+from resilience import CircuitOpenError, DeadlineExceededError, backoff_delay, request_deadline
+
+load_dotenv()
+
+QUEUED, RUNNING, SUCCEEDED, FAILED = "queued", "running", "succeeded", "failed"
+
+
+class JobQueueFullError(RuntimeError):
+    def __init__(self, message, retry_after=5):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Job:
+    FIELDS = ("id", "status", "created_at", "started_at", "finished_at", "result_id", "error", "error_status",
+              "callback_url")
+
+    def __init__(self, id, status=QUEUED, created_at=None, started_at=None, finished_at=None, result_id=None,
+                 error=None, error_status=None, callback_url=None):
+        """
+        State of one background pipeline run. The result itself lives in the result
+        cache under result_id, so it is served like any other render.
+        """
+        self.id = id
+        self.status = status
+        self.created_at = created_at or time.time()
+        self.started_at = started_at
+        self.finished_at = finished_at
+        self.result_id = result_id
+        self.error = error
+        # HTTP status the synchronous endpoint would have answered with
+        self.error_status = error_status
+        self.callback_url = callback_url
+
+    @property
+    def finished(self):
+        return self.status in (SUCCEEDED, FAILED)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+
+class MemoryJobStore:
+    def __init__(self, ttl=None):
+        """
+        Jobs of this worker process only: with several workers, poll with sticky
+        sessions or use SQLiteJobStore.
+        :param ttl: Seconds after which finished jobs are forgotten.
+        """
+        self.ttl = ttl or float(os.getenv("JOB_TTL", "86400"))
+        self._lock = threading.Lock()
+        self._jobs = {}
+
+    def save(self, job):
+        with self._lock:
+            self._jobs[job.id] = Job(**job.to_dict())
+            expired = [job_id for job_id, stored in self._jobs.items()
+                       if stored.finished and stored.finished_at < time.time() - self.ttl]
+            for job_id in expired:
+                del self._jobs[job_id]
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return Job(**job.to_dict()) if job is not None else None
+
+
+class SQLiteJobStore:
+    def __init__(self, db_path, ttl=None):
+        """
+        Jobs in a SQLite file shared by the workers of one host, so any worker can answer
+        a poll. Results are only visible to all of them when the result cache has its
+        SQLite tier (RESULT_CACHE_DB) as well.
+        """
+        self.ttl = ttl or float(os.getenv("JOB_TTL", "86400"))
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=10)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY, status TEXT, created_at REAL, started_at REAL, finished_at REAL,"
+            " result_id TEXT, error TEXT, error_status INTEGER, callback_url TEXT)"
+        )
+        self._db.commit()
+
+    def save(self, job):
+        with self._lock:
+            self._db.execute(
+                f"INSERT OR REPLACE INTO jobs ({', '.join(Job.FIELDS)}) VALUES ({', '.join('?' * len(Job.FIELDS))})",
+                [getattr(job, name) for name in Job.FIELDS],
+            )
+            self._db.execute("DELETE FROM jobs WHERE finished_at < ?", (time.time() - self.ttl,))
+            self._db.commit()
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._db.execute(f"SELECT {', '.join(Job.FIELDS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return Job(**dict(zip(Job.FIELDS, row))) if row is not None else None
+
+
+def error_status(error):
+    """
+    HTTP status /api/analyze answers with for a pipeline error.
+    """
+    from admission import AdmissionError
+    from renderer import RenderBusyError, RenderLimitError
+
+    if isinstance(error, AdmissionError):
+        return 429
+    if isinstance(error, (RenderBusyError, CircuitOpenError)):
+        return 503
+    if isinstance(error, RenderLimitError):
+        return 422
+    if isinstance(error, DeadlineExceededError):
+        return 504
+    return 500
+
+
+def validate_callback_url(url):
+    """
+    Callbacks are POSTed from inside the deployment, so they must not reach its own
+    network: hosts resolving to loopback, private, link-local (such as the cloud
+    metadata service at 169.254.169.254) or other non-public addresses are refused
+    unless listed in JOB_CALLBACK_HOSTS.
+    :raises ValueError: The URL is not http(s), its host is not in JOB_CALLBACK_HOSTS
+        (when set), or it does not resolve to public addresses only.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        raise ValueError("callback_url must be an http or https URL")
+    host = parsed.hostname.lower()
+    allowed = [name.strip().lower() for name in os.getenv("JOB_CALLBACK_HOSTS", "").split(",") if name.strip()]
+    if allowed and host not in allowed:
+        raise ValueError(f"callback_url host '{parsed.hostname}' is not allowed")
+    if host in allowed:
+        return
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, parsed.port or None, proto=socket.IPPROTO_TCP)}
+    except (socket.gaierror, UnicodeError):
+        raise ValueError(f"callback_url host '{parsed.hostname}' does not resolve")
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split("%")[0])
+        if not ip.is_global or ip.is_multicast:
+            raise ValueError(f"callback_url host '{parsed.hostname}' is not a public address")
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    # A redirect could point a validated callback at an internal address
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+_callback_opener = urllib.request.build_opener(_NoRedirect)
+
+
+class JobRunner:
+    def __init__(self, store, workers=None, max_queued=None, deadline=None):
+        """
+        Runs submitted work on a fixed pool of threads, so long renders and fix rounds
+        no longer hold an HTTP connection. Threads rather than processes: jobs share
+        the worker's LLM connection pool, render pool and in-memory result cache, and
+        spend their time waiting on I/O and on dot subprocesses anyway.
+        :param store: MemoryJobStore or SQLiteJobStore.
+        :param workers: Jobs run at the same time (JOB_WORKERS, default 4).
+        :param max_queued: Jobs allowed to wait; submit fails beyond it (JOB_QUEUE_SIZE, default 100).
+        :param deadline: Time budget of one job in seconds (JOB_DEADLINE, default 600).
+        """
+        self.store = store
+        self.workers = workers or int(os.getenv("JOB_WORKERS", "4"))
+        self.max_queued = max_queued or int(os.getenv("JOB_QUEUE_SIZE", "100"))
+        self.deadline = deadline or float(os.getenv("JOB_DEADLINE", "600"))
+        self._queue = queue.Queue(maxsize=self.max_queued)
+        self._lock = threading.Lock()
+        self._threads = []
+        self.running = 0
+        # Callbacks retry with backoff; delivering them here keeps them off the job threads and
+        # off the event loop of the ASGI app, where completed() is called
+        self._callbacks = ThreadPoolExecutor(
+            max_workers=int(os.getenv("JOB_CALLBACK_WORKERS", "2")), thread_name_prefix="job-callback"
+        )
+
+    def _start_threads(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name=f"job-{len(self._threads)}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, fn, callback_url=None):
+        """
+        Queue fn to run in the background.
+        :param fn: Zero-argument callable returning the result cache key of its result.
+        :param callback_url: URL that receives the finished job as a JSON POST.
+        :return: The queued Job.
+        :raises JobQueueFullError: max_queued jobs are already waiting.
+        """
+        job = Job(uuid.uuid4().hex, callback_url=callback_url)
+        self.store.save(job)
+        try:
+            self._queue.put_nowait((job, fn))
+        except queue.Full:
+            job.status, job.finished_at = FAILED, time.time()
+            job.error, job.error_status = "Job queue is full", 503
+            self.store.save(job)
+            JOBS_FINISHED.inc(status="rejected")
+            raise JobQueueFullError("Job queue is full, please retry shortly.")
+        self._start_threads()
+        return job
+
+    def completed(self, result_id, callback_url=None):
+        """
+        Record a job whose result is already cached, without queueing it.
+        """
+        job = Job(uuid.uuid4().hex, status=SUCCEEDED, result_id=result_id, callback_url=callback_url)
+        job.started_at = job.finished_at = job.created_at
+        self.store.save(job)
+        JOBS_FINISHED.inc(status=SUCCEEDED)
+        if callback_url:
+            self._callbacks.submit(self._notify, job)
+        return job
+
+    def _work(self):
+        while True:
+            job, fn = self._queue.get()
+            with self._lock:
+                self.running += 1
+            job.status, job.started_at = RUNNING, time.time()
+            self.store.save(job)
+            try:
+                with request_deadline(self.deadline):
+                    job.result_id = fn()
+                job.status = SUCCEEDED
+            except Exception as e:
+                print(f"Job {job.id} failed: {e}")
+                job.status, job.error, job.error_status = FAILED, str(e), error_status(e)
+            finally:
+                job.finished_at = time.time()
+                self.store.save(job)
+                with self._lock:
+                    self.running -= 1
+                JOBS_FINISHED.inc(status=job.status)
+                JOB_DURATION.observe(job.started_at - job.created_at, phase="queued")
+                JOB_DURATION.observe(job.finished_at - job.started_at, phase="running")
+                self._queue.task_done()
+            if job.callback_url:
+                self._callbacks.submit(self._notify, job)
+
+    def _notify(self, job):
+        """
+        POST the finished job to its callback URL, retrying with backoff on failure.
+        """
+        retries = int(os.getenv("JOB_CALLBACK_RETRIES", "3"))
+        body = json.dumps(job_body(job)).encode("utf-8")
+        for attempt in range(retries + 1):
+            try:
+                # Again at delivery, in case the host now resolves elsewhere
+                validate_callback_url(job.callback_url)
+            except ValueError as e:
+                print(f"Callback for job {job.id} not sent: {e}")
+                return
+            request = urllib.request.Request(
+                job.callback_url, data=body, method="POST", headers={"Content-Type": "application/json"}
+            )
+            try:
+                with _callback_opener.open(request, timeout=float(os.getenv("JOB_CALLBACK_TIMEOUT", "10"))):
+                    return
+            except Exception as e:
+                if attempt == retries:
+                    print(f"Callback for job {job.id} to {job.callback_url} failed: {e}")
+                    return
+                time.sleep(backoff_delay(attempt))
+
+    def stats(self):
+        with self._lock:
+            return {"queued": self._queue.qsize(), "running": self.running, "workers": self.workers}
+
+
+def job_body(job):
+    """
+    JSON body for GET /api/jobs/<id> and callbacks: the job, plus the result metadata
+    of /api/analyze once it succeeded and the result is still cached.
+    """
+    from negotiation import result_metadata
+    from result_cache import get_result_cache
+
+    body = job.to_dict()
+    body["url"] = f"/api/jobs/{job.id}"
+    if job.status == SUCCEEDED:
+        result = get_result_cache().get(job.result_id)
+        if result is not None:
+            body["result"] = result_metadata(job.result_id, result)
+    return body
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+def get_job_runner():
+    """
+    The worker's JobRunner, with a SQLite job store when JOB_DB is set.
+    """
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            db_path = os.getenv("JOB_DB")
+            _runner = JobRunner(SQLiteJobStore(db_path) if db_path else MemoryJobStore())
+        return _runner
+
+
+def job_stats():
+    """
+    Stats of the worker's JobRunner, or None before the first job.
+    """
+    with _runner_lock:
+        runner = _runner
+    return runner.stats() if runner is not None else None
@@ -0,0 +1,326 @@
+import asyncio
+import math
+import os
+import re
+import shlex
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from dotenv import load_dotenv
+from dot_lint import KEYWORDS, graph_body_start, tokenize_dot
+from metrics import LAYOUT_SELECTIONS, stage_timer
+from renderer import get_render_pool, render_dot, render_dot_async
+from resilience import submit_in_context
+
+load_dotenv()
+
+ENGINES = ("dot", "neato", "fdp", "sfdp", "circo", "twopi", "osage", "patchwork")
+
+# Layout attributes of the graph; quoted strings are matched first so labels are never touched
+_LAYOUT_ATTRIBUTE_RE = re.compile(r'("(?:[^"\\]|\\.)*")|(?i:\blayout\s*=\s*"?(\w+)"?\s*[;,]?)', re.S)
+
+# Speculative layouts run here; the render pool still bounds the dot processes to its slots
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("LAYOUT_MAX_WORKERS", "8")),
+    thread_name_prefix="layout",
+)
+
+# Relative weight of each layout metric in the score; lower scores are better
+WEIGHTS = {"crossings": 1.0, "overlaps": 2.0, "aspect": 0.5, "whitespace": 0.3, "time": 0.5}
+
+
+def declared_layout(dot_code):
+    """
+    The engine named by the graph's layout attribute, or None.
+    """
+    for match in _LAYOUT_ATTRIBUTE_RE.finditer(dot_code):
+        if match.group(2) and match.group(2).lower() in ENGINES:
+            return match.group(2).lower()
+    return None
+
+
+def with_layout(dot_code, engine):
+    """
+    DOT code that lays out with engine: Graphviz prefers the layout attribute over -K,
+    so existing ones are replaced by a single one on the line of the graph's '{', keeping
+    the line numbers of the rest.
+    """
+    dot_code = _LAYOUT_ATTRIBUTE_RE.sub(lambda match: match.group(1) or "\n" * match.group().count("\n"), dot_code)
+    body_start = graph_body_start(dot_code)
+    if body_start == -1:
+        return dot_code
+    return f"{dot_code[:body_start]} layout={engine};{dot_code[body_start:]}"
+
+
+def _bucket(value):
+    # 0, 1, 2-3, 4-7, 8-15, ...
+    return value.bit_length()
+
+
+def graph_shape(dot_code):
+    """
+    Coarse structure of a graph, used as the key of the winning engine: graphs of the
+    same shape tend to suit the same engine, whatever their labels say.
+    :return: Tuple (directed, node bucket, edge bucket, max degree bucket, has clusters).
+    """
+    tokens, _ = tokenize_dot(dot_code)
+    directed = any(token.value.lower() == "digraph" for token in tokens[:2])
+    nodes, degree, edges, clusters = set(), {}, 0, False
+    for index, token in enumerate(tokens):
+        if token.kind == "edgeop":
+            edges += 1
+            for neighbour in (tokens[index - 1], tokens[index + 1] if index + 1 < len(tokens) else None):
+                if neighbour is not None and neighbour.kind in ("id", "string"):
+                    nodes.add(neighbour.value)
+                    degree[neighbour.value] = degree.get(neighbour.value, 0) + 1
+        elif token.kind in ("id", "string") and token.value.lower() not in KEYWORDS:
+            following = tokens[index + 1] if index + 1 < len(tokens) else None
+            previous = tokens[index - 1] if index > 0 else None
+            statement_start = previous is None or previous.value in ("{", ";", "}", "]")
+            if statement_start and (following is None or following.value in ("[", ";", "}")):
+                nodes.add(token.value)
+        elif token.value.lower() == "subgraph":
+            following = tokens[index + 1] if index + 1 < len(tokens) else None
+            clusters = clusters or (following is not None and following.value.strip('"').startswith("cluster"))
+    return (directed, _bucket(len(nodes)), _bucket(edges), _bucket(max(degree.values(), default=0)), clusters)
+
+
+def parse_plain(plain):
+    """
+    Parse Graphviz -Tplain output.
+    :return: (width, height, {node: (x, y, width, height)}, [(tail, head, [(x, y), ...])])
+    :raises ValueError: The output is not in plain format.
+    """
+    width = height = None
+    nodes, edges = {}, []
+    for line in plain.decode("utf-8", "replace").splitlines():
+        fields = shlex.split(line)
+        if not fields:
+            continue
+        if fields[0] == "graph":
+            width, height = float(fields[2]), float(fields[3])
+        elif fields[0] == "node":
+            nodes[fields[1]] = tuple(float(value) for value in fields[2:6])
+        elif fields[0] == "edge":
+            count = int(fields[3])
+            values = [float(value) for value in fields[4:4 + 2 * count]]
+            edges.append((fields[1], fields[2], list(zip(values[::2], values[1::2]))))
+    if width is None:
+        raise ValueError("Not Graphviz plain output")
+    return width, height, nodes, edges
+
+
+def _crosses(a, b, c, d):
+    def orientation(p, q, r):
+        return (q[0] - p[0]) * (r[1] - p[1]) - (q[1] - p[1]) * (r[0] - p[0])
+
+    return (orientation(a, b, c) * orientation(a, b, d) < 0) and (orientation(c, d, a) * orientation(c, d, b) < 0)
+
+
+def edge_crossings(edges, limit=None):
+    """
+    Crossings between edges that share no node, with each spline reduced to the
+    polyline through its Bezier end points. Only the first `limit` edges are compared.
+    """
+    limit = limit or int(os.getenv("LAYOUT_MAX_EDGES", "200"))
+    polylines = [(tail, head, points[::3] or points) for tail, head, points in edges[:limit]]
+    crossings = 0
+    for index, (tail, head, points) in enumerate(polylines):
+        segments = list(zip(points, points[1:]))
+        for other_tail, other_head, other_points in polylines[index + 1:]:
+            if {tail, head} & {other_tail, other_head}:
+                continue
+            other_segments = list(zip(other_points, other_points[1:]))
+            if any(_crosses(a, b, c, d) for a, b in segments for c, d in other_segments):
+                crossings += 1
+    return crossings
+
+
+def node_overlaps(nodes, limit=300):
+    boxes = list(nodes.values())[:limit]
+    overlaps = 0
+    for index, (x, y, width, height) in enumerate(boxes):
+        for other_x, other_y, other_width, other_height in boxes[index + 1:]:
+            if abs(x - other_x) * 2 < width + other_width and abs(y - other_y) * 2 < height + other_height:
+                overlaps += 1
+    return overlaps
+
+
+def score_layout(plain, seconds, budget):
+    """
+    Cheap quality score of a layout; lower is better.
+    :param plain: Graphviz -Tplain output of the layout.
+    :param seconds: Time the layout took.
+    :param budget: Time limit of the layout.
+    :return: (score, metrics dict)
+    """
+    width, height, nodes, edges = parse_plain(plain)
+    node_area = sum(box[2] * box[3] for box in nodes.values()) or 1e-6
+    target_aspect = float(os.getenv("LAYOUT_TARGET_ASPECT", "1.33"))
+    aspect = width / height if width and height else 1.0
+    metrics = {
+        "crossings": edge_crossings(edges) / max(1, len(edges)),
+        "overlaps": node_overlaps(nodes) / max(1, len(nodes)),
+        # Within 1.5x of the target aspect ratio is free, beyond it the log of the excess counts
+        "aspect": max(0.0, abs(math.log(aspect / target_aspect)) - math.log(1.5)),
+        # Canvas beyond four times the node area is whitespace
+        "whitespace": max(0.0, math.log(max(width * height, 1e-6) / node_area) - math.log(4)),
+        "time": seconds / budget,
+    }
+    return sum(WEIGHTS[name] * value for name, value in metrics.items()), metrics
+
+
+class LayoutChoice:
+    def __init__(self, engine, source, score=None, metrics=None):
+        """
+        :param source: declared, cache or speculative.
+        """
+        self.engine = engine
+        self.source = source
+        self.score = score
+        self.metrics = metrics or {}
+
+
+class LayoutSelector:
+    def __init__(self, engines=None, timeout=None, cache_size=None):
+        """
+        Picks a layout engine per graph by laying it out with several engines at once
+        (as -Tplain, which skips rasterization), scoring each layout on edge crossings,
+        node overlaps, aspect ratio, whitespace and time, and keeping the best. The
+        winner is remembered per graph shape, so later graphs of that shape take it
+        without speculating.
+        :param engines: Candidate engines in order of preference (LAYOUT_ENGINES, default
+            dot,neato,fdp,sfdp,circo,twopi); the graph's declared layout always comes first.
+        :param timeout: Time budget of each candidate in seconds (LAYOUT_TIMEOUT, default 3).
+        :param cache_size: Graph shapes remembered (LAYOUT_CACHE_SIZE, default 1024).
+        """
+        engines = engines or os.getenv("LAYOUT_ENGINES", "dot,neato,fdp,sfdp,circo,twopi").split(",")
+        self.engines = [engine.strip() for engine in engines if engine.strip() in ENGINES]
+        self.timeout = timeout or float(os.getenv("LAYOUT_TIMEOUT", "3"))
+        self.cache_size = cache_size or int(os.getenv("LAYOUT_CACHE_SIZE", "1024"))
+        self._lock = threading.Lock()
+        self._winners = OrderedDict()
+
+    def candidates(self, dot_code):
+        """
+        The declared engine, then the others in order: as many as the render pool has
+        slots (at least two), so speculation runs in parallel without queueing.
+        """
+        declared = declared_layout(dot_code) or "dot"
+        engines = [declared] + [engine for engine in self.engines if engine != declared]
+        return engines[:max(2, get_render_pool().max_concurrent)]
+
+    def cached(self, shape):
+        with self._lock:
+            engine = self._winners.get(shape)
+            if engine is not None:
+                self._winners.move_to_end(shape)
+            return engine
+
+    def remember(self, shape, engine):
+        with self._lock:
+            self._winners[shape] = engine
+            self._winners.move_to_end(shape)
+            while len(self._winners) > self.cache_size:
+                self._winners.popitem(last=False)
+
+    def _busy(self):
+        # Speculation multiplies render work; under load every graph gets one layout
+        return get_render_pool().stats()["waiting"] > 0
+
+    def _precheck(self, dot_code):
+        """
+        :return: (shape, LayoutChoice when no speculation is needed, else None)
+        """
+        shape = graph_shape(dot_code)
+        engine = self.cached(shape)
+        if engine is not None:
+            return shape, LayoutChoice(engine, "cache")
+        if self._busy():
+            return shape, LayoutChoice(declared_layout(dot_code) or "dot", "declared")
+        return shape, None
+
+    def _pick(self, shape, dot_code, results):
+        """
+        :param results: List of (engine, plain output or None, seconds), in candidate order.
+        """
+        best = None
+        for engine, plain, seconds in results:
+            if plain is None:
+                continue
+            try:
+                score, metrics = score_layout(plain, seconds, self.timeout)
+            except ValueError:
+                continue
+            # Ties go to the earlier candidate, i.e. the declared layout
+            if best is None or score < best.score:
+                best = LayoutChoice(engine, "speculative", score, metrics)
+        if best is None:
+            # Every candidate failed; the real render reports the error
+            return LayoutChoice(declared_layout(dot_code) or "dot", "declared")
+        self.remember(shape, best.engine)
+        return best
+
+    def _layout(self, dot_code, engine):
+        start = time.perf_counter()
+        try:
+            plain = render_dot(with_layout(dot_code, engine), image_format="plain", engine=engine, timeout=self.timeout)
+        except Exception as e:
+            print(f"Speculative '{engine}' layout failed: {e}")
+            return engine, None, None
+        return engine, plain, time.perf_counter() - start
+
+    def select(self, dot_code):
+        """
+        Choose the layout engine for DOT code that is known to parse.
+        :return: LayoutChoice.
+        """
+        shape, choice = self._precheck(dot_code)
+        if choice is None:
+            with stage_timer("layout_select"):
+                futures = [submit_in_context(_executor, self._layout, dot_code, engine)
+                           for engine in self.candidates(dot_code)]
+                wait(futures)
+                choice = self._pick(shape, dot_code, [future.result() for future in futures])
+        LAYOUT_SELECTIONS.inc(engine=choice.engine, source=choice.source)
+        return choice
+
+    async def _alayout(self, dot_code, engine):
+        start = time.perf_counter()
+        try:
+            plain = await render_dot_async(with_layout(dot_code, engine), image_format="plain", engine=engine,
+                                           timeout=self.timeout)
+        except Exception as e:
+            print(f"Speculative '{engine}' layout failed: {e}")
+            return engine, None, None
+        return engine, plain, time.perf_counter() - start
+
+    async def aselect(self, dot_code):
+        """
+        Asyncio variant of select.
+        """
+        shape, choice = self._precheck(dot_code)
+        if choice is None:
+            with stage_timer("layout_select"):
+                results = await asyncio.gather(*(self._alayout(dot_code, engine)
+                                                 for engine in self.candidates(dot_code)))
+                choice = self._pick(shape, dot_code, results)
+        LAYOUT_SELECTIONS.inc(engine=choice.engine, source=choice.source)
+        return choice
+
+    def stats(self):
+        with self._lock:
+            return {"shapes": len(self._winners), "engines": self.engines}
+
+
+_selector = None
+_selector_lock = threading.Lock()
+
+
+def get_layout_selector():
+    global _selector
+    with _selector_lock:
+        if _selector is None:
+            _selector = LayoutSelector()
+        return _selector
@@ -1,13 +1,96 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
-#from groq_handler import GrokHandler
-#from openrouter_llms import QueryHandler
 from router_groq_llms import GrokHandler
-import base64
-import os
+from pipeline import (cached_stream_events, run_pipeline, run_refinement, sse_event, stream_event_to_sse,
+                      stream_pipeline)
+from result_cache import CachedResult, get_result_cache, handler_cache_key, refine_cache_key
+from renderer import RenderBusyError, RenderLimitError
+from render_profiles import profile_from_request
+from resilience import CircuitOpenError, DeadlineExceededError, request_deadline
+from singleflight import get_single_flight
+from jobs import JobQueueFullError, get_job_runner, job_body, validate_callback_url
+from batch import (BATCH_OUTPUTS, BatchPacer, batch_concurrency, batch_items, batch_output, batch_summary,
+                   ndjson_line, run_batch, write_archive, zip_response_headers)
+from admission import (AdmissionError, admission_enabled, admission_slot, client_identity,
+                       get_admission_controller, rate_limit_buckets)
+from negotiation import NotAcceptableError, artifact_cache_control, artifact_response, negotiate, result_response
+from metrics import (CONTENT_TYPE, HTTP_DURATION, HTTP_REQUESTS, end_request_span, render_metrics,
+                     start_request_span)
+import io
+import threading
+import time
 
 app = Flask(__name__)
-CORS(app)
+# The frontend reads Retry-After on 429 and 503
+CORS(app, expose_headers=['Retry-After'])
+
+# One handler per worker; its LLM clients come from the shared connection pool
+_query_handler = None
+_query_handler_lock = threading.Lock()
+
+
+def get_query_handler():
+    global _query_handler
+    with _query_handler_lock:
+        if _query_handler is None:
+            _query_handler = GrokHandler()
+        return _query_handler
+
+def _endpoint_label():
+    # The route pattern, not the path, so render ids do not become label values
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.request_span = start_request_span(f"{request.method} {_endpoint_label()}")
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = _endpoint_label()
+    HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    HTTP_DURATION.observe(time.perf_counter() - g.request_started, endpoint=endpoint, method=request.method)
+    g.response_status = response.status_code
+    return response
+
+# Endpoints that start pipeline work, and so count against the client's rate limit
+ADMITTED_ENDPOINTS = {'analyze', 'analyze_stream', 'refine', 'create_job', 'create_batch'}
+
+@app.before_request
+def admit_request():
+    # Turn clients over their rate away before reading the body or touching an LLM
+    if request.method != 'POST' or request.endpoint not in ADMITTED_ENDPOINTS or not admission_enabled():
+        return None
+    g.client_identity = client_identity(request.headers, request.remote_addr)
+    g.rate_limit_buckets = rate_limit_buckets(request.headers, request.remote_addr)
+    try:
+        get_admission_controller().check_rate(g.rate_limit_buckets)
+    except AdmissionError as e:
+        return jsonify({'error': str(e)}), 429, {'Retry-After': str(e.retry_after)}
+    return None
+
+@app.teardown_request
+def end_request_metrics(error=None):
+    # Runs after streamed bodies finish, so the span covers the whole SSE stream
+    end_request_span(g.pop('request_span', None), g.pop('response_status', None))
+
+def compute_result(query_handler, user_prompt, profile, cache_key, identity=None):
+    """
+    Run the pipeline and cache its result. Identical prompts arriving while it runs
+    share the result instead of starting their own.
+    :param identity: Client whose admission slot the run takes; None for background jobs.
+    :return: CachedResult.
+    """
+    def compute():
+        with admission_slot(identity):
+            result = run_pipeline(query_handler, user_prompt, profile)
+        computed = CachedResult(result.dot_code, result.image, result.explanation, result.image_format,
+                                result.user_prompt)
+        get_result_cache().put(cache_key, computed)
+        return computed
+
+    cached, _ = get_single_flight().do(cache_key, compute)
+    return cached
 
 @app.route('/api/analyze', methods=['POST'])
 def analyze():
@@ -19,38 +102,318 @@ def analyze():
         if not user_prompt:
             return jsonify({'error': 'No prompt provided'}), 400
 
-        # Initialize the GrokHandler
-        query_handler = GrokHandler()
-       
-        # Step 1: Generate DOT code
-        dot_code = query_handler.generate_dot_code(user_prompt)
+        # Response type from the Accept header (JSON, raw image or multipart); output
+        # format and size from 'profile' ("preview" or "full"), 'format', 'max_pixels', 'quality'
+        try:
+            media_type, accepted_format = negotiate(request.accept_mimetypes, data.get('format'))
+            profile = profile_from_request(data, image_format=accepted_format)
+        except NotAcceptableError as e:
+            return jsonify({'error': str(e)}), 406
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+
+        # Reuse the worker's GrokHandler
+        query_handler = get_query_handler()
 
-        # Step 2: Validate and render the flowchart
-        output_image_path = query_handler.validate_and_render_dot_code(
-            dot_code,
-            output_file="flowchart"
-        )
+        # Serve repeated prompts from the result cache
+        result_cache = get_result_cache()
+        cache_key = handler_cache_key(query_handler, user_prompt, profile)
+        cached = result_cache.get(cache_key)
+        if cached is None:
+            # Steps 1-3: Generate DOT code, then render it in memory while the explanation is generated
+            with request_deadline():
+                cached = compute_result(query_handler, user_prompt, profile, cache_key, g.get('client_identity'))
 
-        # Step 3: Generate textual explanation
-        explanation = query_handler.generate_text_response(dot_code, user_prompt)
+        # Step 4: Respond in the negotiated representation
+        return result_response(cache_key, cached, media_type)
 
-        # Step 4: Read and encode the image
-        with open(output_image_path, "rb") as image_file:
-            encoded_image = base64.b64encode(image_file.read()).decode()
+    except AdmissionError as e:
+        return jsonify({'error': str(e)}), 429, {'Retry-After': str(e.retry_after)}
 
-        if os.path.exists(output_image_path):
-            os.remove(output_image_path)
-        if os.path.exists(output_image_path + ".jpeg"):
-            os.remove(output_image_path + ".jpeg")
+    except RenderBusyError as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': str(e.retry_after)}
 
-        return jsonify({
-            'flowchart': encoded_image,
-            'explanation': explanation
-        })
+    except RenderLimitError as e:
+        return jsonify({'error': str(e)}), 422
+
+    except CircuitOpenError as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': str(e.retry_after)}
+
+    except DeadlineExceededError as e:
+        return jsonify({'error': str(e)}), 504
 
     except Exception as e:
         print(f"Error: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/analyze/stream', methods=['POST'])
+def analyze_stream():
+    """
+    Streaming variant of /api/analyze using Server-Sent Events. Emits 'dot',
+    'render_attempt', 'image', 'explanation_reset' and 'explanation_token' events as
+    the pipeline progresses, then 'done' with the full explanation, or 'error'.
+    """
+    data = request.json
+    user_prompt = data.get('prompt') if data else None
+
+    if not user_prompt:
+        return jsonify({'error': 'No prompt provided'}), 400
+
+    try:
+        profile = profile_from_request(data)
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    def generate():
+        # Sent immediately so the client sees the first byte before any LLM call
+        yield sse_event('status', {'stage': 'generating'})
+        try:
+            query_handler = get_query_handler()
+            result_cache = get_result_cache()
+            cache_key = handler_cache_key(query_handler, user_prompt, profile)
+            cached = result_cache.get(cache_key)
+            if cached is not None:
+                for event, payload in cached_stream_events(cached):
+                    yield stream_event_to_sse(event, payload, cached=True)
+                return
+
+            with request_deadline(), admission_slot(g.get('client_identity')):
+                for event, payload in stream_pipeline(query_handler, user_prompt, profile):
+                    if event == 'done':
+                        result_cache.put(cache_key, CachedResult(
+                            payload.dot_code, payload.image, payload.explanation, payload.image_format,
+                            payload.user_prompt
+                        ))
+                    yield stream_event_to_sse(event, payload)
+
+        except AdmissionError as e:
+            yield sse_event('error', {'error': str(e), 'retry_after': e.retry_after})
+        except Exception as e:
+            print(f"Error: {str(e)}")
+            yield sse_event('error', {'error': str(e)})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/refine', methods=['POST'])
+def refine():
+    """
+    Change an earlier diagram instead of generating a new one. Body: 'id' (the render
+    id of a /api/analyze or /api/refine result) and 'instruction', e.g. "make the boxes
+    blue" or "add a step for password reset", plus the profile fields of /api/analyze.
+    Style-only instructions are applied without an LLM call; others ask the LLM for
+    line edits to the existing DOT code. The response has a new render id, so
+    refinements can be chained.
+    """
+    try:
+        data = request.json
+        parent_id = data.get('id') if data else None
+        instruction = data.get('instruction') if data else None
+
+        if not parent_id or not instruction:
+            return jsonify({'error': "Both 'id' and 'instruction' are required"}), 400
+
+        try:
+            media_type, accepted_format = negotiate(request.accept_mimetypes, data.get('format'))
+            profile = profile_from_request(data, image_format=accepted_format)
+        except NotAcceptableError as e:
+            return jsonify({'error': str(e)}), 406
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+
+        result_cache = get_result_cache()
+        parent = result_cache.get(parent_id)
+        if parent is None:
+            return jsonify({'error': 'Unknown or expired render id'}), 404
+
+        query_handler = get_query_handler()
+        identity = g.get('client_identity')
+        cache_key = refine_cache_key(query_handler, parent_id, instruction, profile)
+        cached = result_cache.get(cache_key)
+        if cached is None:
+            def compute():
+                with admission_slot(identity):
+                    result = run_refinement(query_handler, parent, instruction, profile)
+                computed = CachedResult(result.dot_code, result.image, result.explanation, result.image_format,
+                                        result.user_prompt)
+                result_cache.put(cache_key, computed)
+                return computed
+
+            with request_deadline():
+                cached, _ = get_single_flight().do(cache_key, compute)
+
+        return result_response(cache_key, cached, media_type)
+
+    except AdmissionError as e:
+        return jsonify({'error': str(e)}), 429, {'Retry-After': str(e.retry_after)}
+
+    except RenderBusyError as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': str(e.retry_after)}
+
+    except RenderLimitError as e:
+        return jsonify({'error': str(e)}), 422
+
+    except CircuitOpenError as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': str(e.retry_after)}
+
+    except DeadlineExceededError as e:
+        return jsonify({'error': str(e)}), 504
+
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/jobs', methods=['POST'])
+def create_job():
+    """
+    Background variant of /api/analyze: answers 202 right away with a job id, and the
+    pipeline runs on the worker's job threads. Poll GET /api/jobs/<id> or pass
+    'callback_url' to receive the finished job as a JSON POST. Takes the body fields
+    of /api/analyze; the result is fetched from the job's result.image_url.
+    """
+    data = request.json
+    user_prompt = data.get('prompt') if data else None
+
+    if not user_prompt:
+        return jsonify({'error': 'No prompt provided'}), 400
+
+    callback_url = data.get('callback_url')
+    try:
+        profile = profile_from_request(data)
+        if callback_url:
+            validate_callback_url(callback_url)
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    query_handler = get_query_handler()
+    runner = get_job_runner()
+    cache_key = handler_cache_key(query_handler, user_prompt, profile)
+    try:
+        if get_result_cache().get(cache_key) is not None:
+            job = runner.completed(cache_key, callback_url)
+        else:
+            def run():
+                compute_result(query_handler, user_prompt, profile, cache_key)
+                return cache_key
+
+            job = runner.submit(run, callback_url)
+    except JobQueueFullError as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': str(e.retry_after)}
+
+    return jsonify(job_body(job)), 202, {'Location': f'/api/jobs/{job.id}'}
+
+@app.route('/api/batch', methods=['POST'])
+def create_batch():
+    """
+    Generate a diagram for each of 'prompts' (a list, at most BATCH_MAX_PROMPTS, or what
+    the client's rate limit pays for within BATCH_RATE_BUDGET when that is fewer),
+    running BATCH_CONCURRENCY of them at a time, or 'concurrency' when lower. Identical
+    prompts run once and cached ones are answered from the result cache. Takes the
+    profile fields of /api/analyze, applied to every prompt. Each distinct prompt costs
+    a rate limit token like a request of its own; beyond the client's burst, prompts
+    wait for their token, so large batches run at the client's rate.
+    The response is NDJSON by default: one line per distinct prompt as it finishes
+    (its 'indexes' in the list, then 'result' as in /api/jobs or 'error' and
+    'error_status'), then a summary line with 'done'. With 'output': "zip" or
+    Accept: application/zip it is a zip archive of the DOT code, images and
+    explanations, with manifest.json, once every prompt finished.
+    """
+    data = request.json
+    prompts = data.get('prompts') if data else None
+
+    if not prompts:
+        return jsonify({'error': 'No prompts provided'}), 400
+
+    query_handler = get_query_handler()
+    buckets = g.get('rate_limit_buckets')
+    pacer = BatchPacer(get_admission_controller() if buckets else None, buckets)
+    try:
+        output = batch_output(request.accept_mimetypes, data.get('output'))
+        profile = profile_from_request(data)
+        concurrency = batch_concurrency(data.get('concurrency'))
+        items = batch_items(prompts, lambda prompt: handler_cache_key(query_handler, prompt, profile),
+                            pacer.max_prompts())
+    except NotAcceptableError as e:
+        return jsonify({'error': str(e)}), 406
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    identity = g.get('client_identity')
+    result_cache = get_result_cache()
+
+    def compute(item):
+        # Every prompt is charged a rate limit token, gets the time budget of a request of
+        # its own and takes an admission slot while it runs
+        pacer.pace(item)
+        cached = result_cache.get(item.cache_key)
+        if cached is None:
+            with request_deadline():
+                cached = compute_result(query_handler, item.prompt, profile, item.cache_key, identity)
+        return cached
+
+    outcomes = run_batch(items, compute, concurrency)
+    if output == 'zip':
+        archive_file = io.BytesIO()
+        write_archive(archive_file, len(prompts), outcomes)
+        return archive_file.getvalue(), 200, zip_response_headers()
+
+    def generate():
+        finished = []
+        for outcome in outcomes:
+            finished.append(outcome)
+            yield ndjson_line(outcome.to_dict())
+        yield ndjson_line(batch_summary(len(prompts), finished))
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype=BATCH_OUTPUTS['ndjson'],
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    Status of a background job: 'queued', 'running', 'succeeded' (with 'result') or
+    'failed' (with 'error' and the 'error_status' /api/analyze would have returned).
+    """
+    job = get_job_runner().store.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job id'}), 404
+    return jsonify(job_body(job))
+
+@app.route('/api/render/<render_id>', methods=['GET'])
+def get_render(render_id):
+    """
+    Serve a cached artifact by the id returned from /api/analyze, with ETag and
+    Cache-Control so browsers and CDNs can cache it. Accept picks the raw image,
+    multipart/mixed, or JSON metadata with the DOT code.
+    """
+    result_cache = get_result_cache()
+    result = result_cache.get(render_id)
+    if result is None:
+        return jsonify({'error': 'Unknown or expired render id'}), 404
+
+    try:
+        media_type, _ = negotiate(request.accept_mimetypes, result.image_format, [result.image_format])
+    except NotAcceptableError as e:
+        return jsonify({'error': str(e)}), 406
+
+    return artifact_response(render_id, result, media_type, request.if_none_match,
+                             artifact_cache_control(result_cache))
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """
+    Prometheus scrape endpoint: stage latencies, retries, render failures, tokens and payload sizes.
+    """
+    return render_metrics(), 200, {'Content-Type': CONTENT_TYPE}
+
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(get_result_cache().stats())
+
 if __name__ == '__main__':
     app.run(port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,478 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Prometheus text exposition format, version 0.0.4
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+TOKEN_BUCKETS = (50, 100, 200, 400, 800, 1600, 3200, 6400, 12800)
+
+
+def _format_labels(labelnames, values):
+    if not labelnames:
+        return ""
+    pairs = []
+    for name, value in zip(labelnames, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        if not self.labelnames:
+            # Unlabelled counters are exposed from the start, so rate() sees the first increment
+            self._values[()] = 0
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in sorted(self._values.items())
+        ]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _samples(self):
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in sorted(self._values.items())
+        ]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket (non-cumulative) counts, then sum and count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _samples(self):
+        samples = []
+        for key, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames + ("le",), key + (_format_value(bound),))
+                samples.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            samples.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            samples.append(f"{self.name}_count{labels} {count}")
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """
+        Register a callable run before every scrape, e.g. to refresh gauges from stats().
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def expose(self):
+        for collector in list(self._collectors):
+            try:
+                collector()
+            except Exception as e:
+                print(f"Metrics collector failed: {e}")
+        lines = []
+        for metric in list(self._metrics):
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_DURATION = REGISTRY.register(Histogram(
+    "text2block_stage_duration_seconds",
+    "Time spent in each pipeline stage.",
+    ("stage", "outcome"),
+))
+STREAM_EARLY_STOPS = REGISTRY.register(Counter(
+    "text2block_stream_early_stops_total",
+    "Streamed completions closed as soon as their DOT graph was complete.",
+    ("backend", "model"),
+))
+FIX_RETRIES = REGISTRY.register(Counter(
+    "text2block_fix_retries_total",
+    "DOT code sent back to the LLM for fixing after a failed render.",
+))
+RENDER_FAILURES = REGISTRY.register(Counter(
+    "text2block_render_failures_total",
+    "Failed render attempts by reason.",
+    ("reason",),
+))
+LLM_TOKENS = REGISTRY.register(Counter(
+    "text2block_llm_tokens_total",
+    "Prompt, cached prompt and completion tokens reported by the LLM providers.",
+    ("backend", "model", "kind"),
+))
+PROMPT_TOKENS = REGISTRY.register(Histogram(
+    "text2block_prompt_tokens",
+    "Estimated tokens per rendered prompt, by template and part (static: cacheable system prefix, dynamic: request).",
+    ("template", "part"),
+    buckets=TOKEN_BUCKETS,
+))
+PAYLOAD_BYTES = REGISTRY.register(Histogram(
+    "text2block_payload_bytes",
+    "Size of generated DOT code, rendered images and explanations.",
+    ("kind",),
+    buckets=SIZE_BUCKETS,
+))
+HTTP_REQUESTS = REGISTRY.register(Counter(
+    "text2block_http_requests_total",
+    "HTTP requests by endpoint and status.",
+    ("endpoint", "method", "status"),
+))
+HTTP_DURATION = REGISTRY.register(Histogram(
+    "text2block_http_request_duration_seconds",
+    "Time until the response headers were ready; streamed bodies continue afterwards.",
+    ("endpoint", "method"),
+))
+CACHE_LOOKUPS = REGISTRY.register(Counter(
+    "text2block_result_cache_lookups_total",
+    "Result cache lookups by outcome (memory_hit, disk_hit, miss).",
+    ("outcome",),
+))
+RENDER_WAITING = REGISTRY.register(Gauge(
+    "text2block_render_waiting",
+    "Renders of this worker waiting for a slot.",
+))
+HEDGE_REQUESTS = REGISTRY.register(Counter(
+    "text2block_hedge_requests_total",
+    "Hedged DOT generation calls by backend and outcome (launched, won, abandoned).",
+    ("backend", "outcome"),
+))
+BACKEND_LATENCY = REGISTRY.register(Gauge(
+    "text2block_backend_latency_seconds",
+    "Recent DOT generation latency per backend, as tracked for hedging.",
+    ("backend", "quantile"),
+))
+LLM_RETRIES = REGISTRY.register(Counter(
+    "text2block_llm_retries_total",
+    "LLM calls retried after a transient failure.",
+    ("backend",),
+))
+CIRCUIT_STATE = REGISTRY.register(Gauge(
+    "text2block_circuit_state",
+    "Circuit breaker state per backend: 0 closed, 1 half-open, 2 open.",
+    ("backend",),
+))
+SEMANTIC_LOOKUPS = REGISTRY.register(Counter(
+    "text2block_semantic_cache_lookups_total",
+    "Semantic cache lookups by outcome (hit, miss).",
+    ("outcome",),
+))
+ADMISSION_DECISIONS = REGISTRY.register(Counter(
+    "text2block_admission_decisions_total",
+    "Admission control decisions (admitted, queued, rate_limited, rejected, timed_out).",
+    ("outcome",),
+))
+LAYOUT_SELECTIONS = REGISTRY.register(Counter(
+    "text2block_layout_selections_total",
+    "Layout engines chosen in auto layout mode, by how (speculative, cache or declared).",
+    ("engine", "source"),
+))
+REFINE_EDITS = REGISTRY.register(Counter(
+    "text2block_refine_edits_total",
+    "Diagram refinements by how they were applied (style: locally without an LLM, llm: as an LLM edit).",
+    ("mode",),
+))
+JOBS_FINISHED = REGISTRY.register(Counter(
+    "text2block_jobs_finished_total",
+    "Background jobs by final status (succeeded, failed, rejected when the queue was full).",
+    ("status",),
+))
+BATCH_ITEMS = REGISTRY.register(Counter(
+    "text2block_batch_items_total",
+    "Prompts of batches by outcome (succeeded, failed, deduplicated when identical to another prompt of the batch).",
+    ("status",),
+))
+JOB_DURATION = REGISTRY.register(Histogram(
+    "text2block_job_duration_seconds",
+    "Time background jobs spent waiting in the queue and running.",
+    ("phase",),
+))
+JOB_QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "text2block_job_queue_depth",
+    "Background jobs of this worker waiting for a job thread.",
+))
+JOBS_RUNNING = REGISTRY.register(Gauge(
+    "text2block_jobs_running",
+    "Background jobs of this worker currently running.",
+))
+ADMISSION_IN_FLIGHT = REGISTRY.register(Gauge(
+    "text2block_admission_in_flight",
+    "Requests of this worker holding an admission slot.",
+))
+ADMISSION_QUEUED = REGISTRY.register(Gauge(
+    "text2block_admission_queued",
+    "Requests of this worker waiting for an admission slot.",
+))
+BACKEND_IN_FLIGHT = REGISTRY.register(Gauge(
+    "text2block_backend_in_flight",
+    "LLM calls of this worker currently holding a slot of a backend (see backends.py).",
+    ("backend",),
+))
+COALESCED_REQUESTS = REGISTRY.register(Counter(
+    "text2block_coalesced_requests_total",
+    "Pipeline callers by single-flight role: leaders ran the pipeline, followers shared a leader's result.",
+    ("role",),
+))
+COALESCING_RATIO = REGISTRY.register(Gauge(
+    "text2block_coalescing_ratio",
+    "Share of this worker's pipeline callers that joined an identical in-flight run.",
+))
+SINGLE_FLIGHT_IN_FLIGHT = REGISTRY.register(Gauge(
+    "text2block_single_flight_in_flight",
+    "Distinct pipeline runs of this worker currently shared through single-flight.",
+))
+
+
+def _collect_runtime_stats():
+    from renderer import get_render_pool
+
+    RENDER_WAITING.set(get_render_pool().stats()["waiting"])
+
+    from hedging import get_latency_tracker
+
+    for backend, stats in get_latency_tracker().stats().items():
+        BACKEND_LATENCY.set(stats["p50"], backend=backend, quantile="0.5")
+        BACKEND_LATENCY.set(stats["p95"], backend=backend, quantile="0.95")
+
+    from resilience import circuit_stats
+
+    states = {"closed": 0, "half_open": 1, "open": 2}
+    for backend, stats in circuit_stats().items():
+        CIRCUIT_STATE.set(states[stats["state"]], backend=backend)
+
+    from singleflight import single_flight_stats
+
+    flight_stats = single_flight_stats()
+    COALESCING_RATIO.set(flight_stats["coalescing_ratio"])
+    SINGLE_FLIGHT_IN_FLIGHT.set(flight_stats["in_flight"])
+
+    from jobs import job_stats
+
+    runner_stats = job_stats()
+    if runner_stats is not None:
+        JOB_QUEUE_DEPTH.set(runner_stats["queued"])
+        JOBS_RUNNING.set(runner_stats["running"])
+
+    from admission import admission_stats
+
+    controller_stats = admission_stats()
+    if controller_stats is not None:
+        ADMISSION_IN_FLIGHT.set(controller_stats["in_flight"])
+        ADMISSION_QUEUED.set(controller_stats["queued"])
+
+    from backends import backend_stats
+
+    for backend, stats in backend_stats().items():
+        BACKEND_IN_FLIGHT.set(stats["in_flight"], backend=backend)
+
+
+REGISTRY.add_collector(_collect_runtime_stats)
+
+
+def render_metrics():
+    """
+    All metrics of this worker in Prometheus text format. Each gunicorn/uvicorn worker
+    keeps its own registry, so scrape every worker (or run one) for complete numbers.
+    """
+    return REGISTRY.expose()
+
+
+def _tracer():
+    try:
+        from opentelemetry import trace
+    except ImportError:
+        return None
+    return trace.get_tracer("text2block")
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    OpenTelemetry span around a block when opentelemetry-api is installed, a no-op otherwise.
+    Spans nest under the request span started by start_request_span.
+    """
+    tracer = _tracer()
+    if tracer is None:
+        yield None
+        return
+    with tracer.start_as_current_span(name, attributes=attributes) as current:
+        yield current
+
+
+def start_request_span(name, **attributes):
+    """
+    Start a per-request root span and make it current.
+    :return: Opaque handle for end_request_span, or None without OpenTelemetry.
+    """
+    tracer = _tracer()
+    if tracer is None:
+        return None
+    from opentelemetry import context, trace
+
+    request_span = tracer.start_span(name, attributes=attributes)
+    token = context.attach(trace.set_span_in_context(request_span))
+    return request_span, token
+
+
+def end_request_span(handle, status=None):
+    if handle is None:
+        return
+    from opentelemetry import context
+
+    request_span, token = handle
+    if status is not None:
+        request_span.set_attribute("http.status_code", status)
+    context.detach(token)
+    request_span.end()
+
+
+@contextmanager
+def stage_timer(stage, **attributes):
+    """
+    Time a pipeline stage into text2block_stage_duration_seconds, labelled with its
+    outcome, inside a trace span of the same name.
+    """
+    start = time.perf_counter()
+    outcome = "error"
+    with span(stage, **attributes):
+        try:
+            yield
+            outcome = "ok"
+        finally:
+            STAGE_DURATION.observe(time.perf_counter() - start, stage=stage, outcome=outcome)
+
+
+def render_failure_reason(error):
+    """
+    Short, low-cardinality label for why a render attempt failed.
+    """
+    import graphviz
+    from dot_lint import DotSyntaxError
+    from renderer import RenderBusyError, RenderLimitError
+    from resilience import DeadlineExceededError
+
+    if isinstance(error, DotSyntaxError):
+        return "lint"
+    if isinstance(error, RenderBusyError):
+        return "busy"
+    if isinstance(error, RenderLimitError):
+        return "limit"
+    if isinstance(error, DeadlineExceededError):
+        return "deadline"
+    if isinstance(error, graphviz.ExecutableNotFound):
+        return "dot_not_found"
+    if isinstance(error, graphviz.CalledProcessError):
+        return "graphviz_error"
+    return "other"
+
+
+def record_render_failure(error):
+    RENDER_FAILURES.inc(reason=render_failure_reason(error))
+
+
+def record_payload(kind, payload):
+    size = len(payload.encode("utf-8")) if isinstance(payload, str) else len(payload)
+    PAYLOAD_BYTES.observe(size, kind=kind)
+
+
+def record_token_usage(backend, model, response):
+    """
+    Count the tokens reported on an OpenAI-style completion or stream chunk.
+    Responses without usage data are ignored.
+    """
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        # Groq reports the usage of a stream in an extension of its last chunk
+        usage = (getattr(response, "x_groq", None) or {}).get("usage")
+    if usage is None:
+        return
+    if isinstance(usage, dict):
+        prompt_tokens = usage.get("prompt_tokens")
+        completion_tokens = usage.get("completion_tokens")
+        cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+    else:
+        prompt_tokens = getattr(usage, "prompt_tokens", None)
+        completion_tokens = getattr(usage, "completion_tokens", None)
+        cached_tokens = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None)
+    if prompt_tokens:
+        LLM_TOKENS.inc(prompt_tokens, backend=backend, model=model, kind="prompt")
+    # Prompt tokens served from the provider's prefix cache, where reported
+    if cached_tokens:
+        LLM_TOKENS.inc(cached_tokens, backend=backend, model=model, kind="cached_prompt")
+    if completion_tokens:
+        LLM_TOKENS.inc(completion_tokens, backend=backend, model=model, kind="completion")
@@ -0,0 +1,143 @@
+import base64
+import json
+import os
+import uuid
+
+JSON_TYPE = "application/json"
+MULTIPART_TYPE = "multipart/mixed"
+IMAGE_MIME_TYPES = {
+    "svg": "image/svg+xml",
+    "png": "image/png",
+    "webp": "image/webp",
+    "jpeg": "image/jpeg",
+}
+_IMAGE_FORMATS_BY_MIME = {mime: image_format for image_format, mime in IMAGE_MIME_TYPES.items()}
+
+
+class NotAcceptableError(ValueError):
+    pass
+
+
+def negotiate(accept_mimetypes, image_format=None, available_formats=None):
+    """
+    Pick the representation of a result for the request's Accept header.
+    JSON with a base64 image stays the default, so existing clients are unaffected.
+    :param accept_mimetypes: request.accept_mimetypes (Flask and Quart alike).
+    :param image_format: Format asked for in the request body; preferred for 'image/*'.
+    :param available_formats: Image formats that can be served; defaults to all of them.
+    :return: (media type, image format or None when the body decides).
+    :raises NotAcceptableError: The client accepts none of the offered types.
+    """
+    if not accept_mimetypes:
+        return JSON_TYPE, None
+
+    formats = [f for f in IMAGE_MIME_TYPES if available_formats is None or f in available_formats]
+    if image_format in formats:
+        formats.remove(image_format)
+        formats.insert(0, image_format)
+    offered = [JSON_TYPE] + [IMAGE_MIME_TYPES[f] for f in formats] + [MULTIPART_TYPE]
+    media_type = accept_mimetypes.best_match(offered)
+    if media_type is None:
+        raise NotAcceptableError(f"Acceptable types are {', '.join(offered)}.")
+    return media_type, _IMAGE_FORMATS_BY_MIME.get(media_type)
+
+
+def render_url(cache_key):
+    return f"/api/render/{cache_key}"
+
+
+def result_metadata(cache_key, result):
+    return {
+        'id': cache_key,
+        'image_url': render_url(cache_key),
+        'format': result.image_format,
+        'explanation': result.explanation,
+    }
+
+
+def _json_response(body):
+    return json.dumps(body).encode("utf-8"), 200, {'Content-Type': JSON_TYPE}
+
+
+def _multipart_body(metadata, result):
+    boundary = uuid.uuid4().hex
+    extension = "jpg" if result.image_format == "jpeg" else result.image_format
+    body = b"".join([
+        f"--{boundary}\r\n".encode(),
+        f"Content-Type: {JSON_TYPE}\r\n\r\n".encode(),
+        json.dumps(metadata).encode("utf-8"),
+        f"\r\n--{boundary}\r\n".encode(),
+        f"Content-Type: {IMAGE_MIME_TYPES[result.image_format]}\r\n".encode(),
+        f'Content-Disposition: attachment; filename="flowchart.{extension}"\r\n\r\n'.encode(),
+        result.image,
+        f"\r\n--{boundary}--\r\n".encode(),
+    ])
+    return body, f"{MULTIPART_TYPE}; boundary={boundary}"
+
+
+def _representation_etag(result, media_type):
+    if media_type == JSON_TYPE:
+        return f"{result.etag}-json"
+    if media_type == MULTIPART_TYPE:
+        return f"{result.etag}-multipart"
+    return result.etag
+
+
+def result_response(cache_key, result, media_type):
+    """
+    Response for POST /api/analyze in the negotiated media type:
+    - application/json: the original shape with the image base64-encoded, plus 'id' and 'image_url'
+    - image/*: the raw image; the explanation can be fetched from GET /api/render/<id>
+    - multipart/mixed: a JSON metadata part followed by the raw image
+    :return: (body, status, headers) for Flask or Quart.
+    """
+    metadata = result_metadata(cache_key, result)
+    if media_type == JSON_TYPE:
+        metadata['flowchart'] = base64.b64encode(result.image).decode()
+        return _json_response(metadata)
+
+    headers = {
+        'ETag': f'"{_representation_etag(result, media_type)}"',
+        'Content-Location': render_url(cache_key),
+        'X-Render-Id': cache_key,
+    }
+    if media_type == MULTIPART_TYPE:
+        body, headers['Content-Type'] = _multipart_body(metadata, result)
+        return body, 200, headers
+    headers['Content-Type'] = IMAGE_MIME_TYPES[result.image_format]
+    return result.image, 200, headers
+
+
+def artifact_response(cache_key, result, media_type, if_none_match, cache_control):
+    """
+    Response for GET /api/render/<id>. Image and multipart requests get the stored
+    artifact; JSON requests get its metadata and DOT code without the image.
+    Each representation has its own ETag, and a matching If-None-Match yields 304.
+    :param if_none_match: request.if_none_match.
+    :return: (body, status, headers) for Flask or Quart.
+    """
+    etag = _representation_etag(result, media_type)
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': cache_control, 'Vary': 'Accept'}
+    if if_none_match.contains(etag):
+        return b"", 304, headers
+
+    metadata = result_metadata(cache_key, result)
+    if media_type == JSON_TYPE:
+        metadata['dot_code'] = result.dot_code
+        body = json.dumps(metadata).encode("utf-8")
+        headers['Content-Type'] = JSON_TYPE
+    elif media_type == MULTIPART_TYPE:
+        body, headers['Content-Type'] = _multipart_body(metadata, result)
+    else:
+        body = result.image
+        headers['Content-Type'] = IMAGE_MIME_TYPES[result.image_format]
+    return body, 200, headers
+
+
+def artifact_cache_control(result_cache):
+    """
+    Cache-Control for GET /api/render/<id>: ids are content-addressed, so shared
+    caches may keep an artifact for as long as the result cache would.
+    """
+    max_age = int(os.getenv("RENDER_ARTIFACT_MAX_AGE", str(int(result_cache.ttl))))
+    return f"public, max-age={max_age}"
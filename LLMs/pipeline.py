@@ -0,0 +1,450 @@
+import asyncio
+import base64
+import json
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from dot_edit import style_refinement
+from metrics import REFINE_EDITS
+from render_profiles import get_profile
+from resilience import DeadlineExceededError, remaining_time, submit_in_context
+from semantic_cache import get_semantic_cache, remember_dot_code, semantic_lookup
+
+# Shared by all requests in this worker; each request occupies at most one thread at a time
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("PIPELINE_MAX_WORKERS", "8")),
+    thread_name_prefix="pipeline",
+)
+
+
+class PipelineResult:
+    def __init__(self, image, dot_code, explanation, image_format="jpeg", user_prompt=None):
+        self.image = image
+        self.image_format = image_format
+        self.dot_code = dot_code
+        self.explanation = explanation
+        # The prompt the diagram was first generated for; refinements keep it
+        self.user_prompt = user_prompt
+
+
+class _BackgroundExplainer:
+    def __init__(self, query_handler, user_prompt):
+        """
+        Keeps one explanation request in flight for the latest candidate DOT code.
+        """
+        self.query_handler = query_handler
+        self.user_prompt = user_prompt
+        self.dot_code = None
+        self.future = None
+        self._lock = threading.Lock()
+
+    def explain(self, dot_code):
+        """
+        Start explaining dot_code, discarding any explanation of an older candidate.
+        A request that already reached the LLM cannot be aborted; its result is ignored.
+        """
+        with self._lock:
+            if dot_code == self.dot_code:
+                return
+            if self.future is not None:
+                self.future.cancel()
+            self.dot_code = dot_code
+            self.future = submit_in_context(
+                _executor, self.query_handler.generate_text_response, dot_code, self.user_prompt
+            )
+
+    def cancel(self):
+        with self._lock:
+            if self.future is not None:
+                self.future.cancel()
+
+    def result(self, dot_code):
+        self.explain(dot_code)
+        try:
+            return self.future.result(timeout=remaining_time())
+        except FutureTimeoutError:
+            self.future.cancel()
+            raise DeadlineExceededError("Request deadline exceeded while waiting for the explanation.")
+
+
+def _reuse_dot_code(lookup):
+    if lookup is not None and lookup.hit:
+        print(f"Semantic cache hit ({lookup.score:.3f}): reusing the diagram of '{lookup.matched_prompt}'.")
+        return lookup.dot_code
+    return None
+
+
+def generate_dot_code(query_handler, user_prompt):
+    """
+    DOT code for user_prompt, taken from the semantic cache when an earlier prompt
+    was similar enough, else generated by query_handler.
+    :return: (dot_code, lookup); pass lookup to remember_dot_code once the code rendered.
+    """
+    lookup = semantic_lookup(query_handler, user_prompt)
+    return _reuse_dot_code(lookup) or query_handler.generate_dot_code(user_prompt), lookup
+
+
+async def agenerate_dot_code(query_handler, user_prompt):
+    """
+    Asyncio variant of generate_dot_code; the prompt is embedded off the event loop.
+    """
+    lookup = None
+    if get_semantic_cache() is not None:
+        lookup = await asyncio.get_running_loop().run_in_executor(
+            _executor, semantic_lookup, query_handler, user_prompt
+        )
+    return _reuse_dot_code(lookup) or await query_handler.agenerate_dot_code(user_prompt), lookup
+
+
+async def _aremember_dot_code(lookup, dot_code):
+    # Embeds the prompt and may write SQLite, so off the event loop
+    if lookup is not None and not lookup.hit:
+        await asyncio.get_running_loop().run_in_executor(_executor, remember_dot_code, lookup, dot_code)
+
+
+def run_pipeline(query_handler, user_prompt, profile=None):
+    """
+    Generate, render and explain a flowchart, overlapping the explanation LLM call
+    with Graphviz rendering. The explanation starts as soon as the first candidate DOT
+    code exists and is only re-issued when a fix round changes the graph, so the
+    latency of the last two stages is max(render, explain) rather than their sum.
+    :param query_handler: Handler providing generate_dot_code, validate_and_render_dot_image
+                          and generate_text_response.
+    :param user_prompt: Prompt provided by the user.
+    :param profile: RenderProfile for the image; defaults to get_profile().
+    :return: PipelineResult with the rendered image bytes, final DOT code and explanation.
+    """
+    profile = profile or get_profile()
+    dot_code, lookup = generate_dot_code(query_handler, user_prompt)
+    return _render_and_explain(query_handler, dot_code, user_prompt, profile, lookup)
+
+
+def _render_and_explain(query_handler, dot_code, user_prompt, profile, lookup=None):
+    explainer = _BackgroundExplainer(query_handler, user_prompt)
+    explainer.explain(dot_code)
+
+    fixed_dot_code = [dot_code]
+
+    def on_fix(new_dot_code):
+        fixed_dot_code[0] = new_dot_code
+        explainer.explain(new_dot_code)
+
+    try:
+        image = query_handler.validate_and_render_dot_image(
+            dot_code,
+            profile=profile,
+            on_fix=on_fix
+        )
+    except Exception:
+        explainer.cancel()
+        raise
+
+    remember_dot_code(lookup, fixed_dot_code[0])
+    explanation = explainer.result(fixed_dot_code[0])
+    return PipelineResult(image, fixed_dot_code[0], explanation, profile.image_format, user_prompt)
+
+
+def run_refinement(query_handler, parent, instruction, profile=None):
+    """
+    Change an earlier result instead of generating a new diagram. Instructions that
+    only restyle it (colors, shapes, fonts, edge styles, direction) are applied to its
+    DOT code locally and keep its explanation; anything else goes to the LLM as a
+    request for line edits, and the edited graph is rendered and explained as usual.
+    :param parent: CachedResult being refined.
+    :param instruction: The user's change request, e.g. "make the boxes blue".
+    :param profile: RenderProfile for the image; defaults to get_profile().
+    :return: PipelineResult.
+    """
+    profile = profile or get_profile()
+    dot_code = style_refinement(parent.dot_code, instruction)
+    if dot_code is None:
+        REFINE_EDITS.inc(mode="llm")
+        dot_code = query_handler.refine_dot_code(parent.dot_code, instruction)
+        # Explained for the diagram's topic; results cached before prompts were kept only have the instruction
+        return _render_and_explain(query_handler, dot_code, parent.user_prompt or instruction, profile)
+
+    REFINE_EDITS.inc(mode="style")
+    fixed_dot_code = [dot_code]
+
+    def on_fix(new_dot_code):
+        fixed_dot_code[0] = new_dot_code
+
+    image = query_handler.validate_and_render_dot_image(
+        dot_code,
+        profile=profile,
+        on_fix=on_fix
+    )
+    return PipelineResult(image, fixed_dot_code[0], parent.explanation, profile.image_format, parent.user_prompt)
+
+
+def stream_pipeline(query_handler, user_prompt, profile=None):
+    """
+    Run the pipeline and yield (event, data) tuples as each stage progresses:
+      ("dot", {"dot_code", "fixed"})       a candidate DOT is ready (fixed=True after a fix round)
+      ("render_attempt", {"attempt"})     a render attempt is starting
+      ("image", {"image", "format"})      the rendered image bytes are ready
+      ("explanation_reset", {})           earlier explanation tokens described a replaced graph
+      ("explanation_token", {"token"})    the next chunk of the explanation
+      ("done", PipelineResult)            everything finished
+    Rendering and the streamed explanation run concurrently; tokens are yielded as
+    soon as the LLM produces them. Errors from either stage are raised to the caller.
+    :param query_handler: Handler providing generate_dot_code, validate_and_render_dot_image
+                          and stream_text_response.
+    :param user_prompt: Prompt provided by the user.
+    :param profile: RenderProfile for the image; defaults to get_profile().
+    """
+    profile = profile or get_profile()
+    dot_code, lookup = generate_dot_code(query_handler, user_prompt)
+    yield "dot", {"dot_code": dot_code, "fixed": False}
+
+    events = queue.Queue()
+    state = {"explanation_id": 0}
+
+    def explain(explanation_id, candidate_dot_code):
+        try:
+            for token in query_handler.stream_text_response(candidate_dot_code, user_prompt):
+                if state["explanation_id"] != explanation_id:
+                    return
+                events.put(("explanation_token", explanation_id, token))
+            events.put(("explanation_done", explanation_id, None))
+        except Exception as e:
+            events.put(("explanation_error", explanation_id, e))
+
+    def start_explanation(candidate_dot_code):
+        state["explanation_id"] += 1
+        submit_in_context(_executor, explain, state["explanation_id"], candidate_dot_code)
+
+    def render():
+        try:
+            image = query_handler.validate_and_render_dot_image(
+                dot_code,
+                profile=profile,
+                on_fix=lambda new_dot_code: events.put(("dot_fixed", None, new_dot_code)),
+                on_attempt=lambda attempt: events.put(("render_attempt", None, attempt))
+            )
+            events.put(("image", None, image))
+        except Exception as e:
+            events.put(("render_error", None, e))
+
+    start_explanation(dot_code)
+    submit_in_context(_executor, render)
+
+    image = None
+    tokens = []
+    explanation_done = False
+    try:
+        while image is None or not explanation_done:
+            try:
+                kind, explanation_id, payload = events.get(timeout=remaining_time())
+            except queue.Empty:
+                raise DeadlineExceededError("Request deadline exceeded while streaming the result.")
+            if explanation_id is not None and explanation_id != state["explanation_id"]:
+                continue
+
+            if kind == "render_attempt":
+                yield "render_attempt", {"attempt": payload}
+            elif kind == "dot_fixed":
+                dot_code = payload
+                yield "dot", {"dot_code": dot_code, "fixed": True}
+                if tokens or explanation_done:
+                    yield "explanation_reset", {}
+                tokens = []
+                explanation_done = False
+                start_explanation(dot_code)
+            elif kind == "image":
+                image = payload
+                remember_dot_code(lookup, dot_code)
+                yield "image", {"image": image, "format": profile.image_format}
+            elif kind == "explanation_token":
+                tokens.append(payload)
+                yield "explanation_token", {"token": payload}
+            elif kind == "explanation_done":
+                explanation_done = True
+            else:
+                raise payload
+    finally:
+        # Stops a still-running explanation stream, e.g. when the client disconnects
+        state["explanation_id"] += 1
+
+    yield "done", PipelineResult(image, dot_code, "".join(tokens).strip(), profile.image_format, user_prompt)
+
+
+async def run_pipeline_async(query_handler, user_prompt, profile=None):
+    """
+    Asyncio variant of run_pipeline for AsyncGrokHandler. A stale explanation is
+    cancelled outright when a fix round changes the graph.
+    """
+    profile = profile or get_profile()
+    dot_code, lookup = await agenerate_dot_code(query_handler, user_prompt)
+    return await _arender_and_explain(query_handler, dot_code, user_prompt, profile, lookup)
+
+
+async def _arender_and_explain(query_handler, dot_code, user_prompt, profile, lookup=None):
+    state = {
+        "dot_code": dot_code,
+        "explanation": asyncio.ensure_future(query_handler.agenerate_text_response(dot_code, user_prompt)),
+    }
+
+    def on_fix(new_dot_code):
+        state["dot_code"] = new_dot_code
+        state["explanation"].cancel()
+        state["explanation"] = asyncio.ensure_future(
+            query_handler.agenerate_text_response(new_dot_code, user_prompt)
+        )
+
+    try:
+        image = await query_handler.avalidate_and_render_dot_image(
+            dot_code,
+            profile=profile,
+            on_fix=on_fix
+        )
+    except Exception:
+        state["explanation"].cancel()
+        raise
+
+    await _aremember_dot_code(lookup, state["dot_code"])
+    try:
+        explanation = await asyncio.wait_for(asyncio.shield(state["explanation"]), timeout=remaining_time())
+    except asyncio.TimeoutError:
+        state["explanation"].cancel()
+        raise DeadlineExceededError("Request deadline exceeded while waiting for the explanation.")
+    return PipelineResult(image, state["dot_code"], explanation, profile.image_format, user_prompt)
+
+
+async def run_refinement_async(query_handler, parent, instruction, profile=None):
+    """
+    Asyncio variant of run_refinement for AsyncGrokHandler.
+    """
+    profile = profile or get_profile()
+    dot_code = style_refinement(parent.dot_code, instruction)
+    if dot_code is None:
+        REFINE_EDITS.inc(mode="llm")
+        dot_code = await query_handler.arefine_dot_code(parent.dot_code, instruction)
+        return await _arender_and_explain(query_handler, dot_code, parent.user_prompt or instruction, profile)
+
+    REFINE_EDITS.inc(mode="style")
+    fixed_dot_code = [dot_code]
+
+    def on_fix(new_dot_code):
+        fixed_dot_code[0] = new_dot_code
+
+    image = await query_handler.avalidate_and_render_dot_image(
+        dot_code,
+        profile=profile,
+        on_fix=on_fix
+    )
+    return PipelineResult(image, fixed_dot_code[0], parent.explanation, profile.image_format, parent.user_prompt)
+
+
+async def stream_pipeline_async(query_handler, user_prompt, profile=None):
+    """
+    Asyncio variant of stream_pipeline for AsyncGrokHandler; yields the same events.
+    """
+    profile = profile or get_profile()
+    dot_code, lookup = await agenerate_dot_code(query_handler, user_prompt)
+    yield "dot", {"dot_code": dot_code, "fixed": False}
+
+    events = asyncio.Queue()
+    state = {"explanation": None}
+
+    async def explain(candidate_dot_code):
+        try:
+            async for token in query_handler.astream_text_response(candidate_dot_code, user_prompt):
+                events.put_nowait(("explanation_token", token))
+            events.put_nowait(("explanation_done", None))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            events.put_nowait(("error", e))
+
+    def start_explanation(candidate_dot_code):
+        if state["explanation"] is not None:
+            state["explanation"].cancel()
+        state["explanation"] = asyncio.ensure_future(explain(candidate_dot_code))
+
+    def on_fix(new_dot_code):
+        # The old explanation task is suspended here, so after cancel() it queues nothing more
+        start_explanation(new_dot_code)
+        events.put_nowait(("dot_fixed", new_dot_code))
+
+    async def render():
+        try:
+            image = await query_handler.avalidate_and_render_dot_image(
+                dot_code,
+                profile=profile,
+                on_fix=on_fix,
+                on_attempt=lambda attempt: events.put_nowait(("render_attempt", attempt))
+            )
+            events.put_nowait(("image", image))
+        except Exception as e:
+            events.put_nowait(("error", e))
+
+    start_explanation(dot_code)
+    render_task = asyncio.ensure_future(render())
+
+    image = None
+    tokens = []
+    explanation_done = False
+    try:
+        while image is None or not explanation_done:
+            try:
+                kind, payload = await asyncio.wait_for(events.get(), timeout=remaining_time())
+            except asyncio.TimeoutError:
+                raise DeadlineExceededError("Request deadline exceeded while streaming the result.")
+
+            if kind == "render_attempt":
+                yield "render_attempt", {"attempt": payload}
+            elif kind == "dot_fixed":
+                dot_code = payload
+                yield "dot", {"dot_code": dot_code, "fixed": True}
+                if tokens or explanation_done:
+                    yield "explanation_reset", {}
+                tokens = []
+                explanation_done = False
+            elif kind == "image":
+                image = payload
+                await _aremember_dot_code(lookup, dot_code)
+                yield "image", {"image": image, "format": profile.image_format}
+            elif kind == "explanation_token":
+                tokens.append(payload)
+                yield "explanation_token", {"token": payload}
+            elif kind == "explanation_done":
+                explanation_done = True
+            else:
+                raise payload
+    finally:
+        # Stops the remaining work, e.g. when the client disconnects
+        render_task.cancel()
+        state["explanation"].cancel()
+
+    yield "done", PipelineResult(image, dot_code, "".join(tokens).strip(), profile.image_format, user_prompt)
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream_event_to_sse(event, payload, cached=False):
+    """
+    Format one stream_pipeline event as a Server-Sent Event.
+    """
+    if event == "image":
+        return sse_event("image", {
+            "flowchart": base64.b64encode(payload["image"]).decode(),
+            "format": payload["format"]
+        })
+    if event == "done":
+        return sse_event("done", {"explanation": payload.explanation, "cached": cached})
+    return sse_event(event, payload)
+
+
+def cached_stream_events(cached):
+    """
+    Replay a cached result as the event sequence of stream_pipeline.
+    """
+    yield "dot", {"dot_code": cached.dot_code, "fixed": False}
+    yield "image", {"image": cached.image, "format": cached.image_format}
+    yield "explanation_token", {"token": cached.explanation}
+    yield "done", PipelineResult(cached.image, cached.dot_code, cached.explanation, cached.image_format,
+                                 cached.user_prompt)
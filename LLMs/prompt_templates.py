@@ -0,0 +1,206 @@
+import os
+import re
+import threading
+from metrics import PROMPT_TOKENS
+
+# Instructions that do not depend on the request go into the system message and the
+# request-specific values into the user message. This does not make the prompts
+# cacheable: the system parts (130-270 tokens) are far below the 1024+ token prefix
+# providers cache, so every token is paid on every call and the savings come only from
+# the shorter templates and the failing region sent to fixes. Bump a template's version
+# whenever its text changes.
+
+
+class Prompt:
+    def __init__(self, template, system, user):
+        """
+        A rendered template: the static system prefix and the per-request user message.
+        """
+        self.template = template
+        self.system = system
+        self.user = user
+
+    def messages(self):
+        """
+        OpenAI-style chat messages.
+        """
+        return [{"role": "system", "content": self.system}, {"role": "user", "content": self.user}]
+
+    def __str__(self):
+        return f"{self.system}\n\n{self.user}"
+
+
+class PromptTemplate:
+    def __init__(self, name, version, system, user):
+        """
+        :param system: Static instructions, sent unchanged on every call.
+        :param user: str.format template for the request-specific part.
+        """
+        self.name = name
+        self.version = version
+        self.system = system.strip()
+        self.user = user.strip()
+        self._static_tokens = None
+
+    @property
+    def static_tokens(self):
+        if self._static_tokens is None:
+            self._static_tokens = estimate_tokens(self.system)
+        return self._static_tokens
+
+    def render(self, **values):
+        """
+        Fill in the user part and record the token cost of both parts.
+        :return: Prompt.
+        """
+        prompt = Prompt(self, self.system, self.user.format(**values))
+        PROMPT_TOKENS.observe(self.static_tokens, template=self.name, part="static")
+        PROMPT_TOKENS.observe(estimate_tokens(prompt.user), template=self.name, part="dynamic")
+        return prompt
+
+
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    global _encoding, _encoding_loaded
+    with _encoding_lock:
+        if not _encoding_loaded:
+            _encoding_loaded = True
+            try:
+                import tiktoken
+
+                _encoding = tiktoken.get_encoding(os.getenv("PROMPT_TOKEN_ENCODING", "cl100k_base"))
+            except Exception:
+                # Not installed, or the encoding cannot be downloaded
+                _encoding = None
+        return _encoding
+
+
+def estimate_tokens(text):
+    """
+    Token count of text: exact for OpenAI-style tokenizers when tiktoken is installed,
+    otherwise about four characters per token, which is close for English and DOT.
+    """
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return max(1, (len(text) + 3) // 4)
+
+
+DOT_CODE = PromptTemplate("dot_code", "2", """
+You generate Graphviz DOT code for diagrams and flowcharts that help users understand complex topics.
+Follow these guidelines:
+1. Start the graph with resolution=900, for example: digraph NameOfGraph {resolution=900 layout=dot; ...}
+2. The graph name must not contain spaces (digraph MDSEmbeddingsPlot, not digraph MDS embeddings plot). Node and edge labels may.
+3. Use digraph, graph or whichever Graphviz graph type suits the request, and a suitable layout (dot, neato, fdp, sfdp, circo, twopi, osage or patchwork).
+4. Use Graphviz color names or quoted hexadecimal colors ("#4CAF50"). Unless the user asks for colors, use pastel fill colors with good text contrast.
+5. The code must be valid Graphviz syntax: quote names with spaces and do not use reserved keywords as node names.
+6. If the request cannot be expressed as a diagram (typos or meaningless input), return a graph with one box labelled:
+   It seems like there might have been a typo or error. Please elaborate your requirement for better understanding.
+7. Output ONLY the DOT code: no preamble, comments or markdown.
+""", """
+User request: {user_prompt}
+""")
+
+FIX_DOT_CODE = PromptTemplate("fix_dot_code", "2", """
+You fix Graphviz DOT code that failed to render. You are shown the lines around the error, numbered, and the error message.
+Reply ONLY with edit commands, one per line, using those line numbers:
+DELETE <n>
+REPLACE <n>: <new line>
+INSERT AFTER <n>: <new line>
+Rules:
+1. Fix the reported error and any other syntax error in the shown lines; keep the meaning of the diagram.
+2. The graph name must not contain spaces; quote node names and labels that contain spaces ("Node With Spaces").
+3. Use '->' in a digraph and '--' in a graph.
+4. Do not use reserved keywords (node, edge, graph, digraph, subgraph, strict) as node names; rename or quote them.
+5. No preamble, explanation or markdown.
+""", """
+The graph has {line_count} lines; {scope}:
+{numbered_lines}
+
+Error message: {error_message}
+""")
+
+TEXT_RESPONSE = PromptTemplate("text_response", "2", """
+You explain flowcharts rendered from Graphviz DOT code, in the context of the user's request.
+1. Write a detailed explanation of the flowchart in a suitable structure (overview, then the steps), aligned with the user's request, so it helps them understand the topic.
+2. Choose the length that suits the request and the diagram.
+3. Refer to colors by name (blue, yellow, ...) and never in hexadecimal, and only when that helps to read the diagram.
+4. You may add information the diagram does not carry if the request needs it.
+5. No preamble; start directly with the explanation.
+6. The output MUST be JSON with exactly this structure:
+{
+  "explanation": {
+    "overview": "High-level explanation of the flowchart and its purpose.",
+    "details": [
+      {"heading": "Step 1", "description": "Detailed explanation of step 1."},
+      {"heading": "Step 2", "description": "Detailed explanation of step 2."}
+    ]
+  }
+}
+""", """
+User request: {user_prompt}
+DOT code of the flowchart:
+{dot_code}
+""")
+
+REFINE = PromptTemplate("refine", "1", """
+You change an existing Graphviz DOT diagram as the user asks, changing as little as possible.
+You are shown the DOT code with line numbers. Reply ONLY with edit commands, one per line, using those line numbers:
+DELETE <n>
+REPLACE <n>: <new line>
+INSERT AFTER <n>: <new line>
+1. Keep existing node names, colors and layout unless the request changes them.
+2. New nodes and edges must follow the style of the existing ones and valid Graphviz syntax.
+3. No preamble, explanation or markdown, only the edit commands.
+""", """
+DOT code:
+{numbered_lines}
+
+Change request: {instruction}
+""")
+
+TEMPLATES = {template.name: template for template in (DOT_CODE, FIX_DOT_CODE, TEXT_RESPONSE, REFINE)}
+
+# Part of every result cache key, so results of older templates are not reused
+PROMPT_VERSION = ",".join(f"{template.name}.{template.version}" for template in TEMPLATES.values())
+
+_ERROR_LINE_RE = re.compile(r"\bline (\d+)")
+
+
+def error_lines(error_message):
+    """
+    Line numbers mentioned in a Graphviz or lint error message.
+    """
+    return sorted({int(number) for number in _ERROR_LINE_RE.findall(error_message)})
+
+
+def failing_region(dot_code, error_message, context=None):
+    """
+    The lines a fix prompt needs: those named in the error message plus `context`
+    lines around each (FIX_CONTEXT_LINES, default 3). Falls back to the whole code when
+    the error names no line or the region would cover most of the graph anyway.
+    :return: (numbered lines with "..." marking skipped ones, description of the scope).
+    """
+    context = context if context is not None else int(os.getenv("FIX_CONTEXT_LINES", "3"))
+    lines = dot_code.split("\n")
+    shown = set()
+    for number in error_lines(error_message):
+        if 1 <= number <= len(lines):
+            shown.update(range(max(1, number - context), min(len(lines), number + context) + 1))
+    if not shown or len(shown) > len(lines) * 0.7:
+        shown = set(range(1, len(lines) + 1))
+
+    numbered, previous = [], 0
+    for number in sorted(shown):
+        if number != previous + 1:
+            numbered.append("...")
+        numbered.append(f"{number}| {lines[number - 1]}")
+        previous = number
+    if previous != len(lines):
+        numbered.append("...")
+    scope = "all lines" if len(shown) == len(lines) else "the lines around the error"
+    return "\n".join(numbered), scope
@@ -0,0 +1,175 @@
+import asyncio
+import io
+import math
+import os
+import re
+from dotenv import load_dotenv
+from dot_lint import graph_body_start
+from renderer import render_dot, render_dot_async
+
+load_dotenv()
+
+IMAGE_FORMATS = ("svg", "png", "webp", "jpeg")
+# declared: the engine in the graph's layout attribute (dot if none); auto: see layout_select.py
+LAYOUT_MODES = ("declared", "auto")
+
+# Graph attributes that control output size; the profile replaces whatever the LLM chose.
+# Quoted strings are matched first so text inside labels is never touched.
+_SIZE_ATTRIBUTE_RE = re.compile(
+    r'("(?:[^"\\]|\\.)*")|(?i:\b(?:resolution|dpi|size)\s*=\s*(?:"(?:[^"\\]|\\.)*"|[\w.]+)\s*[;,]?)',
+    re.S
+)
+
+
+class RenderProfile:
+    def __init__(self, name, image_format="jpeg", dpi=96, max_pixels=4_000_000, quality=None, layout="declared"):
+        """
+        Output settings for a rendered diagram.
+        :param name: Profile name, e.g. "preview" or "full".
+        :param image_format: One of IMAGE_FORMATS.
+        :param dpi: Rasterization density passed to Graphviz.
+        :param max_pixels: Upper bound on width * height of raster output.
+        :param quality: JPEG/WebP quality (1-100); needs Pillow. The default of a profile
+            is ignored without it; get_profile refuses an explicit one.
+        :param layout: One of LAYOUT_MODES.
+        """
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError(f"Unsupported image format '{image_format}'. Use one of: {', '.join(IMAGE_FORMATS)}.")
+        if layout not in LAYOUT_MODES:
+            raise ValueError(f"Unsupported layout mode '{layout}'. Use one of: {', '.join(LAYOUT_MODES)}.")
+        self.name = name
+        self.image_format = image_format
+        self.dpi = dpi
+        self.max_pixels = max_pixels
+        self.quality = quality
+        self.layout = layout
+
+    @property
+    def cache_tag(self):
+        tag = f"{self.name}:{self.image_format}:{self.dpi}:{self.max_pixels}:{self.quality}"
+        # Unchanged for the default mode, so existing cache entries stay valid
+        return tag if self.layout == "declared" else f"{tag}:{self.layout}"
+
+    @property
+    def max_size_inches(self):
+        # A square bound keeps width * height within the budget for any aspect ratio
+        return math.sqrt(self.max_pixels) / self.dpi
+
+
+PROFILES = {
+    "preview": RenderProfile("preview", image_format="png", dpi=72, max_pixels=800 * 800),
+    "full": RenderProfile("full", image_format="jpeg", dpi=150, max_pixels=4_000_000, quality=85),
+}
+
+
+def get_profile(name=None, image_format=None, max_pixels=None, quality=None, layout=None):
+    """
+    Resolve a named profile (default: RENDER_PROFILE, else "full") with optional overrides.
+    The layout mode defaults to RENDER_LAYOUT, else "declared".
+    :raises ValueError: Unknown profile name, unsupported format, out-of-range values, or
+        a quality without Pillow.
+    """
+    name = name or os.getenv("RENDER_PROFILE", "full")
+    if name not in PROFILES:
+        raise ValueError(f"Unknown render profile '{name}'. Use one of: {', '.join(PROFILES)}.")
+    base = PROFILES[name]
+    if max_pixels is not None and not 10_000 <= int(max_pixels) <= base.max_pixels * 4:
+        raise ValueError(f"max_pixels must be between 10000 and {base.max_pixels * 4}.")
+    if quality is not None and not 1 <= int(quality) <= 100:
+        raise ValueError("quality must be between 1 and 100.")
+    if quality is not None and not _pillow_available():
+        # Graphviz cannot apply it; refuse rather than silently ignore it
+        raise ValueError("quality is not supported on this server (Pillow is not installed).")
+    return RenderProfile(
+        name,
+        image_format=image_format or base.image_format,
+        dpi=base.dpi,
+        max_pixels=int(max_pixels) if max_pixels is not None else base.max_pixels,
+        quality=int(quality) if quality is not None else base.quality,
+        layout=layout or os.getenv("RENDER_LAYOUT", "declared"),
+    )
+
+
+def profile_from_request(data, image_format=None):
+    """
+    Profile for an API request body with optional 'profile', 'format', 'max_pixels',
+    'quality' and 'layout' fields.
+    :param image_format: Format negotiated from the Accept header; overrides 'format'.
+    :raises ValueError: If any of them is invalid.
+    """
+    data = data or {}
+    return get_profile(
+        name=data.get("profile"),
+        image_format=image_format or data.get("format"),
+        max_pixels=data.get("max_pixels"),
+        quality=data.get("quality"),
+        layout=data.get("layout"),
+    )
+
+
+def apply_profile(dot_code, profile):
+    """
+    Rewrite the graph's dpi/resolution/size attributes so the output stays within the
+    profile's pixel budget. Quoted strings (labels) are left untouched. No line is added
+    or removed, so the line numbers of Graphviz errors point into dot_code.
+    """
+    dot_code = _SIZE_ATTRIBUTE_RE.sub(lambda match: match.group(1) or "\n" * match.group().count("\n"), dot_code)
+
+    body_start = graph_body_start(dot_code)
+    if body_start == -1:
+        return dot_code
+    inches = f"{profile.max_size_inches:.2f}"
+    settings = f' dpi={profile.dpi}; size="{inches},{inches}";'
+    return dot_code[:body_start] + settings + dot_code[body_start:]
+
+
+def _reencode(png, profile):
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(png))
+    if profile.image_format == "jpeg" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    output = io.BytesIO()
+    image.save(output, format=profile.image_format.upper(), quality=profile.quality)
+    return output.getvalue()
+
+
+def _pillow_available():
+    try:
+        import PIL  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _graphviz_format(profile):
+    """
+    Graphviz has no quality setting, so lossy formats with a quality are rendered as
+    PNG and re-encoded with Pillow when it is installed.
+    """
+    if profile.image_format in ("jpeg", "webp") and profile.quality and _pillow_available():
+        return "png"
+    return profile.image_format
+
+
+def render_with_profile(dot_code, profile, engine="dot"):
+    """
+    Render DOT code within the profile's size budget and in its output format.
+    :return: Image bytes.
+    """
+    graphviz_format = _graphviz_format(profile)
+    image = render_dot(apply_profile(dot_code, profile), image_format=graphviz_format, engine=engine)
+    if graphviz_format != profile.image_format:
+        image = _reencode(image, profile)
+    return image
+
+
+async def render_with_profile_async(dot_code, profile, engine="dot"):
+    """
+    Asyncio variant of render_with_profile; re-encoding runs off the event loop.
+    """
+    graphviz_format = _graphviz_format(profile)
+    image = await render_dot_async(apply_profile(dot_code, profile), image_format=graphviz_format, engine=engine)
+    if graphviz_format != profile.image_format:
+        image = await asyncio.get_running_loop().run_in_executor(None, _reencode, image, profile)
+    return image
@@ -0,0 +1,234 @@
+import asyncio
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import graphviz
+from dotenv import load_dotenv
+from resilience import DeadlineExceededError, SlotPool, check_deadline
+
+load_dotenv()
+
+# Make a default Windows Graphviz install reachable; harmless elsewhere
+graphviz_path = r"C:\Program Files\Graphviz\bin"
+if graphviz_path not in os.environ.get("PATH", "").split(os.pathsep):
+    os.environ["PATH"] = os.environ.get("PATH", "") + os.pathsep + graphviz_path
+
+
+# Sets the limits and execs dot where prlimit (util-linux) is missing, e.g. on macOS
+_LIMIT_HELPER = (
+    "import os, resource, sys\n"
+    "cpu, memory = int(sys.argv[1]), int(sys.argv[2])\n"
+    "resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu))\n"
+    "if memory:\n"
+    "    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))\n"
+    "os.execvp(sys.argv[3], sys.argv[3:])\n"
+)
+
+
+class RenderError(RuntimeError):
+    pass
+
+
+class RenderBusyError(RenderError):
+    """
+    All render slots are taken and the queue is full or the wait timed out.
+    """
+    retry_after = 5
+
+
+class RenderLimitError(RenderError):
+    """
+    A render exceeded its wall-clock, CPU or memory limit and was killed.
+    """
+
+
+class RenderPool:
+    def __init__(self, max_concurrent=None, max_queue=None, queue_timeout=None,
+                 render_timeout=None, memory_limit_mb=None):
+        """
+        Bounded set of render slots shared by all requests of this worker, sync and
+        async alike. At most max_concurrent dot processes run at once; up to max_queue more renders
+        wait for a slot (for at most queue_timeout seconds) and anything beyond that is
+        rejected with RenderBusyError. Each dot process is killed after render_timeout
+        seconds and, on POSIX, cannot allocate more than memory_limit_mb of address space.
+        """
+        self.max_concurrent = max_concurrent or int(os.getenv("RENDER_MAX_CONCURRENT", str(os.cpu_count() or 2)))
+        self.max_queue = max_queue if max_queue is not None else int(
+            os.getenv("RENDER_MAX_QUEUE", str(4 * self.max_concurrent)))
+        self.queue_timeout = queue_timeout or float(os.getenv("RENDER_QUEUE_TIMEOUT", "10"))
+        self.render_timeout = render_timeout or float(os.getenv("RENDER_TIMEOUT", "20"))
+        self.memory_limit_mb = memory_limit_mb if memory_limit_mb is not None else int(
+            os.getenv("RENDER_MEMORY_LIMIT_MB", "1024"))
+
+        # One pool for both paths: in the ASGI app, job threads render synchronously
+        # while requests render asynchronously
+        self._slots = SlotPool(self.max_concurrent)
+
+    def _command(self, image_format, engine):
+        """
+        The dot command line. On POSIX it is wrapped so the process cannot allocate more
+        than memory_limit_mb of address space or use more than render_timeout seconds of
+        CPU; the limits are set by prlimit (or a small exec helper) rather than in a
+        preexec_fn, which is not safe in a process with threads.
+        :raises graphviz.ExecutableNotFound: dot is not installed.
+        """
+        cmd = ["dot", f"-K{engine}", f"-T{image_format}"]
+        if shutil.which("dot") is None:
+            raise graphviz.ExecutableNotFound(cmd)
+        if os.name != "posix":
+            return cmd
+        cpu_seconds = int(self.render_timeout) + 1
+        memory = self.memory_limit_mb * 1024 * 1024 if self.memory_limit_mb else 0
+        prlimit = shutil.which("prlimit")
+        if prlimit is not None:
+            return [prlimit, f"--cpu={cpu_seconds}"] + ([f"--as={memory}"] if memory else []) + ["--"] + cmd
+        return [sys.executable, "-c", _LIMIT_HELPER, str(cpu_seconds), str(memory)] + cmd
+
+    def _check_result(self, cmd, returncode, stdout, stderr):
+        if returncode < 0:
+            raise RenderLimitError(
+                f"Rendering was killed by signal {-returncode}; the graph exceeds the "
+                f"{self.render_timeout:g}s CPU or {self.memory_limit_mb} MB memory limit."
+            )
+        if returncode != 0:
+            if b"out of memory" in stderr.lower():
+                raise RenderLimitError(f"Rendering exceeded the {self.memory_limit_mb} MB memory limit.")
+            raise graphviz.CalledProcessError(returncode, cmd, output=stdout, stderr=stderr)
+        return stdout
+
+    def _budget(self, limit):
+        """
+        A wait limit capped by the request deadline, if any.
+        :return: (seconds, whether the deadline is the tighter bound)
+        :raises DeadlineExceededError: The deadline has already passed.
+        """
+        remaining = check_deadline("rendering")
+        if remaining is not None and remaining < limit:
+            return remaining, True
+        return limit, False
+
+    def _queue_timeout_error(self, deadline):
+        if deadline:
+            return DeadlineExceededError("Request deadline exceeded while waiting for a render slot.")
+        return RenderBusyError(f"No render slot became free within {self.queue_timeout:g}s.")
+
+    def _render_timeout_error(self, deadline, timeout):
+        if deadline:
+            return DeadlineExceededError("Request deadline exceeded while rendering.")
+        return RenderLimitError(f"Rendering took longer than {timeout:g}s and was stopped.")
+
+    def render(self, dot_code, image_format="jpeg", engine="dot", timeout=None):
+        """
+        Render DOT code in a bounded slot, piping the source to Graphviz over stdin.
+        :param timeout: Time limit of this render below render_timeout, e.g. for speculative layouts.
+        :return: Rendered image bytes.
+        :raises RenderBusyError: No slot became free in time.
+        :raises RenderLimitError: The render was killed for exceeding a limit.
+        :raises DeadlineExceededError: The request deadline passed while waiting or rendering.
+        :raises graphviz.CalledProcessError: Graphviz rejected the DOT code.
+        """
+        cmd = self._command(image_format, engine)
+        queue_timeout, queue_deadline = self._budget(self.queue_timeout)
+        if self._slots.waiting >= self.max_queue:
+            raise RenderBusyError("Render queue is full, please retry shortly.")
+        if not self._slots.acquire(timeout=queue_timeout):
+            raise self._queue_timeout_error(queue_deadline)
+
+        try:
+            render_timeout, render_deadline = self._budget(min(timeout or self.render_timeout, self.render_timeout))
+            completed = subprocess.run(
+                cmd,
+                input=dot_code.encode("utf-8"),
+                capture_output=True,
+                timeout=render_timeout
+            )
+        except FileNotFoundError as e:
+            raise graphviz.ExecutableNotFound(cmd) from e
+        except subprocess.TimeoutExpired:
+            raise self._render_timeout_error(render_deadline, render_timeout)
+        finally:
+            self._slots.release()
+
+        return self._check_result(cmd, completed.returncode, completed.stdout, completed.stderr)
+
+    async def render_async(self, dot_code, image_format="jpeg", engine="dot", timeout=None):
+        """
+        Asyncio variant of render with the same limits, for the ASGI app.
+        """
+        cmd = self._command(image_format, engine)
+        queue_timeout, queue_deadline = self._budget(self.queue_timeout)
+        if self._slots.waiting >= self.max_queue:
+            raise RenderBusyError("Render queue is full, please retry shortly.")
+        if not await self._slots.aacquire(timeout=queue_timeout):
+            raise self._queue_timeout_error(queue_deadline)
+
+        try:
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *cmd,
+                    stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE
+                )
+            except FileNotFoundError as e:
+                raise graphviz.ExecutableNotFound(cmd) from e
+
+            render_timeout, render_deadline = self._budget(min(timeout or self.render_timeout, self.render_timeout))
+            try:
+                stdout, stderr = await asyncio.wait_for(
+                    process.communicate(dot_code.encode("utf-8")),
+                    timeout=render_timeout
+                )
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                raise self._render_timeout_error(render_deadline, render_timeout)
+        finally:
+            self._slots.release()
+
+        return self._check_result(cmd, process.returncode, stdout, stderr)
+
+    def stats(self):
+        return {
+            "max_concurrent": self.max_concurrent,
+            "waiting": self._slots.waiting,
+        }
+
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+
+def get_render_pool():
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            _render_pool = RenderPool()
+        return _render_pool
+
+
+def render_dot(dot_code, image_format="jpeg", engine="dot", timeout=None):
+    """
+    Render DOT code in memory. The source is piped to Graphviz over stdin and the
+    image is read back from stdout, so no files are written and concurrent renders
+    cannot collide. Runs in the worker's RenderPool, which bounds concurrency and
+    enforces time and memory limits.
+    :param dot_code: DOT source to render.
+    :param image_format: Graphviz output format (jpeg, png, svg, ...).
+    :param engine: Graphviz layout engine.
+    :param timeout: Time limit in seconds, at most RENDER_TIMEOUT.
+    :return: Rendered image bytes.
+    """
+    return get_render_pool().render(dot_code, image_format=image_format, engine=engine, timeout=timeout)
+
+
+async def render_dot_async(dot_code, image_format="jpeg", engine="dot", timeout=None):
+    """
+    Asyncio variant of render_dot for the ASGI app: runs Graphviz with
+    asyncio.create_subprocess_exec so the event loop keeps serving other requests.
+    Raises the same exceptions as render_dot.
+    """
+    return await get_render_pool().render_async(dot_code, image_format=image_format, engine=engine,
+                                                timeout=timeout)
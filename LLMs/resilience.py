@@ -0,0 +1,432 @@
+import asyncio
+import contextvars
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from metrics import LLM_RETRIES
+
+load_dotenv()
+
+
+class ResilienceError(RuntimeError):
+    retry_after = 5
+
+
+class CircuitOpenError(ResilienceError):
+    """
+    The backend's circuit is open: recent calls failed or were too slow, so calls
+    fail fast until the cool-down has passed.
+    """
+
+    def __init__(self, backend, retry_after):
+        super().__init__(f"The '{backend}' backend is unavailable; retry in {retry_after:.0f}s.")
+        self.backend = backend
+        self.retry_after = max(1, int(retry_after + 0.999))
+
+
+class DeadlineExceededError(ResilienceError):
+    """
+    The request ran out of its overall time budget (REQUEST_DEADLINE).
+    """
+
+
+# Absolute time.monotonic() deadline of the current request, or None
+_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+
+@contextmanager
+def request_deadline(seconds=None):
+    """
+    Give everything run inside the block an overall time budget. LLM calls, renders and
+    waits for other stages use at most the remaining time and fail with
+    DeadlineExceededError once it is spent. Nested blocks keep the earlier deadline.
+    """
+    seconds = seconds or float(os.getenv("REQUEST_DEADLINE", "90"))
+    deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(deadline if current is None else min(current, deadline))
+    try:
+        yield
+    finally:
+        try:
+            _deadline.reset(token)
+        except ValueError:
+            # A streamed response's generator can be finished from another context
+            _deadline.set(current)
+
+
+def remaining_time():
+    """
+    Seconds left before the current request's deadline (0 once it passed), or None without a deadline.
+    """
+    deadline = _deadline.get()
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+
+def check_deadline(stage):
+    """
+    :return: Seconds left (None without a deadline).
+    :raises DeadlineExceededError: No time is left for stage.
+    """
+    remaining = remaining_time()
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceededError(f"Request deadline exceeded before {stage}.")
+    return remaining
+
+
+def submit_in_context(executor, fn, *args):
+    """
+    executor.submit that carries the caller's context (and so its deadline) into the worker thread.
+    """
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+class SlotPool:
+    def __init__(self, size):
+        """
+        Counting semaphore shared by threads and event loops, so sync callers (the Flask
+        app, job threads) and async ones (the Quart app) draw from one limit. Waiters
+        are served in arrival order.
+        """
+        self.size = size
+        self._lock = threading.Lock()
+        self._active = 0
+        # Wake callbacks of waiting callers, each in a one-item list that is cleared once served
+        self._waiters = deque()
+
+    @property
+    def waiting(self):
+        with self._lock:
+            return len(self._waiters)
+
+    def _enter(self, wake):
+        """
+        :return: None when a slot was taken, else the queued waiter.
+        """
+        with self._lock:
+            if self._active < self.size and not self._waiters:
+                self._active += 1
+                return None
+            waiter = [wake]
+            self._waiters.append(waiter)
+            return waiter
+
+    def _abandon(self, waiter):
+        """
+        :return: False when the waiter was handed a slot meanwhile and now holds it.
+        """
+        with self._lock:
+            if not waiter[0]:
+                return False
+            self._waiters.remove(waiter)
+            return True
+
+    def acquire(self, timeout=None):
+        """
+        :return: False when no slot became free within timeout seconds.
+        """
+        event = threading.Event()
+        waiter = self._enter(event.set)
+        return waiter is None or event.wait(timeout) or not self._abandon(waiter)
+
+    async def aacquire(self, timeout=None):
+        """
+        Asyncio variant of acquire.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        waiter = self._enter(wake)
+        if waiter is None:
+            return True
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return not self._abandon(waiter)
+        except asyncio.CancelledError:
+            if not self._abandon(waiter):
+                self.release()
+            raise
+
+    def release(self):
+        """
+        Free a slot, handing it straight to the longest waiting caller if any.
+        """
+        with self._lock:
+            if not self._waiters:
+                self._active -= 1
+                return
+            waiter = self._waiters.popleft()
+            wake, waiter[0] = waiter[0], None
+        wake()
+
+
+def timeout_kwargs(timeout, cap=None):
+    """
+    Per-call timeout keyword for the OpenAI/Groq SDKs; empty when there is no deadline,
+    since timeout=None would disable the client's own timeout.
+    """
+    if timeout is None:
+        return {}
+    return {"timeout": max(0.1, min(timeout, cap) if cap else timeout)}
+
+
+class CircuitBreaker:
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+    def __init__(self, name, window=None, min_calls=None, error_rate=None, slow_call_seconds=None,
+                 slow_call_rate=None, open_seconds=None):
+        """
+        Per-backend circuit breaker over the outcomes of the last `window` calls.
+        The circuit opens when at least min_calls were made and either the share of failed
+        calls reaches error_rate or the share of calls slower than slow_call_seconds reaches
+        slow_call_rate. After open_seconds one trial call is let through (half-open); its
+        success closes the circuit, its failure opens it again.
+        """
+        self.name = name
+        self.window = window or int(os.getenv("CIRCUIT_WINDOW", "20"))
+        self.min_calls = min_calls or int(os.getenv("CIRCUIT_MIN_CALLS", "5"))
+        self.error_rate = error_rate or float(os.getenv("CIRCUIT_ERROR_RATE", "0.5"))
+        self.slow_call_seconds = slow_call_seconds or float(os.getenv("CIRCUIT_SLOW_CALL_SECONDS", "30"))
+        self.slow_call_rate = slow_call_rate or float(os.getenv("CIRCUIT_SLOW_CALL_RATE", "0.8"))
+        self.open_seconds = open_seconds or float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"))
+
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen=self.window)
+        self.state = self.CLOSED
+        self._opened_until = 0.0
+        self._trial_started = None
+
+    def allow(self):
+        """
+        :raises CircuitOpenError: The circuit is open, or half-open with its trial call in flight.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.OPEN:
+                if now < self._opened_until:
+                    raise CircuitOpenError(self.name, self._opened_until - now)
+                self.state = self.HALF_OPEN
+                self._trial_started = None
+            if self.state == self.HALF_OPEN:
+                # A trial that never reported back (e.g. a cancelled call) must not block forever
+                if self._trial_started is not None and now - self._trial_started < self.open_seconds:
+                    raise CircuitOpenError(self.name, self.open_seconds - (now - self._trial_started))
+                self._trial_started = now
+
+    def record(self, ok, latency=None):
+        """
+        Report a finished call. Latency None (e.g. for streams) only counts the outcome.
+        """
+        slow = latency is not None and latency >= self.slow_call_seconds
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                if ok and not slow:
+                    self.state = self.CLOSED
+                    self._outcomes.clear()
+                    print(f"Circuit for '{self.name}' closed.")
+                else:
+                    self._trip()
+                return
+
+            self._outcomes.append((ok, slow))
+            calls = len(self._outcomes)
+            if calls < self.min_calls:
+                return
+            failures = sum(1 for ok, _ in self._outcomes if not ok)
+            slow_calls = sum(1 for _, slow in self._outcomes if slow)
+            if failures / calls >= self.error_rate or slow_calls / calls >= self.slow_call_rate:
+                self._trip()
+
+    def _trip(self):
+        self.state = self.OPEN
+        self._opened_until = time.monotonic() + self.open_seconds
+        self._outcomes.clear()
+        print(f"Circuit for '{self.name}' opened for {self.open_seconds:g}s.")
+
+    def stats(self):
+        with self._lock:
+            return {"state": self.state, "recent_calls": len(self._outcomes)}
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(backend):
+    with _breakers_lock:
+        breaker = _breakers.get(backend)
+        if breaker is None:
+            breaker = _breakers[backend] = CircuitBreaker(backend)
+        return breaker
+
+
+def circuit_stats():
+    with _breakers_lock:
+        breakers = dict(_breakers)
+    return {name: breaker.stats() for name, breaker in breakers.items()}
+
+
+def is_transient(error):
+    """
+    Whether retrying or failing over may help: connection problems, timeouts,
+    rate limits and 5xx responses. Other API errors (4xx) are the request's fault.
+    """
+    from client_pool import _is_connection_error
+
+    if _is_connection_error(error) or isinstance(error, (TimeoutError, asyncio.TimeoutError)):
+        return True
+    status = getattr(error, "status_code", None)
+    return status in (408, 409, 429) or (isinstance(status, int) and status >= 500)
+
+
+def backoff_delay(attempt, base=None, cap=None):
+    """
+    Exponential backoff with full jitter: uniform in [0, min(cap, base * 2**attempt)].
+    """
+    base = base or float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+    cap = cap or float(os.getenv("LLM_BACKOFF_CAP", "8"))
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def _max_retries(retries):
+    return retries if retries is not None else int(os.getenv("LLM_MAX_RETRIES", "2"))
+
+
+def _retry_delay(backend, error, attempt, retries):
+    """
+    Delay before the next attempt, or None when the error should be raised.
+    """
+    remaining = remaining_time()
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceededError(f"Request deadline exceeded while calling '{backend}'.") from error
+    if not is_transient(error) or attempt >= retries:
+        return None
+    delay = backoff_delay(attempt)
+    if remaining is not None and delay >= remaining:
+        return None
+    LLM_RETRIES.inc(backend=backend)
+    print(f"'{backend}' call failed ({error}); retry {attempt + 1}/{retries} in {delay:.2f}s.")
+    return delay
+
+
+def _record(breaker, error, latency):
+    # Calls cut short by our own deadline say nothing about the backend's health
+    remaining = remaining_time()
+    if remaining is not None and remaining <= 0:
+        return
+    breaker.record(error is None or not is_transient(error), latency)
+
+
+def resilient_call(backend, call, retries=None):
+    """
+    Call a backend through its circuit breaker, retrying transient failures with
+    jittered exponential backoff within the request deadline.
+    :param backend: Breaker name, e.g. "openrouter" or "groq".
+    :param call: Callable taking the timeout (seconds or None) for this attempt.
+    :raises CircuitOpenError: The backend's circuit is open.
+    :raises DeadlineExceededError: The request deadline passed.
+    """
+    breaker = get_circuit_breaker(backend)
+    retries = _max_retries(retries)
+    attempt = 0
+    while True:
+        timeout = check_deadline(f"calling '{backend}'")
+        breaker.allow()
+        start = time.perf_counter()
+        try:
+            result = call(timeout)
+        except Exception as e:
+            _record(breaker, e, time.perf_counter() - start)
+            delay = _retry_delay(backend, e, attempt, retries)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            attempt += 1
+            continue
+        _record(breaker, None, time.perf_counter() - start)
+        return result
+
+
+async def aresilient_call(backend, call, retries=None):
+    """
+    Asyncio variant of resilient_call; call returns an awaitable.
+    """
+    breaker = get_circuit_breaker(backend)
+    retries = _max_retries(retries)
+    attempt = 0
+    while True:
+        timeout = check_deadline(f"calling '{backend}'")
+        breaker.allow()
+        start = time.perf_counter()
+        try:
+            result = await call(timeout)
+        except Exception as e:
+            _record(breaker, e, time.perf_counter() - start)
+            delay = _retry_delay(backend, e, attempt, retries)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            attempt += 1
+            continue
+        _record(breaker, None, time.perf_counter() - start)
+        return result
+
+
+@contextmanager
+def guarded_stream(backend):
+    """
+    Circuit breaker and deadline check around a streamed call, which cannot be retried
+    once tokens were passed on. Only the outcome is recorded, not the stream's duration.
+    :return: The timeout for the call (seconds or None).
+    """
+    breaker = get_circuit_breaker(backend)
+    timeout = check_deadline(f"calling '{backend}'")
+    breaker.allow()
+    try:
+        yield timeout
+    except Exception as e:
+        _record(breaker, e, None)
+        raise
+    _record(breaker, None, None)
+
+
+def call_with_fallback(calls):
+    """
+    Try backends in order, moving on when one fails (including an open circuit).
+    :param calls: List of (name, zero-argument callable).
+    :raises DeadlineExceededError: Immediately; falling back cannot help.
+    :return: The first successful result; otherwise the last error is raised.
+    """
+    for index, (name, call) in enumerate(calls):
+        try:
+            return call()
+        except DeadlineExceededError:
+            raise
+        except Exception as e:
+            if index == len(calls) - 1:
+                raise
+            print(f"'{name}' failed ({e}); falling back to '{calls[index + 1][0]}'.")
+
+
+async def acall_with_fallback(calls):
+    """
+    Asyncio variant of call_with_fallback; the callables return awaitables.
+    """
+    for index, (name, call) in enumerate(calls):
+        try:
+            return await call()
+        except DeadlineExceededError:
+            raise
+        except Exception as e:
+            if index == len(calls) - 1:
+                raise
+            print(f"'{name}' failed ({e}); falling back to '{calls[index + 1][0]}'.")
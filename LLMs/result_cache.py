@@ -0,0 +1,232 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from dotenv import load_dotenv
+from metrics import CACHE_LOOKUPS
+
+load_dotenv()
+
+
+def normalize_prompt(user_prompt):
+    """
+    Canonical form of a prompt for cache lookups: case, surrounding punctuation
+    and whitespace differences do not change the generated diagram.
+    """
+    text = unicodedata.normalize("NFKC", user_prompt).casefold()
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.strip(" .!?")
+
+
+def make_cache_key(user_prompt, model_names, prompt_version, render_tag=""):
+    """
+    Content-addressed key for a pipeline result.
+    :param user_prompt: Prompt provided by the user.
+    :param model_names: Models used by the pipeline stages, in order.
+    :param prompt_version: Version of the prompt templates that produced the result.
+    :param render_tag: Render profile settings, so each output variant is cached separately.
+    :return: Hex SHA-256 digest.
+    """
+    payload = json.dumps(
+        [normalize_prompt(user_prompt), list(model_names), str(prompt_version), render_tag],
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def handler_cache_key(query_handler, user_prompt, profile=None):
+    """
+    Cache key for a prompt answered by a GrokHandler-style handler and rendered with profile.
+    """
+    return make_cache_key(
+        user_prompt,
+        query_handler.model_names,
+        query_handler.PROMPT_VERSION,
+        profile.cache_tag if profile is not None else ""
+    )
+
+
+def refine_cache_key(query_handler, parent_id, instruction, profile=None):
+    """
+    Cache key for a refinement of the cached result parent_id; refinements of
+    refinements chain through their own keys.
+    """
+    return make_cache_key(
+        f"{parent_id} {instruction}",
+        query_handler.model_names,
+        f"refine:{query_handler.PROMPT_VERSION}",
+        profile.cache_tag if profile is not None else ""
+    )
+
+
+class CachedResult:
+    def __init__(self, dot_code, image, explanation, image_format="jpeg", user_prompt=None):
+        self.dot_code = dot_code
+        self.image = image
+        self.explanation = explanation
+        self.image_format = image_format
+        # The prompt the diagram was first generated for, so refinements are explained for it
+        self.user_prompt = user_prompt
+        self._etag = None
+
+    @property
+    def etag(self):
+        """
+        Strong validator for the rendered image: a digest of its bytes.
+        """
+        if self._etag is None:
+            self._etag = hashlib.sha256(self.image).hexdigest()[:32]
+        return self._etag
+
+    @property
+    def size(self):
+        return len(self.image) + len(self.dot_code) + len(self.explanation) + len(self.user_prompt or "")
+
+
+class ResultCache:
+    def __init__(self, max_entries=None, db_path=None, ttl=None, max_db_bytes=None):
+        """
+        Two-tier cache of final DOT code, rendered image bytes and explanations.
+        The first tier is an in-memory LRU; the optional second tier is a SQLite file
+        that survives restarts and can be shared by the workers of one host.
+        :param max_entries: Capacity of the in-memory LRU.
+        :param db_path: SQLite file for the second tier, or None to disable it.
+        :param ttl: Seconds after which an entry is treated as missing.
+        :param max_db_bytes: Size budget for the SQLite tier; least recently used entries are evicted.
+        """
+        self.max_entries = max_entries or int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "256"))
+        self.ttl = ttl or float(os.getenv("RESULT_CACHE_TTL", "86400"))
+        self.max_db_bytes = max_db_bytes or int(os.getenv("RESULT_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+        db_path = db_path if db_path is not None else os.getenv("RESULT_CACHE_DB")
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=10)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                " key TEXT PRIMARY KEY, dot_code TEXT, image BLOB, image_format TEXT,"
+                " explanation TEXT, size INTEGER, created_at REAL, accessed_at REAL, user_prompt TEXT)"
+            )
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(results)")]
+            if "user_prompt" not in columns:
+                # Files written before prompts were kept
+                self._db.execute("ALTER TABLE results ADD COLUMN user_prompt TEXT")
+            self._db.commit()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Look up a result, promoting disk hits into memory.
+        :return: CachedResult or None.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created_at, result = entry
+                if now - created_at <= self.ttl:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    CACHE_LOOKUPS.inc(outcome="memory_hit")
+                    return result
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT dot_code, image, image_format, explanation, created_at, user_prompt FROM results"
+                    " WHERE key = ?",
+                    (key,),
+                ).fetchone()
+                if row is not None and now - row[4] <= self.ttl:
+                    self._db.execute("UPDATE results SET accessed_at = ? WHERE key = ?", (now, key))
+                    self._db.commit()
+                    result = CachedResult(row[0], row[1], row[3], row[2], row[5])
+                    self._remember(key, result, row[4])
+                    self.hits += 1
+                    self.disk_hits += 1
+                    CACHE_LOOKUPS.inc(outcome="disk_hit")
+                    return result
+
+            self.misses += 1
+            CACHE_LOOKUPS.inc(outcome="miss")
+            return None
+
+    def put(self, key, result):
+        now = time.time()
+        with self._lock:
+            self._remember(key, result, now)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO results (key, dot_code, image, image_format, explanation, size,"
+                    " created_at, accessed_at, user_prompt) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (key, result.dot_code, result.image, result.image_format,
+                     result.explanation, result.size, now, now, result.user_prompt),
+                )
+                self._evict_disk(now)
+                self._db.commit()
+
+    async def aget(self, key):
+        """
+        get for the asyncio app; runs off the event loop, since it takes the cache lock
+        and may read the SQLite tier.
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self.get, key)
+
+    async def aput(self, key, result):
+        """
+        put for the asyncio app, off the event loop.
+        """
+        await asyncio.get_running_loop().run_in_executor(None, self.put, key, result)
+
+    def _remember(self, key, result, created_at):
+        self._memory[key] = (created_at, result)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self, now):
+        self._db.execute("DELETE FROM results WHERE created_at < ?", (now - self.ttl,))
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_db_bytes:
+            return
+        for key, size in self._db.execute(
+                "SELECT key, size FROM results ORDER BY accessed_at").fetchall():
+            self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_db_bytes:
+                break
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "memory_entries": len(self._memory),
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResultCache()
+        return _cache
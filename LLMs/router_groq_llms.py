@@ -1,214 +1,292 @@
 import os
-from openai import OpenAI
-from langchain_groq import ChatGroq
+from functools import partial
 from dotenv import load_dotenv
-import re
-from graphviz import Source
+from backends import DEFAULT_MODELS, get_backend, stage_backends
+from renderer import RenderError
+from layout_select import declared_layout, get_layout_selector, with_layout
+from render_profiles import get_profile, render_with_profile
+from dot_lint import DotStreamExtractor, check_dot_code, dot_code_parses, extract_dot_code
+from dot_edit import apply_refinement, number_lines
+from prompt_templates import DOT_CODE, FIX_DOT_CODE, PROMPT_VERSION, REFINE, TEXT_RESPONSE, failing_region
+from hedging import hedged_call, parse_hedge_backends
+from resilience import DeadlineExceededError, ResilienceError, call_with_fallback, check_deadline, guarded_stream
+from metrics import FIX_RETRIES, PAYLOAD_BYTES, record_payload, record_render_failure, stage_timer
 
 load_dotenv()
 
 
-class GrokHandler:
-    def __init__(self, openrouter_model="anthropic/claude-3.5-haiku-20241022:beta",
-                 groq_model="llama-3.3-70b-versatile"):
-        """
-        Initializes the QueryHandler with both OpenRouter and Groq clients.
-        """
-        # OpenRouter initialization
-        self.openrouter_api_key = os.getenv("OPENROUTER_API_KEY")
-        if not self.openrouter_api_key:
-            raise ValueError("OPENROUTER_API_KEY environment variable not set.")
-
-        self.openrouter_client = OpenAI(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=self.openrouter_api_key,
-            default_headers={
-                "HTTP-Referer": "null",
-                "X-Title": "Text2Block",
-            }
-        )
-        self.openrouter_model = openrouter_model
+def run_steps(steps, calls):
+    """
+    Drive a generator that yields (name, *args) for the calls it needs, such as
+    GrokHandler._render_steps, by running calls[name](*args) and sending back the result
+    or throwing the exception in.
+    :return: The generator's return value.
+    """
+    try:
+        request = next(steps)
+        while True:
+            try:
+                result = calls[request[0]](*request[1:])
+            except Exception as e:
+                request = steps.throw(e)
+            else:
+                request = steps.send(result)
+    except StopIteration as stop:
+        return stop.value
+
 
-        # Groq initialization
-        self.groq_api_key = os.getenv("GROQ_API_KEY")
-        if not self.groq_api_key:
-            raise ValueError("GROQ_API_KEY environment variable not set.")
+class GrokHandler:
+    # Versions of the templates in prompt_templates.py, so cached results from older prompts are not reused
+    PROMPT_VERSION = PROMPT_VERSION
 
-        self.groq_client = ChatGroq(
-            groq_api_key=self.groq_api_key,
-            model_name=groq_model
+    def __init__(self, openrouter_model=DEFAULT_MODELS["openrouter"], groq_model=DEFAULT_MODELS["groq"],
+                 hedge_backends=None, stages=None):
+        """
+        The pipeline engine: prompts, parsing and the fix loop, with every LLM call going
+        to the backend chain of its stage (generate, fix, explain, refine; see backends.py).
+        By default DOT code comes from OpenRouter and explanations from Groq, each falling
+        back to the other; LLM_<STAGE>_BACKENDS changes a stage per deployment.
+        :param stages: Dict of stage -> backend chain ("groq:llama-3.1-8b-instant,openrouter"
+            or list of Backend), taking precedence over the environment.
+        :param hedge_backends: Backends raced against the primary generate backend, in the
+            DOT_HEDGE_BACKENDS format (e.g. "groq"); defaults to that variable, empty disables hedging.
+        """
+        self.stages = stage_backends(openrouter_model, groq_model, stages)
+        hedge_backends = parse_hedge_backends(
+            hedge_backends if hedge_backends is not None else os.getenv("DOT_HEDGE_BACKENDS", "")
         )
-        self.groq_model = groq_model
-
-        # Provider configuration for OpenRouter
-        self.provider_config = {
-            "provider": {
-                "order": ["Anthropic", "Google Vertex"]
-            },
-            "allow_fallbacks": False
-        }
+        self.hedge_backends = [
+            get_backend(f"{provider}:{model or (groq_model if provider == 'groq' else openrouter_model)}")
+            for provider, model in hedge_backends
+        ]
+        # Stream DOT generation and stop it once the graph closes, instead of paying for
+        # whatever the model writes after it
+        self.stream_dot_code = os.getenv("DOT_STREAM", "on").lower() not in ("0", "off", "false", "no")
+        for backends in self.stages.values():
+            for backend in backends:
+                # Fails at startup rather than on the first request when a key is missing
+                backend.client()
 
-    def generate_dot_code(self, user_prompt):
+    @property
+    def model_names(self):
+        """
+        Primary backend of every stage, e.g. ["generate=openrouter:...", ...]; part of
+        result cache keys, since another model gives another result.
         """
-        Generate DOT code using OpenRouter/Claude.
-        """
-        prompt = (
-            f"You are a personal assistant responsible for generating DOT language code to help users understand complex topics.\n "
-            f"The DOT code must create clear and visually appealing diagrams \ flowcharts that are suitable to user query. \n"
-
-            f"The User Query is : {user_prompt} \n\n"
-            f"Follow these **guidelines** while generating the DOT code:\n\n"
-            f"1. Begin the DOT code with [resolution=900] to ensure high resolution.\n"
-            f"2. STRICTLY The graph name **must not** contain spaces, but node and edge names may include spaces."
-            f"  - for example [digraph MDSembeddingsplot] is right way of naming a graph, but not [digraph MDS embeddings plot]\n"
-            f"3. The dot code MUST contain digraph or graph or any type of graph available in GRAPHVIZ library suitable to the user query. \n "
-            f"4. You can follow different layouts [dot, neato, dfp, sfdp, circo, twopi, osage and patchwork] whichever suitable to User Query in the dot code. \n"
-            f"5. Use valid Graphviz-supported or custom hexadecimal colors (\"#4CAF50\").\n"
-            f"6. If color not specified in user query, use flowchart suitable pastel colors for diagram elements with good text contrast to ensure readability.\n"
-            f"7. Validate the DOT code to ensure it complies with Graphviz syntax and avoid reserved keywords or invalid node names and ensure the resolution is set to 900 in the beginning of the code. \n"
-            f"This is the example structure you can follow for the parameters to include in the start of the code:\n"
-            f"digraph nameofgraph {{resolution = 900 layout= circo; rest of the code}}"
-            # f"8. When using multi-line labels in dot code, use '\\n' explicitly for line breaks."
-            # f" avoid inserting 'n' in front of other words like 'nError', 'ngradient' etc .\n"
-            f"8. If the input cannot be expressed in a flowchart (e.g., typos or meaningless queries), generate a DOT flowchart with one square box containing:\n"
-            f"   [It seems like there might have been a typo or error. Please elaborate your requirement for better understanding.]\n"
-            f"9. The output should only be DOT CODE, STRICTLY Avoid preamble, unnecessary comments, or extraneous symbols,  \n\n"
+        return [f"{stage}={backends[0].name}" for stage, backends in self.stages.items()]
 
-        )
+    def dot_code_prompt(self, user_prompt):
+        """
+        Build the DOT generation prompt.
+        """
+        return DOT_CODE.render(user_prompt=user_prompt)
 
-        try:
-            response = self.openrouter_client.chat.completions.create(
-                model=self.openrouter_model,
-                messages=[{"role": "user", "content": prompt}],
-                extra_headers={"X-Custom-Provider": str(self.provider_config)}
-            )
-
-            dot_code = response.choices[0].message.content.strip()
-
-            # Extract and validate DOT code
-            if "digraph" in dot_code:
-                dot_code_start = dot_code.find("digraph")
-                dot_code = dot_code[dot_code_start:].strip()
-            elif "graph" in dot_code:
-                dot_code_start = dot_code.find("graph")
-                dot_code = dot_code[dot_code_start:].strip()
-            else:
-                print("Warning: Generated DOT code does not contain 'digraph' or 'graph'.")
+    def _dot_code(self, backend, prompt, stage):
+        if self.stream_dot_code:
+            response = backend.complete_streamed(prompt, stage, DotStreamExtractor).dot_code
+        else:
+            response = backend.complete(prompt, stage)
+        # Extract the DOT code and repair mechanical errors locally
+        dot_code = extract_dot_code(response)
+        record_payload("dot_code", dot_code)
+        return dot_code
 
-            # Cleanup DOT code
-            #dot_code = re.sub(r"[^a-zA-Z0-9\s\-\->;{}\"\\\[\]=#\+\-\*/\^%()]", " ", dot_code)
-            return dot_code
+    def _text(self, backend, prompt, stage):
+        explanation = backend.complete(prompt, stage).strip()
+        record_payload("explanation", explanation)
+        return explanation
 
-        except Exception as e:
-            raise Exception(f"Error in OpenRouter API call: {e}")
+    def dot_code_backends(self):
+        """
+        DOT generation backends: with hedge backends configured, the primary generate
+        backend followed by them, in hedging order; otherwise the generate chain.
+        :return: List of Backend.
+        """
+        if self.hedge_backends:
+            return self.stages["generate"][:1] + self.hedge_backends
+        return self.stages["generate"]
 
-    def fix_dot_code(self, dot_code, error_message):
+    def generate_dot_code(self, user_prompt):
+        """
+        Generate DOT code with the generate backends. With hedge backends configured, the
+        same prompt goes to the next backend once the primary is slower than its recent
+        tail latency, and the first answer that passes the syntax check wins. Without
+        them, a failing backend falls back to the next one of the chain.
+        """
+        prompt = self.dot_code_prompt(user_prompt)
+        calls = [(backend.name, partial(self._dot_code, backend, prompt, "generate_dot_code"))
+                 for backend in self.dot_code_backends()]
+        if self.hedge_backends:
+            return hedged_call(calls, dot_code_parses)
+        return call_with_fallback(calls)
+
+    def fix_dot_code_prompt(self, dot_code, error_message):
+        """
+        Build the prompt asking the LLM to fix DOT code that failed to render. Only the
+        lines around the ones named in the error are sent, and only edits come back.
         """
-        Use OpenRouter/Claude to fix the DOT code based on the error message.
-        """
-        prompt = (
-            f"Your task is to fix the errors and generate an error free dot code, while making sure it can render successfully as a flowchart. \n"
-            f"The dot code is: \n {dot_code} \n"
-            f"is showing this Error message: {error_message} \n"
-            f"Please follow the below guidelines while generating the corrected code:"
-            f"1. Firstly find the issues with given dot code and correct them. \n"
-            f"2. Make sure the given Error message is rectified and name of the graph is not having spaces .\n"
-            f" for example [digraph MDSembeddingsplot] is right way of naming a graph, but not [digraph MDS embeddings plot]\n"
-            f"3. If node or edge names include spaces, enclose them in double quotes to avoid syntax errors. "
-            f"   - For example: [node1 -> \"Node With Spaces\"] is valid.\n"
-            f"4. Set the resolution of DOT code as 900 [resolution=900] in the beginning of the code "
-            f"5. Make sure the corrected dot code carries the similar information as the original dot code carried. \n"
-            f"6. The dot code MUST contain digraph or graph or a suitable type of graph suitable to the dot code. \n"
-            f"7. Validate the DOT code to ensure it complies with Graphviz syntax and avoid reserved keywords or invalid node names (e.g., do not use 'subgraph' as a node name unless it is meant to represent a subgraph).\n"
-            f"   - If a reserved term is used incorrectly, suggest an alternative or provide a corrected version.\n"
-            f"   Example: If 'subgraph' is used as a node name, rename it to avoid conflicts or use proper subgraph syntax.\n"
-            f"8. Ensure the use of '->' for directed graphs (digraph) and '--' for undirected graphs (graph) to avoid syntax errors.\n"
-            f"9. STRICTLY NO PREAMBLE OR UNNECESSARY COMMENTS, Generate only DOT code as Output. \n"
+        numbered_lines, scope = failing_region(dot_code, error_message)
+        return FIX_DOT_CODE.render(
+            line_count=len(dot_code.split("\n")), scope=scope, numbered_lines=numbered_lines,
+            error_message=error_message.strip()
         )
 
-        try:
-            response = self.openrouter_client.chat.completions.create(
-                model=self.openrouter_model,
-                messages=[{"role": "user", "content": prompt}],
-                extra_headers={"X-Custom-Provider": str(self.provider_config)}
-            )
-
-            dot_code = response.choices[0].message.content.strip()
-
-            # Extract and validate DOT code
-            if "digraph" in dot_code:
-                dot_code_start = dot_code.find("digraph")
-                dot_code = dot_code[dot_code_start:].strip()
-            elif "graph" in dot_code:
-                dot_code_start = dot_code.find("graph")
-                dot_code = dot_code[dot_code_start:].strip()
-            else:
-                print("Warning: Generated DOT code does not contain 'digraph' or 'graph'.")
+    def fix_dot_code(self, dot_code, error_message):
+        """
+        Fix the DOT code based on the error message with the fix backends.
+        """
+        prompt = self.fix_dot_code_prompt(dot_code, error_message)
+        return call_with_fallback([
+            (backend.name, partial(self._edited_dot_code, backend, prompt, dot_code, "fix_dot_code"))
+            for backend in self.stages["fix"]
+        ])
 
-            # Cleanup DOT code
-            #dot_code = re.sub(r"[^a-zA-Z0-9\s\-\->;{}\"\\\[\]=#\+\-\*/\^%()]", " ", dot_code)
-            return dot_code
+    def refine_prompt(self, dot_code, instruction):
+        """
+        Build the prompt asking for the edits that apply an instruction to existing DOT code.
+        The code is sent with line numbers and only the changed lines come back, which
+        keeps the response short and leaves the rest of the diagram untouched.
+        """
+        return REFINE.render(numbered_lines=number_lines(dot_code), instruction=instruction)
 
-        except Exception as e:
-            raise Exception(f"Error in OpenRouter API call: {e}")
+    def _edited_dot_code(self, backend, prompt, dot_code, stage):
+        # Apply the edit commands (or take the whole graph) and repair mechanical errors locally
+        edited = apply_refinement(dot_code, backend.complete(prompt, stage))
+        record_payload("dot_code", edited)
+        return edited
 
-    def generate_text_response(self, dot_code, user_prompt):
+    def refine_dot_code(self, dot_code, instruction):
         """
-        Generate a textual explanation using Groq/Llama.
-        """
-        prompt = (
-            f"Your task is to generate a text response that provides a thorough understanding of the flowchart rendered by the dot code in context of user prompt:\n"
-            f"Input Dot Code: {dot_code}\n"
-            f"Input User Prompt: {user_prompt}\n"
-            f"Flow chart: This is rendered by the input Dot Code"
-            f"Follow the below instructions while drafting the text response: \n"
-            f"1. Write a detailed explanation of the flowchart in a suitable structure [ex: bullet points, headings & subheadings & explanation etc.,] while aligning the response with the User Prompt. \n"
-            f"   - Ensure the explanation helps the user understand the complex topic inquired through the User Prompt. \n"  # Modified line
-            f"2. You are free to decide the length of the explanation that is most suitable for the User Prompt and Dot code given to you.\n"
-            f"3. You can explain the color coding in standard format (ex: blue, yellow, red, etc.) but not in hexadecimal coding. \n"
-            f"   - Only if that gives more clarity to users to understand the diagram/flowchart. \n"
-            f"4. Avoid preambles or unnecessary introductory text. Start directly with the explanation.\n"
-            f"5. You can provide additional information if the dot code is not carrying sufficient information as per the user prompt.\n"
-            #f"7. MOST IMPORTANTLY response MUST be structured in JSON format with clear keys and values to ensure readability and usability.\n"
-            f"7. MOST IMPORTANTLY The output MUST be structured in this exact JSON format. Example structure:\n"
-            f"{{\n"
-            f"  \"explanation\": {{\n"
-            f"    \"overview\": \"High-level explanation of the flowchart and its purpose.\",\n"
-            f"    \"details\": [\n"
-            f"      {{\"heading\": \"Step 1\", \"description\": \"Detailed explanation of step 1.\"}},\n"
-            f"      {{\"heading\": \"Step 2\", \"description\": \"Detailed explanation of step 2.\"}}\n"
-            f"    ]\n"
-            f"  }}\n"
-            f"}}\n"
-
-            # Added line
-        )
+        Apply a structural change to DOT code with the refine backends.
+        :raises ValueError: The reply could not be applied (when every backend failed).
+        """
+        prompt = self.refine_prompt(dot_code, instruction)
+        return call_with_fallback([
+            (backend.name, partial(self._edited_dot_code, backend, prompt, dot_code, "refine_dot_code"))
+            for backend in self.stages["refine"]
+        ])
 
-        try:
-            response = self.groq_client.invoke(prompt)
+    def text_response_prompt(self, dot_code, user_prompt):
+        """
+        Build the explanation prompt shared by generate_text_response and stream_text_response.
+        """
+        return TEXT_RESPONSE.render(dot_code=dot_code, user_prompt=user_prompt)
 
-            return response.content.strip()
+    def generate_text_response(self, dot_code, user_prompt):
+        """
+        Generate a textual explanation with the explain backends.
+        """
+        prompt = self.text_response_prompt(dot_code, user_prompt)
+        return call_with_fallback([(backend.name, partial(self._text, backend, prompt, "generate_text_response"))
+                                   for backend in self.stages["explain"]])
 
+    def stream_text_response(self, dot_code, user_prompt):
+        """
+        Stream the textual explanation from the explain backends. A backend that fails
+        before its first token falls back to the next one; once tokens were yielded errors are raised.
+        :return: Generator of text chunks as they arrive.
+        """
+        prompt = self.text_response_prompt(dot_code, user_prompt)
+        backends = self.stages["explain"]
+        for index, backend in enumerate(backends):
+            size = 0
+            try:
+                with stage_timer("stream_text_response", model=backend.model), \
+                        guarded_stream(backend.provider) as timeout:
+                    for token in backend.stream(prompt, timeout):
+                        size += len(token.encode("utf-8"))
+                        yield token
+                backend.client_pool.record_success(backend.provider)
+                PAYLOAD_BYTES.observe(size, kind="explanation")
+                return
 
-        except Exception as e:
-            raise Exception(f"Error in Groq API call: {e}")
+            except DeadlineExceededError:
+                raise
+            except Exception as e:
+                error = backend.api_error(e)
+                if size == 0 and index < len(backends) - 1:
+                    print(f"'{backend.name}' failed ({e}); falling back to '{backends[index + 1].name}'.")
+                    continue
+                if isinstance(e, ResilienceError):
+                    raise
+                raise error from e
 
-    def validate_and_render_dot_code(self, dot_code, output_file="flowchart"):
+    def _render_steps(self, dot_code, profile, on_fix=None, on_attempt=None):
         """
-        Validate and render the DOT code. Use LLM to fix errors if encountered.
+        The lint, layout, render and fix loop of validate_and_render_dot_image, shared with
+        its asyncio variant. The calls that block are yielded to the caller as tuples,
+        which sends back their result or throws their exception in:
+            ("select", dot_code) -> layout_select.LayoutChoice
+            ("render", dot_code, engine) -> image bytes
+            ("fix", dot_code, error_message) -> fixed DOT code
+        :return: The rendered image bytes, as the generator's return value.
         """
         max_retries = 5
         for attempt in range(max_retries):
+            if on_attempt is not None:
+                on_attempt(attempt + 1)
+            check_deadline("render")
             try:
-                graphviz_path = r"C:\Program Files\Graphviz\bin"
-                os.environ["PATH"] += os.pathsep + graphviz_path
+                # Fix what can be fixed locally and only render code that parses
+                with stage_timer("lint"):
+                    checked_dot_code = check_dot_code(dot_code)
+                if checked_dot_code != dot_code:
+                    dot_code = checked_dot_code
+                    if on_fix is not None:
+                        on_fix(dot_code)
+
+                engine = "dot"
+                if profile.layout == "auto":
+                    choice = yield "select", dot_code
+                    engine = choice.engine
+                    if engine != (declared_layout(dot_code) or "dot"):
+                        # Keep the returned DOT code in step with the image
+                        dot_code = with_layout(dot_code, engine)
+                        if on_fix is not None:
+                            on_fix(dot_code)
 
-                src = Source(dot_code, format="jpeg", engine="dot")
-                output_path = src.render(output_file, cleanup=True)
-                return output_path
+                with stage_timer("render", profile=profile.name, format=profile.image_format):
+                    image = yield "render", dot_code, engine
+                record_payload("image", image)
+                return image
+            except (RenderError, ResilienceError) as e:
+                # Resource limits, back-pressure and deadlines are not something the LLM can fix
+                record_render_failure(e)
+                raise
             except Exception as e:
+                record_render_failure(e)
                 if attempt < max_retries - 1:
                     print(f"Render attempt {attempt + 1} failed. Sending error to LLM...")
-                    dot_code = self.fix_dot_code(dot_code, str(e))
+                    FIX_RETRIES.inc()
+                    dot_code = yield "fix", dot_code, str(e)
+                    if on_fix is not None:
+                        on_fix(dot_code)
                 else:
-                    raise RuntimeError(f"DOT code validation failed after {max_retries} attempts. Error: {e}")
\ No newline at end of file
+                    raise RuntimeError(f"DOT code validation failed after {max_retries} attempts. Error: {e}")
+
+    def validate_and_render_dot_image(self, dot_code, profile=None, on_fix=None, on_attempt=None):
+        """
+        Validate and render the DOT code in memory. Use LLM to fix errors if encountered.
+        :param profile: RenderProfile controlling format, size and layout mode; defaults to get_profile().
+        :param on_fix: Optional callback invoked with the new DOT code after each LLM fix round.
+        :param on_attempt: Optional callback invoked with the attempt number before each render.
+        :return: Rendered image bytes.
+        """
+        profile = profile or get_profile()
+        calls = {
+            "select": lambda dot_code: get_layout_selector().select(dot_code),
+            "render": lambda dot_code, engine: render_with_profile(dot_code, profile, engine=engine),
+            "fix": self.fix_dot_code,
+        }
+        return run_steps(self._render_steps(dot_code, profile, on_fix, on_attempt), calls)
+
+    def validate_and_render_dot_code(self, dot_code, output_file="flowchart", on_fix=None):
+        """
+        Validate and render the DOT code to output_file + ".jpeg".
+        Prefer validate_and_render_dot_image, which does not touch the filesystem.
+        """
+        image = self.validate_and_render_dot_image(dot_code, profile=get_profile(image_format="jpeg"), on_fix=on_fix)
+        output_path = f"{output_file}.jpeg"
+        with open(output_path, "wb") as image_file:
+            image_file.write(image)
+        return output_path
@@ -0,0 +1,275 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from dotenv import load_dotenv
+from metrics import SEMANTIC_LOOKUPS, stage_timer
+from result_cache import normalize_prompt
+
+load_dotenv()
+
+DEFAULT_EMBEDDING_MODEL = "BAAI/bge-small-en-v1.5"
+
+
+class FastEmbedEmbedder:
+    def __init__(self, model_name=None):
+        """
+        Small ONNX sentence embedding model run on the CPU by fastembed; the model is
+        downloaded on first use and cached by fastembed.
+        """
+        from fastembed import TextEmbedding
+
+        self.model_name = model_name or os.getenv("SEMANTIC_CACHE_MODEL", DEFAULT_EMBEDDING_MODEL)
+        self._model = TextEmbedding(model_name=self.model_name)
+
+    def embed(self, text):
+        return next(iter(self._model.embed([text])))
+
+
+class SemanticLookup:
+    def __init__(self, prompt, namespace, vector, dot_code=None, score=None, matched_prompt=None):
+        """
+        Outcome of SemanticCache.lookup; keeps the prompt's embedding so a miss can be
+        added later without embedding the prompt again.
+        """
+        self.prompt = prompt
+        self.namespace = namespace
+        self.vector = vector
+        self.dot_code = dot_code
+        self.score = score
+        self.matched_prompt = matched_prompt
+
+    @property
+    def hit(self):
+        return self.dot_code is not None
+
+
+class SemanticCache:
+    def __init__(self, embedder=None, threshold=None, max_entries=None, db_path=None, ttl=None):
+        """
+        DOT code of earlier prompts, looked up by embedding similarity so paraphrases of
+        a prompt reuse its diagram. Vectors live in a fixed-size numpy matrix searched by
+        brute force (a few milliseconds for thousands of entries); the least recently
+        used entry is evicted when it is full. Entries are persisted to SQLite and loaded
+        again at startup; workers of one host share the file but only see each other's
+        entries after a restart.
+        :param embedder: Object with embed(text) -> vector; defaults to FastEmbedEmbedder.
+        :param threshold: Minimum cosine similarity for a hit.
+        :param max_entries: Capacity; bounds memory to max_entries x embedding size floats.
+        :param db_path: SQLite file for persistence, or None to keep entries in memory only.
+        :param ttl: Seconds after which an entry is no longer returned.
+        """
+        import numpy as np
+
+        self._np = np
+        self.embedder = embedder or FastEmbedEmbedder()
+        self.model_name = getattr(self.embedder, "model_name", type(self.embedder).__name__)
+        self.threshold = threshold or float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+        self.max_entries = max_entries or int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "5000"))
+        self.ttl = ttl or float(os.getenv("SEMANTIC_CACHE_TTL", str(7 * 86400)))
+        db_path = db_path if db_path is not None else (
+            os.getenv("SEMANTIC_CACHE_DB") or os.getenv("RESULT_CACHE_DB")
+        )
+
+        self._lock = threading.Lock()
+        # Allocated on the first vector, once the embedding size is known
+        self._vectors = None
+        self._used = np.zeros(self.max_entries, dtype=bool)
+        self._created_at = np.zeros(self.max_entries)
+        self._accessed_at = np.zeros(self.max_entries)
+        self._namespace_ids = np.full(self.max_entries, -1, dtype=np.int32)
+        self._namespaces = {}
+        self._keys = [None] * self.max_entries
+        self._prompts = [None] * self.max_entries
+        self._dot_codes = [None] * self.max_entries
+        self._slots = {}
+
+        self.hits = 0
+        self.misses = 0
+
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=10)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS semantic_cache ("
+                " key TEXT PRIMARY KEY, model TEXT, namespace TEXT, prompt TEXT, embedding BLOB,"
+                " dot_code TEXT, created_at REAL, accessed_at REAL)"
+            )
+            self._db.commit()
+            self._load()
+
+    def _normalize(self, vector):
+        vector = self._np.asarray(vector, dtype=self._np.float32).ravel()
+        norm = float(self._np.linalg.norm(vector))
+        return vector / norm if norm else vector
+
+    def embed(self, prompt):
+        return self._normalize(self.embedder.embed(normalize_prompt(prompt)))
+
+    def _key(self, namespace, prompt):
+        return hashlib.sha256(f"{namespace}\n{normalize_prompt(prompt)}".encode("utf-8")).hexdigest()
+
+    def _namespace_id(self, namespace):
+        return self._namespaces.setdefault(namespace, len(self._namespaces))
+
+    def _load(self):
+        np = self._np
+        rows = self._db.execute(
+            "SELECT key, namespace, prompt, embedding, dot_code, created_at, accessed_at FROM semantic_cache"
+            " WHERE model = ? AND created_at >= ? ORDER BY accessed_at DESC LIMIT ?",
+            (self.model_name, time.time() - self.ttl, self.max_entries),
+        ).fetchall()
+        for key, namespace, prompt, embedding, dot_code, created_at, accessed_at in rows:
+            vector = np.frombuffer(embedding, dtype=np.float32)
+            if self._vectors is not None and vector.shape[0] != self._vectors.shape[1]:
+                continue
+            self._store(key, namespace, prompt, vector, dot_code, created_at, accessed_at)
+        if rows:
+            print(f"Loaded {len(self._slots)} semantic cache entries.")
+
+    def _store(self, key, namespace, prompt, vector, dot_code, created_at, accessed_at):
+        """
+        Put an entry into a free slot, evicting the least recently used one when full.
+        :return: Key of the evicted entry, or None.
+        """
+        np = self._np
+        if self._vectors is None:
+            self._vectors = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+
+        evicted = None
+        slot = self._slots.get(key)
+        if slot is None:
+            free = np.flatnonzero(~self._used)
+            if free.size:
+                slot = int(free[0])
+            else:
+                slot = int(np.argmin(self._accessed_at))
+                evicted = self._keys[slot]
+                del self._slots[evicted]
+
+        self._vectors[slot] = vector
+        self._used[slot] = True
+        self._created_at[slot] = created_at
+        self._accessed_at[slot] = accessed_at
+        self._namespace_ids[slot] = self._namespace_id(namespace)
+        self._keys[slot] = key
+        self._prompts[slot] = prompt
+        self._dot_codes[slot] = dot_code
+        self._slots[key] = slot
+        return evicted
+
+    def lookup(self, prompt, namespace):
+        """
+        Find the most similar earlier prompt of the same namespace.
+        :param namespace: Keeps results of different models or prompt versions apart.
+        :return: SemanticLookup; .hit tells whether its similarity reached the threshold.
+        """
+        np = self._np
+        vector = self.embed(prompt)
+        now = time.time()
+        with self._lock:
+            best = None
+            namespace_id = self._namespaces.get(namespace)
+            if self._vectors is not None and namespace_id is not None:
+                valid = self._used & (self._namespace_ids == namespace_id) & (self._created_at >= now - self.ttl)
+                if valid.any() and self._vectors.shape[1] == vector.shape[0]:
+                    scores = self._vectors @ vector
+                    scores[~valid] = -np.inf
+                    best = int(np.argmax(scores))
+                    score = float(scores[best])
+
+            if best is None or score < self.threshold:
+                self.misses += 1
+                SEMANTIC_LOOKUPS.inc(outcome="miss")
+                return SemanticLookup(prompt, namespace, vector, score=score if best is not None else None)
+
+            self.hits += 1
+            SEMANTIC_LOOKUPS.inc(outcome="hit")
+            self._accessed_at[best] = now
+            if self._db is not None:
+                self._db.execute("UPDATE semantic_cache SET accessed_at = ? WHERE key = ?", (now, self._keys[best]))
+                self._db.commit()
+            return SemanticLookup(prompt, namespace, vector, self._dot_codes[best], score, self._prompts[best])
+
+    def add(self, lookup, dot_code):
+        """
+        Remember the DOT code generated after a missed lookup.
+        """
+        if lookup.hit:
+            return
+        key = self._key(lookup.namespace, lookup.prompt)
+        now = time.time()
+        with self._lock:
+            evicted = self._store(key, lookup.namespace, lookup.prompt, lookup.vector, dot_code, now, now)
+            if self._db is not None:
+                if evicted is not None:
+                    self._db.execute("DELETE FROM semantic_cache WHERE key = ?", (evicted,))
+                self._db.execute(
+                    "INSERT OR REPLACE INTO semantic_cache VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (key, self.model_name, lookup.namespace, lookup.prompt, lookup.vector.tobytes(),
+                     dot_code, now, now),
+                )
+                self._db.execute("DELETE FROM semantic_cache WHERE created_at < ?", (now - self.ttl,))
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "entries": len(self._slots),
+                "threshold": self.threshold,
+            }
+
+
+_cache = None
+_cache_loaded = False
+_cache_lock = threading.Lock()
+
+
+def get_semantic_cache():
+    """
+    The worker's SemanticCache, or None unless SEMANTIC_CACHE=on and numpy and
+    fastembed are installed (see requirements-semantic.txt).
+    """
+    global _cache, _cache_loaded
+    with _cache_lock:
+        if not _cache_loaded:
+            _cache_loaded = True
+            if os.getenv("SEMANTIC_CACHE", "off").lower() in ("1", "on", "true", "yes"):
+                try:
+                    _cache = SemanticCache()
+                except ImportError as e:
+                    print(f"Semantic cache disabled: {e}. Install requirements-semantic.txt to use it.")
+        return _cache
+
+
+def semantic_namespace(query_handler):
+    """
+    Semantic cache namespace of a GrokHandler-style handler: DOT code is only reused
+    for the same primary generate backend and prompt version.
+    """
+    return f"{query_handler.stages['generate'][0].name}|{query_handler.PROMPT_VERSION}"
+
+
+def semantic_lookup(query_handler, user_prompt):
+    """
+    :return: SemanticLookup, or None when the semantic cache is disabled.
+    """
+    cache = get_semantic_cache()
+    if cache is None:
+        return None
+    with stage_timer("semantic_lookup"):
+        return cache.lookup(user_prompt, semantic_namespace(query_handler))
+
+
+def remember_dot_code(lookup, dot_code):
+    """
+    Add DOT code that rendered successfully after a missed lookup.
+    """
+    if lookup is not None and not lookup.hit:
+        get_semantic_cache().add(lookup, dot_code)
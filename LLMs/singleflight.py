@@ -0,0 +1,146 @@
+import asyncio
+import threading
+from metrics import COALESCED_REQUESTS
+from resilience import DeadlineExceededError, remaining_time
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        """
+        Coalesces concurrent calls with the same key: the first caller (the leader) runs
+        the function and every caller that arrives while it runs (a follower) waits for
+        and shares its result or error. Calls are only shared while in flight; anything
+        later is left to the result cache. Coalescing is per worker process.
+        """
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def do(self, key, fn):
+        """
+        :param key: Identity of the work, e.g. the result cache key.
+        :param fn: Zero-argument callable doing the work.
+        :return: (result, shared), shared being True for followers.
+        :raises DeadlineExceededError: A follower's request deadline passed while waiting.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.followers += 1
+        COALESCED_REQUESTS.inc(role="leader" if leader else "follower")
+
+        if not leader:
+            if not call.done.wait(remaining_time()):
+                raise DeadlineExceededError("Request deadline exceeded while waiting for an identical request.")
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+            return call.result, False
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._calls), "leaders": self.leaders, "followers": self.followers}
+
+
+class AsyncSingleFlight:
+    def __init__(self):
+        """
+        Asyncio variant of SingleFlight. The work runs in its own task, so it carries on
+        for the remaining callers (and still fills the cache) when the leader's client
+        disconnects and its request is cancelled.
+        """
+        self._tasks = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def _forget(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled():
+            # Marks the error as retrieved when no caller is left to await it
+            task.exception()
+
+    async def do(self, key, fn):
+        """
+        :param fn: Zero-argument coroutine function doing the work.
+        :return: (result, shared), shared being True for followers.
+        """
+        task = self._tasks.get(key)
+        leader = task is None
+        if leader:
+            task = self._tasks[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda done: self._forget(key, done))
+            self.leaders += 1
+        else:
+            self.followers += 1
+        COALESCED_REQUESTS.inc(role="leader" if leader else "follower")
+
+        try:
+            result = await asyncio.wait_for(asyncio.shield(task), timeout=remaining_time())
+        except asyncio.TimeoutError:
+            raise DeadlineExceededError("Request deadline exceeded while waiting for an identical request.")
+        return result, not leader
+
+    def stats(self):
+        return {"in_flight": len(self._tasks), "leaders": self.leaders, "followers": self.followers}
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def get_single_flight():
+    """
+    The worker's SingleFlight for pipeline runs.
+    """
+    with _flights_lock:
+        if "sync" not in _flights:
+            _flights["sync"] = SingleFlight()
+        return _flights["sync"]
+
+
+def get_async_single_flight():
+    """
+    The worker's AsyncSingleFlight for pipeline runs; use it from the event loop only.
+    """
+    with _flights_lock:
+        if "async" not in _flights:
+            _flights["async"] = AsyncSingleFlight()
+        return _flights["async"]
+
+
+def single_flight_stats():
+    """
+    Combined stats of the worker's single-flight groups, with the share of callers that were coalesced.
+    """
+    with _flights_lock:
+        flights = list(_flights.values())
+    totals = {"in_flight": 0, "leaders": 0, "followers": 0}
+    for flight in flights:
+        for name, value in flight.stats().items():
+            totals[name] += value
+    callers = totals["leaders"] + totals["followers"]
+    totals["coalescing_ratio"] = totals["followers"] / callers if callers else 0.0
+    return totals
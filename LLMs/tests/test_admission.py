@@ -0,0 +1,41 @@
+import pytest
+
+from admission import AdmissionController, AdmissionError, MemoryBucketStore, client_identity, rate_limit_buckets
+
+
+@pytest.fixture(autouse=True)
+def environment(monkeypatch):
+    monkeypatch.delenv("TRUST_PROXY_HEADERS", raising=False)
+    monkeypatch.setenv("API_KEYS", "listed")
+
+
+def test_client_identity_prefers_api_key_then_user_then_ip():
+    assert client_identity({"X-API-Key": "k", "X-User-Id": "u"}, "1.2.3.4").startswith("key:")
+    assert client_identity({"X-User-Id": "u"}, "1.2.3.4") == "user:u"
+    assert client_identity({}, "1.2.3.4") == "ip:1.2.3.4"
+    assert client_identity({}, None) == "ip:unknown"
+
+
+def test_forwarded_address_needs_trust(monkeypatch):
+    headers = {"X-Forwarded-For": "5.6.7.8, 10.0.0.1"}
+    assert client_identity(headers, "10.0.0.1") == "ip:10.0.0.1"
+    monkeypatch.setenv("TRUST_PROXY_HEADERS", "on")
+    assert client_identity(headers, "10.0.0.1") == "ip:5.6.7.8"
+
+
+def test_listed_api_key_has_a_bucket_of_its_own():
+    assert rate_limit_buckets({"X-API-Key": "listed"}, "1.2.3.4") == [client_identity({"X-API-Key": "listed"}, "")]
+
+
+@pytest.mark.parametrize("headers", [{"X-API-Key": "unlisted"}, {"X-User-Id": "u"}])
+def test_unverified_headers_are_charged_to_the_ip_too(headers):
+    assert rate_limit_buckets(headers, "1.2.3.4") == ["ip:1.2.3.4", client_identity(headers, "1.2.3.4")]
+
+
+def test_new_header_values_do_not_get_around_the_limit():
+    controller = AdmissionController(MemoryBucketStore(), rate=60, burst=2)
+    for user in ("a", "b"):
+        controller.check_rate(rate_limit_buckets({"X-User-Id": user}, "1.2.3.4"))
+    with pytest.raises(AdmissionError) as raised:
+        controller.check_rate(rate_limit_buckets({"X-User-Id": "c"}, "1.2.3.4"))
+    assert raised.value.retry_after == 1
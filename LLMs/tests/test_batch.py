@@ -0,0 +1,77 @@
+import time
+
+import pytest
+
+from admission import AdmissionController, MemoryBucketStore
+from batch import BatchPacer, batch_items, run_batch
+
+
+def make_items(count):
+    return batch_items([f"prompt {index}" for index in range(count)], lambda prompt: prompt)
+
+
+def test_batch_items_merges_duplicates():
+    items = batch_items(["a", "b", "a"], lambda prompt: prompt.upper())
+    assert [(item.cache_key, item.indexes) for item in items] == [("A", [0, 2]), ("B", [1])]
+
+
+@pytest.mark.parametrize("prompts", [[], "a", ["a", ""], ["a", 3]])
+def test_batch_items_rejects_invalid_prompts(prompts):
+    with pytest.raises(ValueError):
+        batch_items(prompts, lambda prompt: prompt)
+
+
+def test_batch_items_enforces_max_size():
+    with pytest.raises(ValueError, match="at most 2"):
+        batch_items(["a", "b", "c"], lambda prompt: prompt, max_size=2)
+
+
+def test_default_max_batch_fits_gunicorn_timeout(monkeypatch):
+    for name in ("RATE_LIMIT_PER_MINUTE", "RATE_LIMIT_BURST", "BATCH_MAX_PROMPTS", "BATCH_RATE_BUDGET",
+                 "REQUEST_DEADLINE"):
+        monkeypatch.delenv(name, raising=False)
+    controller = AdmissionController(MemoryBucketStore())
+    pacer = BatchPacer(controller, ["client"])
+    assert pacer.max_prompts() == 100
+    # Waiting for the last token, then running it, stays inside the Dockerfile's GUNICORN_TIMEOUT
+    pacing = pacer.deadline - time.monotonic()
+    assert pacing + 90 < 300
+
+
+def test_max_size_batch_completes_at_the_client_rate(monkeypatch):
+    monkeypatch.setenv("BATCH_RATE_BUDGET", "1")
+    controller = AdmissionController(MemoryBucketStore(), rate=600, burst=3)
+    # The gate in front of /api/batch charged the request itself
+    controller.check_rate(["client"])
+    pacer = BatchPacer(controller, ["client"])
+    items = make_items(pacer.max_prompts())
+    assert len(items) == 13
+
+    def compute(item):
+        pacer.pace(item)
+        return item.prompt
+
+    start = time.monotonic()
+    outcomes = list(run_batch(items, compute, concurrency=4))
+    assert [outcome.error for outcome in outcomes] == [None] * len(items)
+    assert time.monotonic() - start < 2
+
+
+def test_pacing_gives_up_when_the_budget_is_spent(monkeypatch):
+    monkeypatch.setenv("BATCH_RATE_BUDGET", "0")
+    controller = AdmissionController(MemoryBucketStore(), rate=60, burst=1)
+    controller.check_rate(["client"])
+    pacer = BatchPacer(controller, ["client"])
+    start = time.monotonic()
+    outcomes = list(run_batch(make_items(4), lambda item: pacer.pace(item) or item.prompt))
+    assert time.monotonic() - start < 1.5
+    failed = [outcome for outcome in outcomes if outcome.error is not None]
+    assert failed and all(outcome.to_dict()["error_status"] == 429 for outcome in failed)
+
+
+def test_pacing_is_off_without_buckets():
+    pacer = BatchPacer(None, None)
+    items = make_items(3)
+    for item in items:
+        pacer.pace(item)
+    assert pacer.max_prompts() == 200
@@ -0,0 +1,55 @@
+import pytest
+
+from dot_edit import apply_line_diff, apply_style_edits, parse_style_instruction, style_refinement
+from dot_lint import DotSyntaxError, lint_dot
+
+DOT_CODE = "digraph G {\n  node [shape=ellipse, color=red];\n  a -> b [style=bold];\n  rankdir=TB;\n}"
+
+
+def edits(instruction):
+    return [(edit.scope, edit.attribute, edit.value, edit.merge) for edit in parse_style_instruction(instruction)]
+
+
+def test_parse_style_instruction():
+    assert edits("make the boxes blue and the arrows dashed") == [
+        ("node", "fillcolor", "#BBDEFB", False),
+        ("node", "style", "filled", True),
+        ("edge", "style", "dashed", False),
+    ]
+    assert edits("lay it out left to right") == [("graph", "rankdir", "LR", False)]
+
+
+@pytest.mark.parametrize("instruction", ["add a database node", "make the boxes blue and add a cache", ""])
+def test_instructions_needing_the_llm(instruction):
+    assert parse_style_instruction(instruction) is None
+
+
+def test_style_edits_replace_conflicting_attributes():
+    edited = apply_style_edits(DOT_CODE, parse_style_instruction("make the arrows dashed"))
+    assert 'edge [style="dashed"];' in edited
+    assert "style=bold" not in edited
+    assert "node [shape=ellipse, color=red];" in edited
+    assert not lint_dot(edited)
+
+
+def test_graph_attributes_are_replaced_not_repeated():
+    edited = apply_style_edits(DOT_CODE, parse_style_instruction("lay it out left to right"))
+    assert edited.startswith('digraph G {\n  rankdir="LR";')
+    assert "rankdir=TB" not in edited
+
+
+def test_style_edits_need_a_graph_header():
+    with pytest.raises(DotSyntaxError):
+        apply_style_edits("a -> b;", parse_style_instruction("make the arrows dashed"))
+    assert style_refinement("a -> b;", "make the arrows dashed") is None
+
+
+def test_apply_line_diff_uses_original_line_numbers():
+    diff = "INSERT AFTER 0: // top\nDELETE 2\nREPLACE 3: a -> c;\nINSERT AFTER 3: c -> d;"
+    assert apply_line_diff("digraph G {\nx;\na -> b;\n}", diff) == "// top\ndigraph G {\na -> c;\nc -> d;\n}"
+
+
+@pytest.mark.parametrize("diff", ["", "REPLACE 9: x;", "DELETE 2\nREPLACE 2: y;", "change line 2"])
+def test_apply_line_diff_rejects_bad_diffs(diff):
+    with pytest.raises(ValueError):
+        apply_line_diff("digraph G {\nx;\n}", diff)
@@ -0,0 +1,90 @@
+import pytest
+
+from dot_lint import DotStreamExtractor, DotSyntaxError, check_dot_code, extract_dot_code, lint_dot, repair_dot
+
+
+def graph(*lines):
+    return "\n".join(["digraph G {", *(f"  {line}" for line in lines), "}"])
+
+
+@pytest.mark.parametrize("dot_code, repaired, repairs", [
+    ("digraph My Graph {\n  a -> b;\n}", "digraph MyGraph {\n  a -> b;\n}", ["removed spaces from graph name"]),
+    (graph("a -> b [color=FF0000];"), graph('a -> b [color="#FF0000"];'), ["added '#' to hex colors"]),
+    (graph("a [label=Start here];"), graph('a [label="Start here"];'), ["quoted multi-word labels"]),
+    ("digraph G {\n  a -> b;\n", "digraph G {\n  a -> b;\n}", ["balanced braces"]),
+    (graph("a -> b;") + "\n}\n", graph("a -> b;"), ["balanced braces"]),
+])
+def test_mechanical_errors_are_repaired(dot_code, repaired, repairs):
+    assert repair_dot(dot_code) == (repaired, repairs)
+
+
+def test_extract_dot_code_strips_fences_and_prose():
+    response = "Sure! Here it is:\n```dot\n" + graph("a -> b;") + "\n```\nHope it helps"
+    assert extract_dot_code(response) == graph("a -> b;")
+
+
+@pytest.mark.parametrize("dot_code, issue", [
+    ("graph G {\n  a -> b;\n}", "line 2: '->' used in an undirected graph; use '--'"),
+    (graph("a -> b [color=red;"), "line 2: '[' is never closed"),
+    (graph("a -> node;"), "line 2: keyword 'node' used as a node name; quote it"),
+    ("a -> b;", "line 1: DOT code must start with 'graph' or 'digraph'"),
+])
+def test_lint_reports_syntax_errors(dot_code, issue):
+    assert issue in lint_dot(dot_code)
+
+
+def test_check_dot_code_raises_for_what_it_cannot_repair():
+    assert check_dot_code(graph("a -> b;")) == graph("a -> b;")
+    with pytest.raises(DotSyntaxError, match="'--' used in a digraph"):
+        check_dot_code(graph("a -- b;"))
+
+
+@pytest.mark.parametrize("statement, repaired", [
+    ("Start Node -> End Node;", '"Start Node" -> "End Node";'),
+    ("A -> B C;", 'A -> "B C";'),
+    ("Start Node [label=\"x\"];", '"Start Node" [label="x"];'),
+    ('Start Node -> "B" -> Big End [color=red];', '"Start Node" -> "B" -> "Big End" [color=red];'),
+])
+def test_multiword_node_names_are_quoted(statement, repaired):
+    assert repair_dot(graph(statement)) == (graph(repaired), ["quoted multi-word node names"])
+
+
+@pytest.mark.parametrize("statement", ["A B C", "a -> b;", "node [shape=box];", '"Start Node" -> "End Node";'])
+def test_valid_statements_are_left_alone(statement):
+    assert repair_dot(graph(statement)) == (graph(statement), [])
+
+
+def feed_all(chunks):
+    extractor = DotStreamExtractor()
+    for received, chunk in enumerate(chunks, 1):
+        if extractor.feed(chunk):
+            return extractor, received
+    return extractor, None
+
+
+@pytest.mark.parametrize("prose", ["Done", "Hope this helps!", "```"])
+def test_stream_closes_before_trailing_prose(prose):
+    chunks = ["Here it is:\n", "digraph G {\n  a -> b;\n", "}\n", f"{prose}\n", "More text.\n"]
+    extractor, received = feed_all(chunks)
+    assert received == 4
+    assert extractor.dot_code == "digraph G {\n  a -> b;\n}"
+
+
+def test_stream_ignores_braces_in_strings_and_comments():
+    chunks = ["digraph G {\n", '  a [label="}"];\n  // }\n', "  a -> b;\n}\n", "Done\n"]
+    extractor, received = feed_all(chunks)
+    assert received == 4
+    assert extractor.dot_code == 'digraph G {\n  a [label="}"];\n  // }\n  a -> b;\n}'
+
+
+def test_stream_without_an_end_returns_everything():
+    extractor, received = feed_all(["digraph G {\n", "  a -> b;\n"])
+    assert received is None
+    assert extractor.dot_code == "digraph G {\n  a -> b;\n"
+
+
+def test_stream_treats_a_brace_followed_by_statements_as_stray():
+    chunks = ["digraph G {\n  a -> b;\n}\n", "  b -> c;\n}\n", "Enjoy\n"]
+    extractor, received = feed_all(chunks)
+    assert received == 3
+    assert extractor.dot_code == "digraph G {\n  a -> b;\n}\n  b -> c;\n}"
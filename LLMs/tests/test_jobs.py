@@ -0,0 +1,54 @@
+import socket
+
+import pytest
+
+import jobs
+from jobs import validate_callback_url
+
+ADDRESSES = {
+    "hooks.example.com": ["93.184.216.34"],
+    "localhost": ["127.0.0.1", "::1"],
+    "127.0.0.1": ["127.0.0.1"],
+    "metadata.internal": ["169.254.169.254"],
+    "intranet.example.com": ["10.0.0.5"],
+    "mixed.example.com": ["93.184.216.34", "192.168.1.10"],
+    "v6.example.com": ["2606:2800:220:1:248:1893:25c8:1946"],
+}
+
+
+@pytest.fixture(autouse=True)
+def resolver(monkeypatch):
+    def getaddrinfo(host, port, proto=0):
+        if host not in ADDRESSES:
+            raise socket.gaierror(host)
+        return [(None, None, proto, "", (address, port or 0)) for address in ADDRESSES[host]]
+
+    monkeypatch.setattr(jobs.socket, "getaddrinfo", getaddrinfo)
+    monkeypatch.delenv("JOB_CALLBACK_HOSTS", raising=False)
+
+
+@pytest.mark.parametrize("url", ["https://hooks.example.com/done", "http://v6.example.com:8080/x"])
+def test_public_callbacks_are_accepted(url):
+    validate_callback_url(url)
+
+
+@pytest.mark.parametrize("url, message", [
+    ("ftp://hooks.example.com/done", "http or https"),
+    ("https:///done", "http or https"),
+    ("http://localhost:5000/", "not a public address"),
+    ("http://127.0.0.1/", "not a public address"),
+    ("http://metadata.internal/latest/meta-data", "not a public address"),
+    ("http://intranet.example.com/", "not a public address"),
+    ("http://mixed.example.com/", "not a public address"),
+    ("http://unknown.example.com/", "does not resolve"),
+])
+def test_unsafe_callbacks_are_refused(url, message):
+    with pytest.raises(ValueError, match=message):
+        validate_callback_url(url)
+
+
+def test_allowed_hosts(monkeypatch):
+    monkeypatch.setenv("JOB_CALLBACK_HOSTS", "intranet.example.com")
+    validate_callback_url("http://intranet.example.com/hook")
+    with pytest.raises(ValueError, match="not allowed"):
+        validate_callback_url("https://hooks.example.com/done")
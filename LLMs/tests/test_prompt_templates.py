@@ -0,0 +1,47 @@
+from layout_select import with_layout
+from prompt_templates import error_lines, failing_region
+from render_profiles import apply_profile, get_profile
+
+BROKEN = """digraph G {
+  dpi=300
+  rankdir=LR;
+  a -> b;
+  b -> c;
+  c -> -> d;
+  d -> e;
+  e -> f;
+  f -> g;
+  g -> h;
+  h -> i;
+  i -> j;
+  j -> k;
+}"""
+
+
+def graphviz_error(rendered, token):
+    # Graphviz numbers the lines of the code it was given
+    number = next(index for index, line in enumerate(rendered.split("\n"), 1) if token in line)
+    return f"Error: <stdin>: syntax error in line {number} near '->'"
+
+
+def test_error_lines():
+    assert error_lines("syntax error in line 12 near '}'; line 3: unexpected '['") == [3, 12]
+
+
+def test_failing_region_shows_lines_around_the_error():
+    numbered, scope = failing_region(BROKEN, "syntax error in line 6 near '->'", context=1)
+    assert numbered.split("\n") == ["...", "5|   b -> c;", "6|   c -> -> d;", "7|   d -> e;", "..."]
+    assert scope == "the lines around the error"
+
+
+def test_failing_region_falls_back_to_all_lines():
+    numbered, scope = failing_region(BROKEN, "Error: something went wrong")
+    assert scope == "all lines"
+    assert numbered.split("\n")[0] == "1| digraph G {"
+
+
+def test_rendered_code_keeps_line_numbers():
+    rendered = apply_profile(with_layout(BROKEN, "neato"), get_profile("full", image_format="png"))
+    assert len(rendered.split("\n")) == len(BROKEN.split("\n"))
+    numbered, _ = failing_region(BROKEN, graphviz_error(rendered, "-> ->"), context=1)
+    assert "6|   c -> -> d;" in numbered.split("\n")
@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+from async_handler import arun_steps
+from renderer import RenderBusyError
+from render_profiles import get_profile
+from router_groq_llms import GrokHandler, run_steps
+
+GOOD = "digraph G {\n  a -> b;\n}"
+BAD = "digraph G {\n  a -> b;\n  c -- d;\n}"
+
+
+def steps(dot_code, layout="declared", fixes=None):
+    handler = object.__new__(GrokHandler)
+    return handler._render_steps(dot_code, get_profile("full", image_format="png", layout=layout), fixes.append
+                                 if fixes is not None else None)
+
+
+def test_render_without_fixes():
+    calls = {"render": lambda dot_code, engine: f"{engine}:{dot_code}".encode()}
+    assert run_steps(steps(GOOD), calls) == b"dot:" + GOOD.encode()
+
+
+def test_render_error_goes_to_the_fix_stage():
+    errors, fixes = [], []
+
+    def render(dot_code, engine):
+        if dot_code != GOOD:
+            raise RuntimeError("Error: <stdin>: syntax error in line 2 near 'b'")
+        return b"image"
+
+    def fix(dot_code, error_message):
+        errors.append(error_message)
+        return GOOD
+
+    assert run_steps(steps(BAD.replace("--", "->"), fixes=fixes), {"render": render, "fix": fix}) == b"image"
+    assert errors == ["Error: <stdin>: syntax error in line 2 near 'b'"]
+    assert fixes == [GOOD]
+
+
+def test_lint_error_goes_to_the_fix_stage_without_rendering():
+    rendered, errors = [], []
+    calls = {"render": lambda dot_code, engine: rendered.append(dot_code) or b"image",
+             "fix": lambda dot_code, error_message: errors.append(error_message) or GOOD}
+    assert run_steps(steps(BAD), calls) == b"image"
+    assert rendered == [GOOD] and "line 3" in errors[0]
+
+
+def test_render_limits_are_not_sent_to_the_llm():
+    def render(dot_code, engine):
+        raise RenderBusyError("busy")
+
+    with pytest.raises(RenderBusyError):
+        run_steps(steps(GOOD), {"render": render, "fix": pytest.fail})
+
+
+def test_gives_up_after_five_attempts():
+    calls = {"render": lambda dot_code, engine: (_ for _ in ()).throw(RuntimeError("bad")),
+             "fix": lambda dot_code, error_message: dot_code}
+    with pytest.raises(RuntimeError, match="after 5 attempts"):
+        run_steps(steps(GOOD), calls)
+
+
+def test_async_driver_shares_the_loop():
+    class Choice:
+        engine = "neato"
+
+    async def select(dot_code):
+        return Choice()
+
+    async def render(dot_code, engine):
+        return f"{engine}:{dot_code}".encode()
+
+    image = asyncio.run(arun_steps(steps(GOOD, layout="auto"), {"select": select, "render": render}))
+    assert image == b"neato:digraph G { layout=neato;\n  a -> b;\n}"
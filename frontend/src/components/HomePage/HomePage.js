@@ -1,8 +1,10 @@
 import React, { useState } from "react";
+import { useUser } from "@clerk/clerk-react";
 import Header from "../Header/Header";
 import { Download } from "lucide-react";
 
 const HomePage = () => {
+  const { user } = useUser();
   const [userPrompt, setUserPrompt] = useState("");
   const [result, setResult] = useState(null);
   const [isLoading, setIsLoading] = useState(false);
@@ -23,10 +25,18 @@ const HomePage = () => {
         method: "POST",
         headers: {
           "Content-Type": "application/json",
+          // Rate limits are per user when signed in, per IP address otherwise
+          ...(user ? { "X-User-Id": user.id } : {}),
         },
         body: JSON.stringify({ prompt: userPrompt }),
       });
 
+      if (response.status === 429) {
+        const retryAfter = response.headers.get("Retry-After");
+        setError(`Too many requests. Please try again in ${retryAfter || "a few"} seconds.`);
+        return;
+      }
+
       if (!response.ok) {
         throw new Error("Failed to analyze text");
       }